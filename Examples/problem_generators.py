@@ -0,0 +1,119 @@
+"""
+Generators for random problems in the blocks-world and logistics domains,
+for seeing how the planner scales. Each generator takes a seed for
+random.Random and returns the same problem each time it is called with the
+same arguments. Unlike the example domains, this file doesn't create a
+domain or print anything when it is imported, so tests and benchmarks can
+import it and make problems with thousands of objects:
+
+    from Examples.problem_generators import random_blocks_problem
+    (state, goal) = random_blocks_problem(1000, seed=3)
+
+See random_blocks_problem and random_logistics_problem for the todo_lists
+to give find_plan in each domain.
+"""
+
+import random
+
+import gtpyhop
+
+
+################################################################################
+# Blocks world
+
+
+def _random_towers(blocks, rng):
+    """
+    Return a dictionary pos that puts the blocks into randomly chosen towers:
+    pos[b] is either 'table' or the block that b is on.
+    """
+    pos = {}
+    tops = []
+    for b in rng.sample(blocks, len(blocks)):
+        if tops and rng.random() < 0.7:
+            i = rng.randrange(len(tops))
+            pos[b] = tops[i]
+            tops[i] = b
+        else:
+            pos[b] = 'table'
+            tops.append(b)
+    return pos
+
+
+def random_blocks_problem(n, seed=0):
+    """
+    Return (state, multigoal) for a random problem with the n blocks 'b0',
+    'b1', ..., in which the goal is to rearrange one random set of towers
+    into another. The state has the state variables pos, clear and holding
+    that blocks_htn, blocks_gtn, blocks_hgn and blocks_goal_splitting use,
+    with nothing in the hand, and multigoal.pos gives the position of every
+    block. The todo_list for blocks_htn is [('achieve', multigoal)], and
+    for the other three domains it is [multigoal].
+    """
+    rng = random.Random(seed)
+    blocks = [f'b{i}' for i in range(n)]
+    state = gtpyhop.State(f'random_{n}_blocks')
+    state.pos = _random_towers(blocks, rng)
+    state.clear = {b:True for b in blocks}
+    for b in blocks:
+        if state.pos[b] != 'table':
+            state.clear[state.pos[b]] = False
+    state.holding = {'hand':False}
+    goal = gtpyhop.Multigoal(f'goal_{n}_blocks')
+    goal.pos = _random_towers(blocks, rng)
+    return (state, goal)
+
+
+################################################################################
+# Logistics
+
+
+def random_logistics_problem(cities, packages, trucks=None, planes=1,
+                             locations_per_city=2, seed=0):
+    """
+    Return (state, goals) for a random problem in logistics_hgn with the given
+    numbers of cities, packages, trucks and planes. Each city c has the
+    locations 'location{c}_0', 'location{c}_1', ..., locations_per_city of
+    them, and the airport 'airport{c}'. trucks defaults to one per city, and
+    must be at least the number of cities, since logistics_hgn needs a truck
+    in each city; the trucks are dealt out to the cities in turn, and start
+    at random locations there. The planes start at random airports, and the
+    packages at random locations or airports. goals is a list of unigoals
+    ('at', package, location) that send each package to a random location,
+    possibly in another city; it is the todo_list to give find_plan.
+
+    The sets of objects in the state (packages, trucks, airplanes, locations,
+    airports and cities) are dictionaries whose values are all True, rather
+    than sets as in the logistics_hgn examples. They work the same way with
+    'in', but they are iterated in a fixed order, so the planner finds the
+    same plan each time.
+    """
+    if trucks == None:
+        trucks = cities
+    if cities < 1 or trucks < cities or (cities > 1 and planes < 1):
+        raise Exception("random_logistics_problem needs at least one city, " + \
+                        "a truck for each city, and a plane if there are several cities")
+    rng = random.Random(seed)
+    state = gtpyhop.State(f'random_logistics_{cities}_{packages}')
+    state.cities = {f'city{c}':True for c in range(cities)}
+    state.in_city = {}
+    city_locations = []
+    for c in range(cities):
+        locations = [f'location{c}_{i}' for i in range(locations_per_city)]
+        locations.append(f'airport{c}')
+        for l in locations:
+            state.in_city[l] = f'city{c}'
+        city_locations.append(locations)
+    state.locations = {l:True for l in state.in_city}
+    state.airports = {f'airport{c}':True for c in range(cities)}
+    state.trucks = {f'truck{t}':True for t in range(trucks)}
+    state.truck_at = {f'truck{t}': rng.choice(city_locations[t % cities])
+                      for t in range(trucks)}
+    state.airplanes = {f'plane{p}':True for p in range(planes)}
+    airports = list(state.airports)
+    state.plane_at = {f'plane{p}': rng.choice(airports) for p in range(planes)}
+    state.packages = {f'package{p}':True for p in range(packages)}
+    all_locations = list(state.locations)
+    state.at = {f'package{p}': rng.choice(all_locations) for p in range(packages)}
+    goals = [('at', f'package{p}', rng.choice(all_locations)) for p in range(packages)]
+    return (state, goals)
@@ -18,4 +18,791 @@ import blocks_hgn; blocks_hgn.main(False)
 import blocks_htn; blocks_htn.main(False)
 import pyhop_simple_travel_example
 import simple_htn_acting_error
+
+
+################################################################################
+# The following checks don't print the planner's messages. Each of them
+# compares what find_plan returns with what it should return, and
+# check_result raises an exception if they differ.
+
+import asyncio, contextlib, copy, io, json, os, subprocess, sys, tempfile, threading, time
+
+import gtpyhop
+import test_harness as th
+from problem_generators import random_blocks_problem, random_logistics_problem
+
+gtpyhop.verbose = 0
+
+pyhop_travel_domain = [d for d in gtpyhop._domains
+                       if d.__name__ == 'pyhop_simple_travel_example'][0]
+
+
+def engine_problems():
+    """
+    Return a list of (domain, state, todo_list) for problems in each of the
+    example domains.
+    """
+    problems = [
+        (simple_htn.the_domain, simple_htn.state0,
+            [('travel','alice','park'), ('travel','bob','park')]),
+        (simple_hgn.the_domain, simple_hgn.state0, [simple_hgn.goal3]),
+        (simple_hgn.the_domain, simple_hgn.state0, [('loc','alice','park')]),
+        (pyhop_travel_domain, pyhop_simple_travel_example.state1,
+            [('travel','me','home','park')])]
+    for todo_list in ([('put_it',),('need0',)], [('put_it',),('need01',)],
+                      [('put_it',),('need10',)], [('put_it',),('need1',)]):
+        problems.append((backtracking_htn.the_domain, backtracking_htn.state0, todo_list))
+    for seed in range(3):
+        (state, goals) = random_logistics_problem(3, 6, seed=seed)
+        problems.append((logistics_hgn.the_domain, state, goals))
+        (state, goal) = random_blocks_problem(12, seed=seed)
+        problems.append((blocks_gtn.the_domain, state, [goal]))
+        problems.append((blocks_hgn.the_domain, state, [goal]))
+        problems.append((blocks_goal_splitting.the_domain, state, [goal]))
+        problems.append((blocks_htn.the_domain, state, [('achieve', goal)]))
+    return problems
+
+
+def check_engines():
+    """
+    Check that the iterative engine, with and without its trail and
+    transposition table, and both engines with copy_on_write and with
+    track_multigoals, return the same plans as seek_plan does, and that
+    copy_on_write doesn't change the caller's state, even when goals are
+    tracked.
+    """
+    options_list = [{'engine':'iterative'},
+                    {'engine':'iterative', 'trail':True},
+                    {'engine':'iterative', 'transposition_table':True},
+                    {'engine':'iterative', 'trail':True, 'transposition_table':True}]
+    for (domain, state, todo_list) in engine_problems():
+        gtpyhop.current_domain = domain
+        expected = gtpyhop.find_plan(state, todo_list, engine='recursive')
+        print(f"{domain.__name__} {todo_list}")
+        for options in options_list:
+            th.check_result(gtpyhop.find_plan(state, todo_list, **options), expected)
+        state_vars = copy.deepcopy(vars(state))
+        for settings in ((True, False), (False, True), (True, True)):
+            (gtpyhop.copy_on_write, gtpyhop.track_multigoals) = settings
+            # without copy_on_write, tracking makes the start state watched
+            start = state if settings[0] else copy.deepcopy(state)
+            try:
+                for options in [{'engine':'recursive'}] + options_list:
+                    th.check_result(gtpyhop.find_plan(start, todo_list, **options),
+                                    expected)
+            finally:
+                (gtpyhop.copy_on_write, gtpyhop.track_multigoals) = (False, False)
+        th.check_result([type(val) for val in vars(state).values()],
+                        [type(val) for val in state_vars.values()])
+        th.check_result(vars(state), state_vars)
+
+
+def check_parallel_search():
+    """
+    Check that find_plan with workers returns the same plans as without,
+    and False for a problem that has no plan.
+    """
+    for (domain, state, todo_list) in engine_problems():
+        gtpyhop.current_domain = domain
+        th.check_result(gtpyhop.find_plan(state, todo_list, workers=2),
+                        gtpyhop.find_plan(state, todo_list))
+    gtpyhop.current_domain = backtracking_htn.the_domain
+    todo_list = [('put_it',), ('need0',), ('need1',)]
+    th.check_result(gtpyhop.find_plan(backtracking_htn.state0, todo_list), False)
+    for options in ({'workers':2}, {'workers':2, 'first_found':True}):
+        th.check_result(gtpyhop.find_plan(backtracking_htn.state0, todo_list,
+                                          **options), False)
+
+def check_portfolio_search():
+    """
+    Check that find_plan with a portfolio of one search in the declared
+    method order returns the same plan as without, that the plans that
+    larger portfolios and restart_nodes return achieve the goal, and that
+    they return False for a problem that has no plan.
+    """
+    for seed in range(3):
+        (state, goal) = random_blocks_problem(12, seed=seed)
+        for domain in (blocks_gtn.the_domain, blocks_hgn.the_domain,
+                       blocks_goal_splitting.the_domain):
+            gtpyhop.current_domain = domain
+            th.check_result(gtpyhop.find_plan(state, [goal], portfolio=[None]),
+                            gtpyhop.find_plan(state, [goal]))
+            for options in ({'portfolio':3}, {'portfolio':3, 'restart_nodes':10}):
+                plan = gtpyhop.find_plan(state, [goal], **options)
+                th.check_result(achieves(execute(state, plan), goal), True)
+    gtpyhop.current_domain = backtracking_htn.the_domain
+    todo_list = [('put_it',), ('need0',), ('need1',)]
+    for options in ({'portfolio':3}, {'portfolio':3, 'restart_nodes':2}):
+        th.check_result(gtpyhop.find_plan(backtracking_htn.state0, todo_list,
+                                          **options), False)
+
+def check_long_plan():
+    """
+    Check that the iterative engine finds a plan of more than 1000 actions,
+    which would make seek_plan raise RecursionError.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    state = gtpyhop.State('three_blocks')
+    state.pos = {'a':'table', 'b':'table', 'c':'table'}
+    state.clear = {'a':True, 'b':True, 'c':True}
+    state.holding = {'hand':False}
+    todo_list = [('pos','a','hand'), ('pos','a','table')] * 600
+    expected = [('pickup','a'), ('putdown','a')] * 600
+    for trail in (False, True):
+        th.check_result(gtpyhop.find_plan(state, todo_list, engine='iterative',
+                                          trail=trail), expected)
+
+
+def fresh_fingerprint(obj):
+    """
+    Return the fingerprint of a new state or multigoal that has the same
+    state variables as obj, computed from scratch rather than updated.
+    """
+    fresh = type(obj)('fresh')
+    for (varname, val) in vars(obj).items():
+        if varname != '__name__':
+            setattr(fresh, varname, copy.deepcopy(val))
+    return fresh.fingerprint()
+
+
+def check_fingerprints():
+    """
+    Check that equal states and multigoals built in different orders are
+    == and have the same hash value, and that writes to a dictionary, writes
+    of whole state variables, and trail undos keep their fingerprints equal
+    to fingerprints computed from scratch.
+    """
+    for cls in (gtpyhop.State, gtpyhop.Multigoal):
+        x1 = cls('x1')
+        x1.pos = {'a':'b', 'b':'table', 'c':'table'}
+        x1.clear = {'a':True, 'b':False, 'c':True}
+        x2 = cls('x2', clear={'c':True, 'b':False})
+        x2.pos = {'c':'table'}
+        x2.pos['b'] = 'table'
+        x2.pos['a'] = 'b'
+        x2.clear['a'] = True
+        th.check_result(x1 == x2, True)
+        th.check_result(hash(x1) == hash(x2), True)
+        x2.pos['a'] = 'c'
+        th.check_result(x1 == x2, False)
+        th.check_result(x2.fingerprint(), fresh_fingerprint(x2))
+        del x2.pos['a']
+        th.check_result(x2.fingerprint(), fresh_fingerprint(x2))
+        x2.holding = {'hand':'a'}
+        th.check_result(x2.fingerprint(), fresh_fingerprint(x2))
+        x2.clear = {'a':False}
+        th.check_result(x2.fingerprint(), fresh_fingerprint(x2))
+        x3 = x2.copy()
+        x3.pos['a'] = 'table'
+        th.check_result(x3.fingerprint(), fresh_fingerprint(x3))
+        th.check_result(x2.fingerprint(), fresh_fingerprint(x2))
+    state = gtpyhop.State('state', pos={'a':'b', 'b':'table'}, clear={'a':True, 'b':False})
+    state.fingerprint()
+    trail = []
+    working = gtpyhop._trailed_copy(state, trail)
+    working.pos['a'] = 'table'
+    working.clear['b'] = True
+    working.holding = {'hand':False}
+    del working.pos['b']
+    th.check_result(working.fingerprint(), fresh_fingerprint(working))
+    gtpyhop._undo_trail(trail, 0)
+    th.check_result(working == state, True)
+    th.check_result(working.fingerprint(), fresh_fingerprint(working))
+    th.check_result(working.fingerprint(), state.fingerprint())
+    gtpyhop.copy_on_write = True
+    try:
+        shared = state.copy()
+        shared.pos['a'] = 'table'
+        th.check_result(shared.fingerprint(), fresh_fingerprint(shared))
+        th.check_result(state.fingerprint(), fresh_fingerprint(state))
+    finally:
+        gtpyhop.copy_on_write = False
+
+
+def check_guarded_blocks():
+    """
+    Check that a copy of blocks_hgn whose 'pos' methods have guards finds
+    the same plans as blocks_hgn, with both engines.
+    """
+    guarded = blocks_hgn.the_domain.copy('blocks_hgn_guarded')
+    gtpyhop.current_domain = guarded
+    gtpyhop.declare_unigoal_methods('pos', blocks_hgn.m_take, blocks_hgn.m_put, guards={
+        blocks_hgn.m_take: gtpyhop.Guard(args=(gtpyhop.ANY, 'hand'),
+                               tests=[('clear', gtpyhop.Arg(0), True),
+                                      ('holding', 'hand', False)]),
+        blocks_hgn.m_put: gtpyhop.Guard(args=(gtpyhop.ANY, gtpyhop.Not('hand')),
+                              tests=[('pos', gtpyhop.Arg(0), 'hand')])})
+    for seed in range(3):
+        (state, goal) = random_blocks_problem(15, seed=seed)
+        for engine in ('recursive', 'iterative'):
+            gtpyhop.current_domain = blocks_hgn.the_domain
+            expected = gtpyhop.find_plan(state, [goal], engine=engine)
+            gtpyhop.current_domain = guarded
+            th.check_result(gtpyhop.find_plan(state, [goal], engine=engine), expected)
+
+
+def check_guard_patterns():
+    """
+    Check that guards with Not, sets and Arg(i) keep the planner from
+    calling the methods they should, and that declaring methods or guards
+    again makes the planner use the new ones.
+    """
+    domain = gtpyhop.Domain('guard_patterns')
+
+    def paint(state, x, color):
+        state.color[x] = color
+        return state
+
+    # none of the methods checks anything, so only the guards decide
+    def m_green(state, x):
+        return [('paint', x, 'green')]
+
+    def m_red(state, x):
+        return [('paint', x, 'red')]
+
+    def m_blue(state, x):
+        return [('paint', x, 'blue')]
+
+    def m_gold(state, x):
+        return [('paint', x, 'gold')]
+
+    gtpyhop.declare_actions(paint)
+    gtpyhop.declare_task_methods('color', m_green, m_red, m_blue, guards={
+        m_green: gtpyhop.Guard(args=(gtpyhop.Not('a'),),
+                               tests=[('wet', gtpyhop.Arg(0), False)]),
+        m_red: gtpyhop.Guard(args=('a',)),
+        m_blue: gtpyhop.Guard(args=({'b', 'c'},))})
+    state = gtpyhop.State('state', color={}, wet={'a':False, 'b':True, 'c':False})
+    for engine in ('recursive', 'iterative'):
+        th.check_result(gtpyhop.find_plan(state, [('color','a')], engine=engine),
+                        [('paint','a','red')])
+        th.check_result(gtpyhop.find_plan(state, [('color','b')], engine=engine),
+                        [('paint','b','blue')])
+        th.check_result(gtpyhop.find_plan(state, [('color','c')], engine=engine),
+                        [('paint','c','green')])
+        th.check_result(gtpyhop.find_plan(state, [('color','e')], engine=engine), False)
+    gtpyhop.declare_task_methods('color', m_gold, guards={m_gold: gtpyhop.Guard(args=('e',))})
+    gtpyhop.declare_task_methods('color', m_red, guards={m_red: gtpyhop.Guard(args=('c',))})
+    for engine in ('recursive', 'iterative'):
+        th.check_result(gtpyhop.find_plan(state, [('color','e')], engine=engine),
+                        [('paint','e','gold')])
+        th.check_result(gtpyhop.find_plan(state, [('color','a')], engine=engine), False)
+        th.check_result(gtpyhop.find_plan(state, [('color','c')], engine=engine),
+                        [('paint','c','green')])
+
+
+def check_budgets():
+    """
+    Check that max_nodes, max_depth and deadline stop the search with the
+    right status, that a search that is stopped and resumed finds the same
+    plan as one that isn't, and that subproblems that max_depth cut off
+    aren't recorded as failures in a transposition table.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(15, seed=1)
+    expected = gtpyhop.find_plan(state, [goal], return_result=True)
+    th.check_result(expected.status, 'success')
+    result = gtpyhop.find_plan(state, [goal], return_result=True, max_nodes=10)
+    th.check_result((result.plan, result.status, result.nodes), (False, 'max_nodes', 10))
+    result = gtpyhop.find_plan(state, [goal], return_result=True, deadline=time.time()-1)
+    th.check_result((result.plan, result.status, result.nodes), (False, 'deadline', 0))
+    result = gtpyhop.find_plan(state, [goal], return_result=True, max_depth=expected.depth)
+    th.check_result((result.plan, result.status), (expected.plan, 'success'))
+    table = gtpyhop.TranspositionTable()
+    result = gtpyhop.find_plan(state, [goal], return_result=True, max_depth=10,
+                               transposition_table=table)
+    th.check_result((result.plan, result.status), (False, 'max_depth'))
+    th.check_result(gtpyhop.find_plan(state, [goal], transposition_table=table),
+                    expected.plan)
+    unsolvable = gtpyhop.State('unsolvable', pos={'a':'b', 'b':'table'},
+                               clear={'a':True, 'b':False}, holding={'hand':False})
+    result = gtpyhop.find_plan(unsolvable, [('pickup','b')], return_result=True)
+    th.check_result((result.plan, result.status), (False, 'failure'))
+
+    for options in ({}, {'trail':True}, {'transposition_table':gtpyhop.TranspositionTable()}):
+        search = gtpyhop._SearchEngine(state, [goal], max_nodes=0, **options)
+        plan = False
+        while search.status in {None, 'max_nodes'}:
+            search.max_nodes += 7
+            plan = search.run()
+        th.check_result((plan, search.status, search.nodes),
+                        (expected.plan, 'success', expected.nodes))
+    plan = asyncio.run(gtpyhop.find_plan_async(state, [goal], yield_nodes=3))
+    th.check_result(plan, expected.plan)
+
+
+def check_transpositions():
+    """
+    Check that a transposition table works with long todo_lists and with
+    unhashable items, and that it finds subproblems that were reached
+    through different methods whose goals are verified.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    state = gtpyhop.State('three_blocks')
+    state.pos = {'a':'table', 'b':'table', 'c':'table'}
+    state.clear = {'a':True, 'b':True, 'c':True}
+    state.holding = {'hand':False}
+    todo_list = [('pos','a','hand'), ('pos','a','table')] * 600
+    th.check_result(gtpyhop.find_plan(state, todo_list, trail=True,
+                                      transposition_table=gtpyhop.TranspositionTable()),
+                    [('pickup','a'), ('putdown','a')] * 600)
+    items = [('pos','a','hand'), ('pos','b','table')]
+    th.check_result(hash(gtpyhop._push_hashed_items(items, ())),
+                    hash(gtpyhop._push_hashed_items(items[:1],
+                                                    gtpyhop._push_hashed_items(items[1:], ()))))
+    th.check_result(gtpyhop._push_hashed_items(items, ()) ==
+                    gtpyhop._push_items(items, ()), True)
+
+    # m_1 and m_2 both lead to the task t in the same state, before a task
+    # that fails, so the second time t is refined it is a known failure
+    domain = gtpyhop.Domain('transpositions')
+
+    def a_set(state, x):
+        state.v[x] = 1
+        return state
+
+    def noop(state):
+        return state
+
+    def m_t(state, x):
+        return [('a_set', x)]
+
+    def m_fail(state, items):
+        return False
+
+    def m_1(state, x, value):
+        return [('t', x)]
+
+    def m_2(state, x, value):
+        return [('noop',), ('t', x)]
+
+    gtpyhop.declare_actions(a_set, noop)
+    gtpyhop.declare_task_methods('t', m_t)
+    gtpyhop.declare_task_methods('fail', m_fail)
+    gtpyhop.declare_unigoal_methods('v', m_1, m_2)
+    state = gtpyhop.State('state', v={'x':0})
+    counts = []
+    old_verify_goals = gtpyhop.verify_goals
+    try:
+        for verify in (False, True):
+            gtpyhop.verify_goals = verify
+            table = gtpyhop.TranspositionTable()
+            # the list in ('fail', [...]) makes the todo_list unhashable
+            for todo_list in ([('v','x',1), ('fail', 'x')], [('v','x',1), ('fail', ['x'])]):
+                result = gtpyhop.find_plan(state, todo_list, return_result=True,
+                                           transposition_table=table)
+                counts.append((result.status, result.nodes, table.stores, table.hits))
+    finally:
+        gtpyhop.verify_goals = old_verify_goals
+    th.check_result(counts[0][3], 1)
+    th.check_result(counts[:2], counts[2:])
+
+
+def check_domain_versions():
+    """
+    Check that the example domains' versions, and a PlanCache key, are the
+    same in two different Python processes, so that a PlanCache with a
+    directory can find the results that another process stored in it.
+    """
+    code = """
+import blocks_goal_splitting, blocks_hgn, logistics_hgn, gtpyhop
+from problem_generators import random_blocks_problem
+(state, goal) = random_blocks_problem(10)
+gtpyhop.current_domain = blocks_goal_splitting.the_domain
+gtpyhop.split_multigoal_order = gtpyhop.order_by_dependencies
+print([m.the_domain._get_version() for m in (blocks_goal_splitting, blocks_hgn, logistics_hgn)],
+      gtpyhop.PlanCache().key(state, [goal]))
+"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    outputs = [subprocess.run([sys.executable, '-c', code], cwd=directory, check=True,
+                              capture_output=True, text=True).stdout.splitlines()[-1]
+               for i in range(2)]
+    print(outputs[0])
+    th.check_result(outputs[0], outputs[1])
+
+
+def check_find_plans_options():
+    """
+    Check that find_plans with workers rejects the options whose objects
+    each worker would update its own copy of, and that without workers, it
+    updates them.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    problems = [random_blocks_problem(8, seed=seed) for seed in range(3)]
+    problems = [(state, [goal]) for (state, goal) in problems]
+    options_list = [{'plan_cache': gtpyhop.PlanCache()},
+                    {'method_statistics': gtpyhop.MethodStatistics()},
+                    {'tracer': gtpyhop.SearchTracer()}]
+    for options in options_list:
+        try:
+            list(gtpyhop.find_plans(problems, workers=2, **options))
+        except Exception as e:
+            th.check_result("can't be used with workers" in str(e), True)
+        else:
+            raise Exception(f"find_plans accepted {list(options)} with workers")
+    plan_cache = gtpyhop.PlanCache()
+    for i in range(2):
+        results = list(gtpyhop.find_plans(problems, plan_cache=plan_cache))
+        th.check_result([r.plan for (_, r) in results],
+                        [gtpyhop.find_plan(state, todo_list) for (state, todo_list) in problems])
+    th.check_result((plan_cache.stores, plan_cache.hits), (3, 3))
+    statistics = gtpyhop.MethodStatistics()
+    list(gtpyhop.find_plans(problems, method_statistics=statistics))
+    th.check_result(statistics.counts(blocks_hgn.m_take)[0] > 0, True)
+    tracer = gtpyhop.SearchTracer(format='collapsed')
+    list(gtpyhop.find_plans(problems, tracer=tracer))
+    th.check_result(tracer.spans > 0, True)
+
+
+def achieves(state, goal):
+    """Return True if state achieves the blocks-world multigoal goal"""
+    return all(state.pos[b] == goal.pos[b] for b in goal.pos)
+
+
+def execute(state, plan):
+    """Return the state that executing plan's actions from state leads to"""
+    actions = gtpyhop.current_domain._action_dict
+    for action in plan:
+        state = actions[action[0]](state.copy(), *action[1:])
+    return state
+
+
+def check_repair_plan():
+    """
+    For each 'stack' action in the plans for some blocks_hgn problems, make
+    the action fail by dropping the block on the table, and check that the
+    plan that repair_plan finds reaches the goal from there.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    for seed in range(3):
+        (state, goal) = random_blocks_problem(12, seed=seed)
+        tree = gtpyhop.find_plan(state, [goal], return_tree=True)
+        for (step, action) in enumerate(tree.plan):
+            if action[0] != 'stack':
+                continue
+            new_state = execute(state, tree.plan[:step])
+            block = action[1]
+            new_state.pos[block] = 'table'
+            new_state.clear[block] = True
+            new_state.holding['hand'] = False
+            repaired = gtpyhop.repair_plan(tree, new_state, step)
+            th.check_result(achieves(execute(new_state, repaired.plan), goal), True)
+
+
+def check_run_lazy_lookahead_repair():
+    """
+    Check that with repair=True and verbose = 0, run_lazy_lookahead stops
+    executing a plan when a command fails, executes the plan that
+    repair_plan finds instead, and reaches the goal.
+    """
+    domain = blocks_hgn.the_domain.copy('blocks_hgn_acting')
+    gtpyhop.current_domain = domain
+    executed = []
+    failures = [1]          # how many more 'stack' commands should fail
+
+    def make_command(action):
+        def command(state, *args):
+            executed.append((action.__name__,) + args)
+            if action.__name__ == 'stack' and failures[0] > 0:
+                failures[0] -= 1
+                return False
+            return action(state, *args)
+        command.__name__ = 'c_' + action.__name__
+        return command
+
+    gtpyhop.declare_commands(*[make_command(action) for action in domain._action_dict.values()])
+    (state, goal) = random_blocks_problem(12, seed=0)
+    tree = gtpyhop.find_plan(state, [goal], return_tree=True)
+    step = [a[0] for a in tree.plan].index('stack')
+    repaired = gtpyhop.repair_plan(tree, execute(state, tree.plan[:step]), step)
+    gtpyhop.verbose = 0
+    final_state = gtpyhop.run_lazy_lookahead(state, [goal], repair=True)
+    th.check_result(executed, tree.plan[:step+1] + repaired.plan)
+    th.check_result(achieves(final_state, goal), True)
+
+
+def check_recursive_threads():
+    """
+    Check that find_plan calls that use the recursive engine in several
+    threads at once each get the options they were given: the calls with
+    return_tree get decomposition trees, and the others get plain plans.
+    Also check that a search in one thread doesn't make a search in another
+    thread wait for it.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(30, seed=5)
+    expected = gtpyhop.find_plan(state, [goal], engine='recursive')
+    results = []
+
+    def plan(return_tree):
+        for i in range(5):
+            results.append((return_tree, gtpyhop.find_plan(state, [goal],
+                            engine='recursive', return_tree=return_tree)))
+
+    threads = [threading.Thread(target=plan, args=(i % 2 == 0,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    th.check_result(len(results), 20)
+    th.check_result([(result.plan if return_tree else result) == expected
+                     for (return_tree, result) in results], [True] * 20)
+
+    # m_wait waits for a find_plan call in another thread, which would wait
+    # for m_wait's own search if searches excluded each other
+    domain = gtpyhop.Domain('threads')
+    inner_plans = []
+
+    def noop(state):
+        return state
+
+    def m_wait(state):
+        thread = threading.Thread(target=lambda: inner_plans.append(
+            gtpyhop.find_plan(state, [('noop',)], engine='recursive')))
+        thread.start()
+        thread.join(10)
+        return [] if inner_plans else False
+
+    gtpyhop.declare_actions(noop)
+    gtpyhop.declare_task_methods('wait', m_wait)
+    state = gtpyhop.State('state')
+    tree = gtpyhop.find_plan(state, [('wait',)], engine='recursive', return_tree=True)
+    th.check_result((tree.plan, inner_plans), ([], [[('noop',)]]))
+
+
+def check_display_events():
+    """
+    Check that SearchStats.display, MethodStatistics.display and
+    DecompositionTree.display report their text as events, so that they
+    print nothing once print_event is removed from event_sinks.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(8, seed=2)
+    statistics = gtpyhop.MethodStatistics()
+    result = gtpyhop.find_plan(state, [goal], return_result=True, return_tree=True,
+                               stats=True, method_statistics=statistics)
+    old_sinks = gtpyhop.event_sinks
+    events = []
+    output = io.StringIO()
+    gtpyhop.event_sinks = [events.append]
+    try:
+        with contextlib.redirect_stdout(output):
+            result.stats.display()
+            statistics.display()
+            result.tree.display()
+    finally:
+        gtpyhop.event_sinks = old_sinks
+    th.check_result(output.getvalue(), '')
+    th.check_result([event.kind for event in events], ['message'] * 3)
+    th.check_result(events[0].message.startswith(result.stats.summary()), True)
+    th.check_result('m_take' in events[1].message, True)
+    th.check_result(events[2].message.startswith('Decomposition tree for'), True)
+
+
+def check_problem_generators():
+    """
+    Check that the problem generators give equal problems when they are
+    called twice with the same seed, and that logistics_hgn can solve a
+    small random logistics problem: executing the plan puts each package
+    where its goal says.
+    """
+    for seed in range(3):
+        th.check_result(random_blocks_problem(20, seed=seed),
+                        random_blocks_problem(20, seed=seed))
+        th.check_result(random_logistics_problem(3, 5, seed=seed),
+                        random_logistics_problem(3, 5, seed=seed))
+    th.check_result(random_blocks_problem(20, seed=0) == random_blocks_problem(20, seed=1),
+                    False)
+    gtpyhop.current_domain = logistics_hgn.the_domain
+    (state, goals) = random_logistics_problem(2, 4, seed=1)
+    plan = gtpyhop.find_plan(state, goals)
+    th.check_result(plan != False, True)
+    final_state = execute(state, plan)
+    th.check_result([final_state.at[package] for (_, package, _) in goals],
+                    [location for (_, _, location) in goals])
+
+
+def check_search_stats():
+    """
+    Check that a SearchStats adds up the work of the calls it is passed to,
+    that stats=True returns a new one in the PlanResult, and that stats=True
+    without return_result, which would lose it, is an error.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(8, seed=4)
+    result = gtpyhop.find_plan(state, [goal], return_result=True, stats=True)
+    th.check_result((result.stats.calls, result.stats.nodes, result.stats.actions),
+                    (1, result.nodes, len(result.plan)))
+    stats = gtpyhop.SearchStats()
+    for engine in ('recursive', 'iterative'):
+        gtpyhop.find_plan(state, [goal], engine=engine, stats=stats)
+    th.check_result((stats.calls, stats.nodes), (2, 2 * result.nodes))
+    try:
+        gtpyhop.find_plan(state, [goal], stats=True)
+    except Exception as e:
+        th.check_result('requires return_result' in str(e), True)
+    else:
+        raise Exception("find_plan accepted stats=True without return_result")
+
+
+def check_search_tracer():
+    """
+    Check that a chrome SearchTracer keeps only its max_spans longest spans,
+    counts the others as discarded, and saves the ones it kept.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(12, seed=3)
+    tracer = gtpyhop.SearchTracer(max_spans=10)
+    gtpyhop.find_plan(state, [goal], tracer=tracer)
+    th.check_result((len(tracer._spans), tracer.discarded), (10, tracer.spans - 10))
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'trace.json')
+        tracer.save(filename)
+        with open(filename) as f:
+            events = json.load(f)['traceEvents']
+    th.check_result(sorted(event['dur'] for event in events),
+                    sorted(span[0] * 1e6 for span in tracer._spans))
+
+    # spans that last 5, 1, 4, 2 and 3 seconds
+    tracer = gtpyhop.SearchTracer(max_spans=3)
+    tracer._start([])
+    frame = tracer._open[0][0]
+    for duration in (5, 1, 4, 2, 3):
+        tracer._close(frame, 0.0, 0.0, 'success', float(duration))
+    th.check_result(sorted(span[0] for span in tracer._spans), [3.0, 4.0, 5.0])
+    th.check_result(tracer.discarded, 2)
+
+
+def check_async_cancel():
+    """
+    Check that cancelling find_plan_async ends the tracer's open spans and
+    makes the EventBuses in event_sinks deliver their events.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(30, seed=6)
+    tracer = gtpyhop.SearchTracer()
+    bus = gtpyhop.EventBus()
+    delivered = []
+    bus.subscribe(delivered.extend)
+
+    async def cancel_search():
+        task = asyncio.ensure_future(gtpyhop.find_plan_async(state, [goal], yield_nodes=5,
+                                                             tracer=tracer))
+        for i in range(3):
+            await asyncio.sleep(0)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return 'cancelled'
+        return 'finished'
+
+    (old_sinks, old_verbose) = (gtpyhop.event_sinks, gtpyhop.verbose)
+    (gtpyhop.event_sinks, gtpyhop.verbose) = ([bus], 2)
+    try:
+        outcome = asyncio.run(cancel_search())
+    finally:
+        (gtpyhop.event_sinks, gtpyhop.verbose) = (old_sinks, old_verbose)
+    th.check_result(outcome, 'cancelled')
+    th.check_result((tracer._open, tracer.path), ([], ()))
+    th.check_result('cancelled' in [span[4] for span in tracer._spans], True)
+    th.check_result((len(bus._buffer), len(delivered) > 0), (0, True))
+
+
+def check_event_bus():
+    """
+    Check that an EventBus gives each subscriber the events it asked for, in
+    batches, reports the events that it drops, and in threaded mode neither
+    loses events nor miscounts the ones that it drops. Also check that
+    find_plan makes the buses in event_sinks deliver their events.
+    """
+    def make_events(specs):
+        return [gtpyhop.Event(level, kind, 'event {i}', {'i': i})
+                for (i, (level, kind)) in enumerate(specs)]
+
+    def recorder(batches):
+        return lambda events: batches.append([event.message for event in events])
+
+    # filtering and batching
+    bus = gtpyhop.EventBus(capacity=100, batch_size=4)
+    (low, x_kind) = ([], [])
+    bus.subscribe(recorder(low), level=1)
+    bus.subscribe(recorder(x_kind), kinds={'x'})
+    for event in make_events([(0,'x'), (2,'x'), (1,'y'), (3,'z'), (1,'x'), (2,'y')]):
+        bus(event)
+    th.check_result((low, x_kind), ([['event 0', 'event 2']], [['event 0', 'event 1']]))
+    bus.flush()
+    th.check_result((low, x_kind), ([['event 0', 'event 2'], ['event 4']],
+                                    [['event 0', 'event 1'], ['event 4']]))
+    bus = gtpyhop.EventBus()
+    bus.subscribe(recorder([]), level=0, kinds={'x'})
+    for event in make_events([(0,'x'), (1,'x'), (0,'y')]):
+        bus(event)
+    th.check_result(len(bus._buffer), 1)
+
+    # dropped events
+    bus = gtpyhop.EventBus(capacity=3)
+    delivered = []
+    bus.subscribe(delivered.extend)
+    for event in make_events([(0,'x')] * 5):
+        bus(event)
+    bus.flush()
+    th.check_result((delivered[0].kind, delivered[0].fields['count'], bus.dropped),
+                    ('events_dropped', 2, 2))
+    th.check_result([event.message for event in delivered[1:]],
+                    ['event 2', 'event 3', 'event 4'])
+
+    # threaded mode: every event is either delivered or counted as dropped
+    for capacity in (100000, 500):
+        bus = gtpyhop.EventBus(capacity=capacity, batch_size=100, threaded=True,
+                               interval=0.001)
+        delivered = []
+        bus.subscribe(delivered.extend)
+        for event in make_events([(0,'x')] * 20000):
+            bus(event)
+        bus.close()
+        messages = [event.message for event in delivered if event.kind == 'x']
+        dropped = sum(event.fields['count'] for event in delivered
+                      if event.kind == 'events_dropped')
+        th.check_result((len(messages) + bus.dropped, dropped), (20000, bus.dropped))
+        th.check_result(messages, sorted(messages, key=lambda m: int(m.split()[1])))
+        if capacity == 100000:
+            th.check_result(bus.dropped, 0)
+
+    # find_plan delivers the buffered events when it finishes
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    (state, goal) = random_blocks_problem(5, seed=0)
+    bus = gtpyhop.EventBus()
+    kinds = []
+    bus.subscribe(lambda events: kinds.extend(event.kind for event in events))
+    (old_sinks, old_verbose) = (gtpyhop.event_sinks, gtpyhop.verbose)
+    (gtpyhop.event_sinks, gtpyhop.verbose) = ([bus], 1)
+    try:
+        gtpyhop.find_plan(state, [goal])
+    finally:
+        (gtpyhop.event_sinks, gtpyhop.verbose) = (old_sinks, old_verbose)
+    th.check_result('plan_found' in kinds, True)
+
+
+check_engines()
+check_parallel_search()
+check_portfolio_search()
+check_long_plan()
+check_fingerprints()
+check_guarded_blocks()
+check_guard_patterns()
+check_budgets()
+check_transpositions()
+check_domain_versions()
+check_find_plans_options()
+check_repair_plan()
+check_run_lazy_lookahead_repair()
+check_recursive_threads()
+check_display_events()
+check_search_stats()
+check_search_tracer()
+check_async_cancel()
+check_event_bus()
+check_problem_generators()
+
 print('\nFinished without error.')
@@ -247,7 +247,7 @@ both the problem and the solution"
     th.check_result(result,expected)
 
     print("""If verbose=2, the planner also prints a note at each recursive call.  Below,
-_verify_g is a task used by the planner to check whether a method has
+_verify_g marks where the planner will check whether a method has
 achieved its goal.
 """)
     gtpyhop.verbose = 2
@@ -293,7 +293,7 @@ Below, goal3 is the goal of having Alice and Bob at the park at the same time.
     
     print("""
 Next, we'll call find_plan on goal3, with verbose=2. In the printout,
-_verify_mg is a task used by the planner to check whether a multigoal
+_verify_mg marks where the planner will check whether a multigoal
 method has achieved all of the values specified in the multigoal.
 """)
     th.pause(do_pauses)
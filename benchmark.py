@@ -0,0 +1,879 @@
+"""
+Benchmarks for GTPyhop's planner. To run them, go to the directory that
+contains gtpyhop.py and type
+    python benchmark.py
+Each benchmark prints a small table. The absolute numbers depend on the
+machine; what matters is how they change from one row to the next.
+"""
+
+import os, pickle, sys, time, random
+
+import gtpyhop
+
+# Importing an example domain creates it and makes it the current domain.
+import Examples.blocks_goal_splitting as blocks_goal_splitting
+import Examples.blocks_hgn as blocks_hgn
+import Examples.logistics_hgn as logistics_hgn
+from Examples.problem_generators import random_blocks_problem, random_logistics_problem
+
+
+################################################################################
+# Helper functions
+
+
+def _time_find_plan(state, todo_list, **kwargs):
+    """
+    Call find_plan with verbose = 0 and return (plan, elapsed seconds).
+    """
+    old_verbose = gtpyhop.verbose
+    gtpyhop.verbose = 0
+    try:
+        start = time.perf_counter()
+        plan = gtpyhop.find_plan(state, todo_list, **kwargs)
+        elapsed = time.perf_counter() - start
+    finally:
+        gtpyhop.verbose = old_verbose
+    return (plan, elapsed)
+
+
+################################################################################
+# Benchmarks
+
+
+def long_plans(sizes=(1000, 2000, 4000, 8000, 16000), engine='iterative'):
+    """
+    Plan for todo_lists of n pairs of blocks-world goals
+        ('pos','a','hand'), ('pos','a','table')
+    in a three-block state, so that the plan has 2n actions but the state
+    stays small. If the cost of the todo_list and the partial plan is linear
+    in the length of the plan, the time per action stays about the same as n
+    grows. With the iterative engine, also plan with trail=True and a
+    TranspositionTable, whose keys include the rest of the todo_list: the
+    time per action should stay about the same with it as well.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    state = gtpyhop.State('three_blocks')
+    state.pos = {'a':'table', 'b':'table', 'c':'table'}
+    state.clear = {'a':True, 'b':True, 'c':True}
+    state.holding = {'hand':False}
+
+    with_table = engine == 'iterative'
+    print(f"\nlong_plans (engine = {engine!r})")
+    print(f"{'n':>8} {'actions':>8} {'seconds':>9} {'usec/action':>12}" + \
+          (f" {'table s':>9} {'usec/action':>12}" if with_table else ""))
+    for n in sizes:
+        todo_list = [('pos','a','hand'), ('pos','a','table')] * n
+        (plan, elapsed) = _time_find_plan(state, todo_list, engine=engine)
+        line = f"{n:>8} {len(plan):>8} {elapsed:>9.3f} {1e6*elapsed/len(plan):>12.1f}"
+        if with_table:
+            (table_plan, table_elapsed) = _time_find_plan(
+                state, todo_list, engine=engine, trail=True,
+                transposition_table=gtpyhop.TranspositionTable())
+            assert table_plan == plan
+            line += f" {table_elapsed:>9.3f} {1e6*table_elapsed/len(plan):>12.1f}"
+        print(line)
+
+
+def logistics_scaling(sizes=((10, 100), (30, 1000), (100, 4000)), seed=0):
+    """
+    Solve a random logistics_hgn problem with each (cities, packages) pair in
+    'sizes', one truck per city and one plane per ten cities, and print the
+    time per action. The state copies grow with the problem, so the trail
+    keeps the time per action from growing with it as well.
+    """
+    gtpyhop.current_domain = logistics_hgn.the_domain
+    print("\nlogistics_scaling (engine = 'iterative', trail = True)")
+    print(f"{'cities':>8} {'packages':>9} {'actions':>8} {'seconds':>9} {'usec/action':>12}")
+    for (cities, packages) in sizes:
+        (state, goals) = random_logistics_problem(cities, packages,
+                                                  planes=max(1, cities // 10), seed=seed)
+        (plan, elapsed) = _time_find_plan(state, goals, engine='iterative', trail=True)
+        print(f"{cities:>8} {packages:>9} {len(plan):>8} {elapsed:>9.3f} " + \
+              f"{1e6*elapsed/len(plan):>12.1f}")
+
+
+def state_copying(sizes=(100, 200, 400, 800)):
+    """
+    Solve random n-block problems in three ways: with gtpyhop.copy_on_write
+    set to False (every action deep-copies the state), with copy_on_write
+    set to True (every action copies only the state variables it writes),
+    and with find_plan's trail=True (actions modify one working state, and
+    backtracking undoes their changes).
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    old_copy_on_write = gtpyhop.copy_on_write
+    print("\nstate_copying (engine = 'iterative')")
+    print(f"{'n':>8} {'actions':>8} {'deepcopy s':>11} {'shared s':>9} {'trail s':>8}")
+    try:
+        for n in sizes:
+            (state, goal) = random_blocks_problem(n)
+            times = []
+            for (mode, trail) in ((False, False), (True, False), (False, True)):
+                gtpyhop.copy_on_write = mode
+                (plan, elapsed) = _time_find_plan(state, [goal], engine='iterative',
+                                                  trail=trail)
+                times.append(elapsed)
+            print(f"{n:>8} {len(plan):>8} {times[0]:>11.3f} {times[1]:>9.3f} {times[2]:>8.3f}")
+    finally:
+        gtpyhop.copy_on_write = old_copy_on_write
+
+
+def multigoal_checks(sizes=(1000, 2000, 4000, 8000), repeats=200):
+    """
+    In an n-block state with every block on the table, plan for a todo_list
+    that picks up one block, puts it down again, and then checks a multigoal
+    that says all n blocks are on the table, repeated 'repeats' times. Each
+    check costs time proportional to n if gtpyhop.track_multigoals is False,
+    but not if it is True. The searches use trail=True, so that copying the
+    state doesn't hide the difference.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    old_track_multigoals = gtpyhop.track_multigoals
+    print("\nmultigoal_checks (trail = True)")
+    print(f"{'n':>8} {'actions':>8} {'untracked s':>12} {'tracked s':>10}")
+    try:
+        for n in sizes:
+            blocks = [f'b{i}' for i in range(n)]
+            state = gtpyhop.State(f'{n}_blocks_on_table')
+            state.pos = {b:'table' for b in blocks}
+            state.clear = {b:True for b in blocks}
+            state.holding = {'hand':False}
+            goal = gtpyhop.Multigoal(f'{n}_blocks_on_table', pos=dict(state.pos))
+            todo_list = [('pos','b0','hand'), ('pos','b0','table'), goal] * repeats
+            times = []
+            for track in (False, True):
+                gtpyhop.track_multigoals = track
+                (plan, elapsed) = _time_find_plan(state, todo_list, trail=True)
+                times.append(elapsed)
+            print(f"{n:>8} {len(plan):>8} {times[0]:>12.3f} {times[1]:>10.3f}")
+    finally:
+        gtpyhop.track_multigoals = old_track_multigoals
+
+
+def goal_verification(sizes=(100, 200, 400), n_problems=5):
+    """
+    Solve n_problems random n-block problems in the blocks_goal_splitting
+    domain with verify_goals = False and with verify_goals = True, and
+    count the nodes that the searches expand. Verification markers are
+    checked without expanding a node, so the two counts should be equal and
+    the times nearly so.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    old_verify_goals = gtpyhop.verify_goals
+    print("\ngoal_verification (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'nodes':>8} {'seconds':>8} {'verified nodes':>15} {'seconds':>8}")
+    try:
+        for n in sizes:
+            problems = [random_blocks_problem(n, seed) for seed in range(n_problems)]
+            row = []
+            for verify in (False, True):
+                gtpyhop.verify_goals = verify
+                nodes = elapsed = 0
+                for (state, goal) in problems:
+                    (result, t) = _time_find_plan(state, [goal], engine='iterative',
+                                                  trail=True, return_result=True)
+                    nodes += result.nodes
+                    elapsed += t
+                row += [nodes, elapsed]
+            print(f"{n:>8} {row[0]:>8} {row[1]:>8.3f} {row[2]:>15} {row[3]:>8.3f}")
+    finally:
+        gtpyhop.verify_goals = old_verify_goals
+
+
+def search_statistics(sizes=(50, 100, 200), n_problems=5, repeats=3):
+    """
+    Solve n_problems random n-block problems in the blocks_goal_splitting
+    domain without and with stats, and print some of the counts. The
+    counts cost a comparison with None when they are turned off, and a few
+    additions per node when they are on. Each time is the best of 'repeats'
+    runs.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    print("\nsearch_statistics (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'nodes':>8} {'methods':>8} {'backtracks':>11} {'max depth':>10} " + \
+          f"{'no stats s':>11} {'stats s':>8}")
+    for n in sizes:
+        problems = [random_blocks_problem(n, seed) for seed in range(n_problems)]
+        times = []
+        for use_stats in (False, True):
+            best = float('inf')
+            for i in range(repeats):
+                stats = gtpyhop.SearchStats() if use_stats else None
+                elapsed = 0
+                for (state, goal) in problems:
+                    (plan, t) = _time_find_plan(state, [goal], engine='iterative',
+                                                trail=True, stats=stats)
+                    elapsed += t
+                best = min(best, elapsed)
+            times.append(best)
+        method_calls = sum(stats.method_calls.values())
+        print(f"{n:>8} {stats.nodes:>8} {method_calls:>8} {stats.backtracks:>11} " + \
+              f"{stats.max_depth:>10} {times[0]:>11.3f} {times[1]:>8.3f}")
+
+
+def search_tracing(sizes=(50, 100, 200), n_problems=5, repeats=3, max_spans=1000):
+    """
+    Solve n_problems random n-block problems in the blocks_goal_splitting
+    domain without a tracer, and with SearchTracers in the 'collapsed' and
+    'chrome' formats, and print how many spans and different stacks they
+    recorded. A collapsed tracer adds up its spans' times as they end,
+    whereas a chrome tracer also keeps each span, up to its max_spans: the
+    last columns are for a chrome tracer whose max_spans is 'max_spans',
+    and the 'kept' columns give the number of spans that each chrome tracer
+    kept for t.save(). Each time is the best of 'repeats' runs.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    print("\nsearch_tracing (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'spans':>8} {'stacks':>8} {'no tracer s':>12} " + \
+          f"{'collapsed s':>12} {'chrome s':>9} {'kept':>8} " + \
+          f"{f'max {max_spans} s':>12} {'kept':>8}")
+    for n in sizes:
+        problems = [random_blocks_problem(n, seed) for seed in range(n_problems)]
+        times = []
+        kept = []
+        for (format, limit) in ((None, None), ('collapsed', None),
+                                ('chrome', 100000), ('chrome', max_spans)):
+            best = float('inf')
+            for i in range(repeats):
+                tracer = gtpyhop.SearchTracer(format=format, max_spans=limit) \
+                         if format else None
+                elapsed = 0
+                for (state, goal) in problems:
+                    (plan, t) = _time_find_plan(state, [goal], engine='iterative',
+                                                trail=True, tracer=tracer)
+                    elapsed += t
+                best = min(best, elapsed)
+            times.append(best)
+            if format == 'chrome':
+                kept.append(len(tracer._spans))
+        print(f"{n:>8} {tracer.spans:>8} {len(tracer._stacks):>8} {times[0]:>12.3f} " + \
+              f"{times[1]:>12.3f} {times[2]:>9.3f} {kept[0]:>8} {times[3]:>12.3f} " + \
+              f"{kept[1]:>8}")
+
+
+def goal_ordering(sizes=(10, 20, 40, 80), n_problems=5):
+    """
+    Solve n_problems random n-block problems in the blocks_goal_splitting
+    domain, whose multigoals are split by m_split_multigoal, with
+    split_multigoal_order = None and with order_by_dependencies. The goals in
+    each multigoal are shuffled, so that the default order often builds a
+    tower from the top down and has to take it apart again.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    old_order = gtpyhop.split_multigoal_order
+    rng = random.Random(0)
+    print("\ngoal_ordering (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'actions':>8} {'seconds':>8} {'ordered actions':>16} {'seconds':>8}")
+    try:
+        for n in sizes:
+            problems = []
+            for seed in range(n_problems):
+                (state, goal) = random_blocks_problem(n, seed)
+                goals = list(goal.pos.items())
+                rng.shuffle(goals)
+                goal.pos = dict(goals)
+                problems.append((state, goal))
+            row = []
+            for order in (None, gtpyhop.order_by_dependencies):
+                gtpyhop.split_multigoal_order = order
+                actions = elapsed = 0
+                for (state, goal) in problems:
+                    (plan, t) = _time_find_plan(state, [goal], engine='iterative',
+                                                trail=True)
+                    actions += len(plan)
+                    elapsed += t
+                row += [actions, elapsed]
+            print(f"{n:>8} {row[0]:>8} {row[1]:>8.3f} {row[2]:>16} {row[3]:>8.3f}")
+    finally:
+        gtpyhop.split_multigoal_order = old_order
+
+
+def plan_caching(sizes=(50, 100, 200), n_problems=10, repeats=5):
+    """
+    Solve n_problems random n-block problems 'repeats' times each, in a
+    random order, as a program that replans from states it has seen before
+    would, without and with a PlanCache. Every lookup after the first one
+    for each problem is a hit, but computing a key costs time proportional
+    to the size of the state.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    rng = random.Random(0)
+    print("\nplan_caching (engine = 'iterative')")
+    print(f"{'n':>8} {'calls':>8} {'uncached s':>11} {'cached s':>9} {'hit rate':>9}")
+    for n in sizes:
+        problems = [random_blocks_problem(n, seed) for seed in range(n_problems)]
+        calls = problems * repeats
+        rng.shuffle(calls)
+        cache = gtpyhop.PlanCache()
+        times = []
+        for plan_cache in (None, cache):
+            elapsed = 0
+            for (state, goal) in calls:
+                (plan, t) = _time_find_plan(state, [goal], engine='iterative',
+                                            plan_cache=plan_cache)
+                elapsed += t
+            times.append(elapsed)
+        print(f"{n:>8} {len(calls):>8} {times[0]:>11.3f} {times[1]:>9.3f} " + \
+              f"{cache.hit_rate():>9.2f}")
+
+
+def tree_recording(sizes=(100, 200, 400), repeats=3):
+    """
+    Solve a random n-block problem 'repeats' times with the iterative engine
+    and the trail, without and with return_tree=True. The difference is the
+    cost of recording the refinements during the search and building the
+    DecompositionTree afterward.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    print("\ntree_recording (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'actions':>8} {'plain s':>9} {'tree s':>9}")
+    for n in sizes:
+        (state, goal) = random_blocks_problem(n)
+        times = []
+        for return_tree in (False, True):
+            elapsed = 0
+            for i in range(repeats):
+                (result, t) = _time_find_plan(state, [goal], engine='iterative',
+                                              trail=True, return_tree=return_tree)
+                elapsed += t
+            times.append(elapsed)
+        print(f"{n:>8} {len(result.plan):>8} {times[0]:>9.3f} {times[1]:>9.3f}")
+
+
+def plan_repair(sizes=(50, 100, 200), n_failures=10):
+    """
+    For a random n-block problem, execute the plan up to one of its 'stack'
+    actions and make the action fail by dropping the block on the table.
+    Then find a new plan with repair_plan, and by planning for the goal
+    again from the same state. Do this for n_failures of the 'stack'
+    actions, spread over the plan. Both searches use the trail, so that
+    their times aren't dominated by copying states.
+    """
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    actions = blocks_hgn.the_domain._action_dict
+    print("\nplan_repair (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'failures':>9} {'replan s':>9} {'repair s':>9}")
+    old_verbose = gtpyhop.verbose
+    gtpyhop.verbose = 0
+    try:
+        for n in sizes:
+            (state, goal) = random_blocks_problem(n)
+            tree = gtpyhop.find_plan(state, [goal], engine='iterative',
+                                     return_tree=True)
+            steps = [i for (i, a) in enumerate(tree.plan) if a[0] == 'stack']
+            steps = steps[::max(1, len(steps) // n_failures)][:n_failures]
+            replan_time = repair_time = 0
+            for step in steps:
+                current = state
+                for action in tree.plan[:step]:
+                    current = actions[action[0]](current.copy(), *action[1:])
+                current = current.copy()
+                block = tree.plan[step][1]
+                current.pos[block] = 'table'
+                current.clear[block] = True
+                current.holding['hand'] = False
+                (plan, t) = _time_find_plan(current, [goal], engine='iterative',
+                                            trail=True)
+                replan_time += t
+                start = time.perf_counter()
+                gtpyhop.repair_plan(tree, current, step, trail=True)
+                repair_time += time.perf_counter() - start
+            print(f"{n:>8} {len(steps):>9} {replan_time:>9.3f} {repair_time:>9.3f}")
+    finally:
+        gtpyhop.verbose = old_verbose
+
+
+def _make_dispatch_domain():
+    """
+    Create a small domain for dispatch_rate, with the action ('bump',), the
+    task ('step',), whose method returns [('bump',)], and unigoal methods for
+    the state variable 'flag'. Restore the previous current domain afterward.
+    """
+    old_domain = gtpyhop.current_domain
+    domain = gtpyhop.Domain('dispatch_rate')
+    # make the subtasks once, so that the methods cost the same
+    step_subtasks = [('bump',)]
+
+    def bump(state):
+        return state
+
+    def m_step(state):
+        return step_subtasks
+
+    def m_flag(state, arg, val):
+        return []
+
+    gtpyhop.declare_actions(bump)
+    gtpyhop.declare_task_methods('step', m_step)
+    gtpyhop.declare_unigoal_methods('flag', m_flag)
+    gtpyhop.current_domain = old_domain
+    return domain
+
+
+def _classify_by_probes(domain, item):
+    """
+    Classify a todo_list item the way the planner did before domains had
+    dispatch tables: by the name of its type, and then by looking up its
+    first element in the action, task-method and unigoal-method dictionaries
+    in turn. Return the same pair as domain._classify.
+    """
+    ttype = gtpyhop.get_type(item)
+    if ttype in {'Multigoal'}:
+        return ('multigoal', domain._multigoal_method_list)
+    elif ttype in {'list','tuple'}:
+        if item[0] in domain._action_dict:
+            return ('action', domain._action_dict[item[0]])
+        elif item[0] in domain._task_method_dict:
+            return ('task', domain._task_method_dict[item[0]])
+        elif item[0] in domain._unigoal_method_dict:
+            return ('unigoal', domain._unigoal_method_dict[item[0]])
+    return None
+
+
+def dispatch_rate(sizes=(100000, 200000, 400000), repeats=3):
+    """
+    Classify n todo_list items, a third each of actions, tasks and unigoals,
+    in three ways, and print how many items per second each way handles:
+      - 'probes' is the way the planner did it before domains had dispatch
+        tables (see _classify_by_probes);
+      - 'classify' is Domain._classify, which seek_plan uses;
+      - 'lookup' is the dictionary lookup that _SearchEngine.run inlines
+        for plain tuples.
+    All three get the same answers. Each time is the best of 'repeats' runs.
+    """
+    domain = _make_dispatch_domain()
+    print("\ndispatch_rate")
+    print(f"{'n':>8} {'probes items/s':>15} {'classify items/s':>17} {'lookup items/s':>15}")
+    for n in sizes:
+        items = [('bump',), ('step',), ('flag', 'x', True)] * (n // 3)
+        dispatch = domain._get_dispatch()
+        assert [_classify_by_probes(domain, item) for item in items[:3]] == \
+               [domain._classify(item) for item in items[:3]] == \
+               [dispatch.get(item[0]) for item in items[:3]]
+        times = [float('inf')] * 3
+        for i in range(repeats):
+            start = time.perf_counter()
+            for item in items:
+                _classify_by_probes(domain, item)
+            times[0] = min(times[0], time.perf_counter() - start)
+            start = time.perf_counter()
+            for item in items:
+                domain._classify(item)
+            times[1] = min(times[1], time.perf_counter() - start)
+            start = time.perf_counter()
+            for item in items:
+                item_type = type(item)
+                if item_type is tuple or item_type is list:
+                    dispatch.get(item[0])
+            times[2] = min(times[2], time.perf_counter() - start)
+        (probes, classify, lookup) = [len(items)/t for t in times]
+        print(f"{len(items):>8} {probes:>15.0f} {classify:>17.0f} {lookup:>15.0f}")
+
+
+def event_reporting(sizes=(1000, 4000, 16000), repeats=5):
+    """
+    Plan for a todo_list of n unigoals that are already achieved, in an
+    n-block state with every block on the table, with verbose = 0 and with
+    verbose = 1. With verbose = 1, find_plan reports an event that includes
+    the whole todo_list. The second column has no event sinks, so the
+    event's message is never formatted; the third has a sink that formats
+    it but doesn't print it. Each time is the best of 'repeats' runs.
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    old_verbose = gtpyhop.verbose
+    old_sinks = gtpyhop.event_sinks
+    print("\nevent_reporting (engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'verbose=0 s':>12} {'no sinks s':>11} {'formatted s':>12}")
+    try:
+        for n in sizes:
+            blocks = [f'b{i}' for i in range(n)]
+            state = gtpyhop.State(f'{n}_blocks_on_table')
+            state.pos = {b:'table' for b in blocks}
+            state.clear = {b:True for b in blocks}
+            state.holding = {'hand':False}
+            todo_list = [('pos', b, 'table') for b in blocks]
+            times = []
+            for (verbose, sinks) in [(0, []), (1, []), (1, [lambda event: event.message])]:
+                gtpyhop.event_sinks = sinks
+                best = float('inf')
+                for i in range(repeats):
+                    gtpyhop.verbose = verbose
+                    start = time.perf_counter()
+                    gtpyhop.find_plan(state, todo_list, engine='iterative', trail=True)
+                    best = min(best, time.perf_counter() - start)
+                times.append(best)
+            print(f"{n:>8} {times[0]:>12.4f} {times[1]:>11.4f} {times[2]:>12.4f}")
+    finally:
+        gtpyhop.verbose = old_verbose
+        gtpyhop.event_sinks = old_sinks
+
+
+def event_bus(sizes=(50, 100, 200, 400), repeats=3):
+    """
+    Solve a random n-block problem with verbose = 3, with a subscriber that
+    formats every event's message: first as an event sink of its own, then
+    through an EventBus that delivers batches in the planner's thread, and
+    then through one that delivers them in a background thread. Both buses
+    have the default capacity. The times are those of find_plan alone, so
+    the threaded bus's deliveries after find_plan returns aren't counted:
+    its speedup comes from putting off the subscriber's work, not from
+    doing less of it. Each time is the best of 'repeats' runs, and the
+    'dropped' columns give the most events that each bus dropped in a run
+    (which should be 0).
+    """
+    gtpyhop.current_domain = blocks_goal_splitting.the_domain
+    old_verbose = gtpyhop.verbose
+    old_sinks = gtpyhop.event_sinks
+    messages = []
+    def format_messages(events):
+        messages.extend(event.message for event in events if event.kind != 'events_dropped')
+    print("\nevent_bus (verbose = 3, engine = 'iterative', trail = True)")
+    print(f"{'n':>8} {'events':>8} {'sink s':>8} {'bus s':>8} {'dropped':>8} " + \
+          f"{'threaded s':>11} {'dropped':>8}")
+    try:
+        for n in sizes:
+            (state, goal) = random_blocks_problem(n)
+            times = []
+            dropped = []
+            for mode in ('sink', 'bus', 'threaded'):
+                best = float('inf')
+                most_dropped = 0
+                for i in range(repeats):
+                    messages.clear()
+                    bus = None
+                    if mode == 'sink':
+                        gtpyhop.event_sinks = [lambda event: format_messages([event])]
+                    else:
+                        bus = gtpyhop.EventBus(threaded=(mode == 'threaded'))
+                        bus.subscribe(format_messages)
+                        gtpyhop.event_sinks = [bus]
+                    gtpyhop.verbose = 3
+                    start = time.perf_counter()
+                    gtpyhop.find_plan(state, [goal], engine='iterative', trail=True)
+                    best = min(best, time.perf_counter() - start)
+                    gtpyhop.verbose = old_verbose
+                    if bus != None:
+                        bus.close()
+                        most_dropped = max(most_dropped, bus.dropped)
+                    if mode == 'sink':
+                        events = len(messages)
+                times.append(best)
+                dropped.append(most_dropped)
+            print(f"{n:>8} {events:>8} {times[0]:>8.3f} {times[1]:>8.3f} {dropped[1]:>8} " + \
+                  f"{times[2]:>11.3f} {dropped[2]:>8}")
+    finally:
+        gtpyhop.verbose = old_verbose
+        gtpyhop.event_sinks = old_sinks
+
+
+def _make_guard_domain(name, n_methods, guarded, calls):
+    """
+    Create a domain in which the task ('do', k) has n_methods methods, and
+    the i'th one applies only if k == i. If guarded is True, each method
+    has a Guard that says so. Each method call adds 1 to calls[0]. Restore
+    the previous current domain afterward.
+    """
+    old_domain = gtpyhop.current_domain
+    domain = gtpyhop.Domain(name)
+
+    def bump(state):
+        return state
+
+    def make_method(i):
+        def method(state, k):
+            calls[0] += 1
+            return [('bump',)] if k == i else False
+        method.__name__ = f'm_do_{i}'
+        return method
+
+    methods = [make_method(i) for i in range(n_methods)]
+    guards = {m: gtpyhop.Guard(args=(i,)) for (i, m) in enumerate(methods)} \
+             if guarded else None
+    gtpyhop.declare_actions(bump)
+    gtpyhop.declare_task_methods('do', *methods, guards=guards)
+    gtpyhop.current_domain = old_domain
+    return domain
+
+
+def method_guards(method_counts=(5, 10, 20, 40), n=5000):
+    """
+    Plan for n tasks ('do', k) with randomly chosen values of k, in domains
+    where 'do' has m methods of which only one applies to each k (see
+    _make_guard_domain), with and without guards. Without guards, the
+    planner calls about m/2 methods per task; with them, it calls one.
+    """
+    old_domain = gtpyhop.current_domain
+    rng = random.Random(0)
+    state = gtpyhop.State('empty')
+    print("\nmethod_guards (trail = True)")
+    print(f"{'methods':>8} {'calls':>8} {'seconds':>8} {'guarded calls':>14} {'seconds':>8}")
+    try:
+        for m in method_counts:
+            todo_list = [('do', rng.randrange(m)) for i in range(n)]
+            row = []
+            for guarded in (False, True):
+                calls = [0]
+                gtpyhop.current_domain = _make_guard_domain(f'guards_{m}_{guarded}',
+                                                            m, guarded, calls)
+                (plan, elapsed) = _time_find_plan(state, todo_list, trail=True)
+                row += [calls[0], elapsed]
+            print(f"{m:>8} {row[0]:>8} {row[1]:>8.3f} {row[2]:>14} {row[3]:>8.3f}")
+    finally:
+        gtpyhop.current_domain = old_domain
+
+
+def _make_detour_domain(depth):
+    """
+    Create a domain in which the task ('step',) has two methods: m_detour,
+    which is always applicable but leads to a chain of 'depth' subtasks that
+    ends with an action that fails, and m_direct, which returns an action
+    that succeeds. Restore the previous current domain afterward.
+    """
+    old_domain = gtpyhop.current_domain
+    domain = gtpyhop.Domain('method_ordering')
+
+    def bump(state):
+        return state
+
+    def fail(state):
+        return False
+
+    def m_detour(state):
+        return [('dead_end', depth)]
+
+    def m_direct(state):
+        return [('bump',)]
+
+    def m_dead_end(state, k):
+        return [('dead_end', k-1)] if k > 0 else [('fail',)]
+
+    gtpyhop.declare_actions(bump, fail)
+    gtpyhop.declare_task_methods('step', m_detour, m_direct)
+    gtpyhop.declare_task_methods('dead_end', m_dead_end)
+    gtpyhop.current_domain = old_domain
+    return domain
+
+
+def method_ordering(depths=(5, 20, 80), n=500, calls=3):
+    """
+    Plan 'calls' times for n tasks ('step',) in the domain made by
+    _make_detour_domain, in which the first method of 'step' always leads
+    to a dead end. The times are for the last call, with a stable
+    MethodStatistics, which keeps the declared order, and with an adaptive
+    one, which has learned in the earlier calls to try m_direct first.
+    """
+    old_domain = gtpyhop.current_domain
+    state = gtpyhop.State('empty')
+    todo_list = [('step',)] * n
+    print("\nmethod_ordering (trail = True)")
+    print(f"{'depth':>8} {'stable s':>9} {'adaptive s':>11}")
+    try:
+        for depth in depths:
+            gtpyhop.current_domain = _make_detour_domain(depth)
+            row = []
+            for stable in (True, False):
+                statistics = gtpyhop.MethodStatistics(stable=stable)
+                for i in range(calls):
+                    (plan, elapsed) = _time_find_plan(state, todo_list, trail=True,
+                                                      method_statistics=statistics)
+                row.append(elapsed)
+            print(f"{depth:>8} {row[0]:>9.3f} {row[1]:>11.3f}")
+    finally:
+        gtpyhop.current_domain = old_domain
+
+
+# The actions and methods of the digits domain are defined at the top level
+# of this file, rather than inside _make_digits_domain, so that they can be
+# pickled, which the worker processes need where the 'fork' start method
+# isn't available (e.g., on macOS and Windows).
+
+
+def digit(state, d):
+    state.sum['digits'] += d
+    return state
+
+
+def check(state, total):
+    if state.sum['digits'] == total:
+        return state
+
+
+def m_done(state, n, total):
+    if n == 0:
+        return [('check', total)]
+
+
+class _DigitMethod():
+    """
+    _DigitMethod(d) is the method m_digit_d of the digits domain, which
+    chooses the digit d if there are any digits left to choose.
+    """
+
+    def __init__(self, d):
+        self.d = d
+        self.__name__ = f'm_digit_{d}'
+
+    def __repr__(self):
+        return f'_DigitMethod({self.d})'
+
+    def __call__(self, state, n, total):
+        if n > 0:
+            return [('digit', self.d), ('digits', n-1, total)]
+
+
+def _make_digits_domain(base):
+    """
+    Create a domain in which the task ('digits', n, total) means "choose n
+    more digits, each less than base, that add up to total". The methods
+    m_digit_0, m_digit_1, ... try the digits in increasing order, and the
+    action ('check', total) fails unless the digits add up to the total,
+    so the planner has to search a tree with base**n leaves. Restore the
+    previous current domain afterward.
+    """
+    old_domain = gtpyhop.current_domain
+    domain = gtpyhop.Domain(f'digits_{base}')
+    gtpyhop.declare_actions(digit, check)
+    gtpyhop.declare_task_methods('digits', m_done,
+                                 *[_DigitMethod(d) for d in range(base)])
+    gtpyhop.current_domain = old_domain
+    return domain
+
+
+def parallel_search(workers=(1, 2, 4), base=6, n=7):
+    """
+    Plan for ('digits', n, total) in the domain of _make_digits_domain, with
+    a total that makes the planner search most of the tree before it finds
+    a plan, first with one process and then with find_plan's workers option.
+    The plans are the same. The workers can only make the search faster if
+    the machine has more than one core (the number of cores is printed in
+    the heading); with one core, the table shows only what the workers cost.
+    """
+    old_domain = gtpyhop.current_domain
+    gtpyhop.current_domain = _make_digits_domain(base)
+    state = gtpyhop.State('digits', sum={'digits':0})
+    todo_list = [('digits', n, (base-1)*n - 1)]
+    print(f"\nparallel_search (trail = True, {base}**{n} leaves, " + \
+          f"{os.cpu_count()} cores)")
+    print(f"{'workers':>8} {'actions':>8} {'seconds':>8} {'same plan':>10}")
+    try:
+        (plan, elapsed) = _time_find_plan(state, todo_list, trail=True)
+        print(f"{'-':>8} {len(plan):>8} {elapsed:>8.3f} {'-':>10}")
+        for k in workers:
+            (parallel_plan, elapsed) = _time_find_plan(state, todo_list, trail=True,
+                                                       workers=k)
+            print(f"{k:>8} {len(parallel_plan):>8} {elapsed:>8.3f} " + \
+                  f"{str(parallel_plan == plan):>10}")
+    finally:
+        gtpyhop.current_domain = old_domain
+
+
+def portfolio_search(portfolios=(None, 2, 4), base=5, n=7, n_problems=10):
+    """
+    Plan for ('digits', n, total) in the domain of _make_digits_domain for
+    n_problems random totals, with and without find_plan's portfolio option,
+    and print the mean and the largest time per problem. For totals that
+    need large digits, the declared method order (smallest digit first)
+    searches most of the tree, and a shuffled order may not. With fewer
+    cores than searches, the searches slow each other down.
+    """
+    old_domain = gtpyhop.current_domain
+    gtpyhop.current_domain = _make_digits_domain(base)
+    state = gtpyhop.State('digits', sum={'digits':0})
+    rng = random.Random(0)
+    totals = [rng.randrange((base-1)*n) for i in range(n_problems)]
+    print(f"\nportfolio_search (trail = True, {n_problems} problems)")
+    print(f"{'portfolio':>10} {'mean s':>8} {'max s':>8}")
+    try:
+        for k in portfolios:
+            times = []
+            for total in totals:
+                (plan, elapsed) = _time_find_plan(state, [('digits', n, total)],
+                                                  trail=True, portfolio=k)
+                times.append(elapsed)
+            print(f"{str(k):>10} {sum(times)/len(times):>8.3f} {max(times):>8.3f}")
+    finally:
+        gtpyhop.current_domain = old_domain
+
+
+def batch_planning(workers=(None, 1, 2, 4), n_problems=200, n_blocks=40):
+    """
+    Solve a batch of random n_blocks-block problems with find_plans, first
+    in this process (workers = None) and then in pools of worker processes,
+    and print the number of problems solved per second, the total of the
+    search times that find_plan reported for the problems, and whether each
+    pool's results are the same as those of the in-process run.
+
+    The heading also gives the time per problem that it takes to pickle and
+    unpickle a problem and its PlanResult, which each problem that is solved
+    in a worker costs the parent process on top of the search. find_plans
+    pays off when that is small compared with the search time per problem,
+    and when there are no more workers than cores: with more, the workers
+    take turns on the cores, so each search takes longer (the 'search s'
+    column grows) and the throughput doesn't improve. The results are
+    compared with those of the first entry in 'workers', which should be
+    None.
+    """
+    old_domain = gtpyhop.current_domain
+    old_verbose = gtpyhop.verbose
+    gtpyhop.current_domain = blocks_hgn.the_domain
+    gtpyhop.verbose = 0
+    problems = []
+    for seed in range(n_problems):
+        (state, goal) = random_blocks_problem(n_blocks, seed)
+        problems.append((state, [goal]))
+    try:
+        in_process = None
+        rows = []
+        for k in workers:
+            start = time.perf_counter()
+            results = list(gtpyhop.find_plans(problems, workers=k))
+            elapsed = time.perf_counter() - start
+            search_time = sum(r.elapsed for (i, r) in results)
+            if in_process == None:
+                in_process = results
+            same = [(i, r.plan, r.status, r.nodes) for (i, r) in results] == \
+                   [(i, r.plan, r.status, r.nodes) for (i, r) in in_process]
+            rows.append((k, elapsed, search_time, same))
+        start = time.perf_counter()
+        for ((state, todo_list), (i, result)) in zip(problems, in_process):
+            pickle.loads(pickle.dumps((state, todo_list)))
+            pickle.loads(pickle.dumps(result))
+        transfer = (time.perf_counter() - start) / n_problems
+        search = sum(r.elapsed for (i, r) in in_process) / n_problems
+        print(f"\nbatch_planning ({n_problems} problems with {n_blocks} blocks, " + \
+              f"{os.cpu_count()} cores; per problem: {1e3*search:.2f} ms search, " + \
+              f"{1e3*transfer:.2f} ms pickling)")
+        print(f"{'workers':>8} {'seconds':>8} {'problems/s':>11} {'search s':>9} " + \
+              f"{'same results':>13}")
+        for (k, elapsed, search_time, same) in rows:
+            print(f"{str(k):>8} {elapsed:>8.3f} {n_problems/elapsed:>11.1f} " + \
+                  f"{search_time:>9.3f} {str(same):>13}")
+    finally:
+        gtpyhop.current_domain = old_domain
+        gtpyhop.verbose = old_verbose
+
+
+def main():
+    long_plans()
+    logistics_scaling()
+    state_copying()
+    multigoal_checks()
+    goal_verification()
+    search_statistics()
+    search_tracing()
+    goal_ordering()
+    plan_caching()
+    tree_recording()
+    plan_repair()
+    dispatch_rate()
+    event_reporting()
+    event_bus()
+    method_guards()
+    method_ordering()
+    parallel_search()
+    portfolio_search()
+    batch_planning()
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,11 @@ of the modules in the Examples directory.
 # from IPython import embed
 # from IPython.terminal.debugger import set_trace
 
-import copy, sys, pprint, re
+import collections, copy, hashlib, heapq, json, os, sys, pprint, random, re, string
+import threading, time, types
+import concurrent.futures, multiprocessing
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 ################################################################################
 # How much information to print while the program is running
@@ -38,6 +42,27 @@ much debugging information GTPyhop will print:
 # Sequence number to use when making copies of states.
 _next_state_number = 0
 
+copy_on_write = False
+"""
+copy_on_write is a global value whose initial value is False. It determines
+how State.copy copies a state:
+ - copy_on_write = False: the copy is made with copy.deepcopy, so it shares
+   nothing with the original state.
+ - copy_on_write = True: the copy shares each state-variable dictionary with
+   the original state, and a state's dictionary is copied only when one of
+   its entries is first written, e.g., by an action doing s.pos[x] = 'hand'.
+   Applying an action then costs time proportional to the size of the state
+   variables that it writes, rather than the size of the whole state.
+   The copies are shallow: the values in the dictionaries, and any state
+   variables that aren't dictionaries (e.g., sets of objects), are shared
+   rather than copied, so actions must assign new values to them rather
+   than modify them in place. Copying also wraps the original state's
+   dictionaries in _SharedVar objects, which behave like dictionaries.
+   The planning functions (find_plan, run_lazy_lookahead, etc.) don't copy
+   the caller's state this way: they make their copies from a private copy
+   of it, so the caller's state is left as it was.
+"""
+
 class State():
     """
     s = State(state_name, **kwargs) creates an object that contains the
@@ -60,13 +85,26 @@ class State():
            s.loc['c'] = 'room3'
         Third:
            s = State('foo',loc={'b':'room2', 'c':'room3'})
+
+    Two states are equal (==) if they have the same state variables with
+    the same values, regardless of their names. A state can be used as a
+    dictionary key, or in a set, as long as it isn't modified afterward;
+    its hash value is s.fingerprint().
     """
+
+    # _fingerprint, _trail and _goal_status are kept out of vars(s), so that
+    # they aren't mistaken for state variables. See the sections on
+    # fingerprints and on tracking multigoals below.
+    __slots__ = ('__dict__', '__weakref__', '_fingerprint', '_trail', '_goal_status')
     
     def __init__(self, state_name, **kwargs):
         """
         state_name is the name to use for the state. The keyword
         args are the names and initial values of state variables.
         """
+        self._fingerprint = None
+        self._trail = None
+        self._goal_status = None
         self.__name__ = state_name
         vars(self).update(kwargs)
             
@@ -76,13 +114,59 @@ class State():
     def __repr__(self):
         return _make_repr(self, 'State')
 
+    def __setattr__(self, varname, val):
+        _set_var(self, varname, val)
+
+    def __delattr__(self, varname):
+        _delete_var(self, varname)
+
+    def __eq__(self, other):
+        if not isinstance(other, State):
+            return NotImplemented
+        return _same_vars(self, other)
+
+    def __hash__(self):
+        return self.fingerprint()
+
+    def __getstate__(self):
+        return vars(self)
+
+    def __setstate__(self, state_vars):
+        self._fingerprint = None
+        self._trail = None
+        self._goal_status = None
+        vars(self).update(state_vars)
+
+    def fingerprint(self):
+        """
+        Return an integer fingerprint of the state's state variables and
+        their values, ignoring the state's name. Equal states have equal
+        fingerprints, and unequal states almost always have different ones.
+        The first call takes time proportional to the size of the state.
+        After that, the fingerprint is updated whenever a state variable is
+        written, at a constant cost per write, and copies of the state start
+        out with the same fingerprint. See the section on fingerprints below.
+        """
+        if self._fingerprint == None:
+            _start_watching(self)
+        return self._fingerprint
+
     def copy(self,new_name=None):
         """
         Make a copy of the state. For its name, use new_name if it is given.
         Otherwise use the old name, with a suffix '_copy#' where # is an integer.
         """
         global _next_state_number
-        the_copy = copy.deepcopy(self)
+        if copy_on_write:
+            the_copy = self._shared_copy()
+        else:
+            the_copy = copy.deepcopy(self)
+            the_copy._fingerprint = self._fingerprint
+        if self._goal_status != None:
+            _fork_goal_status(self, the_copy)
+        if _is_watched(the_copy):
+            # e.g., if the state had _SharedVars, its deep copy has dicts
+            _watch_dicts(the_copy)
         if new_name:
             the_copy.__name__ = new_name
         else:
@@ -90,6 +174,28 @@ class State():
             _next_state_number += 1
         return the_copy
 
+    def _shared_copy(self):
+        """
+        Make a copy of the state for copy_on_write mode. Each dictionary-valued
+        state variable, in both the state and the copy, becomes a _SharedVar
+        that refers to the same dictionary. Other values are shared as-is.
+        """
+        the_copy = State.__new__(type(self))
+        the_copy._fingerprint = self._fingerprint
+        the_copy._trail = None
+        the_copy._goal_status = None
+        old_vars = vars(self)
+        new_vars = vars(the_copy)
+        for (varname,val) in old_vars.items():
+            if isinstance(val, dict):
+                old_vars[varname] = _SharedVar(self, varname, val)
+                new_vars[varname] = _SharedVar(the_copy, varname, val)
+            elif type(val) is _SharedVar:
+                new_vars[varname] = _SharedVar(the_copy, varname, val._target())
+            else:
+                new_vars[varname] = val
+        return the_copy
+
     def display(self, heading=None):
         """
         Print the state's state-variables and their values.
@@ -102,6 +208,142 @@ class State():
         return [v for v in vars(self) if v != '__name__']
 
 
+class _SharedVar():
+    """
+    In copy_on_write mode, a dictionary-valued state variable that may be
+    shared with other states is a _SharedVar. It behaves like a dictionary:
+    reads go to the shared dictionary, and the first write replaces the
+    state variable with a private copy of the dictionary, which receives
+    that write and all later ones. After that, the _SharedVar forwards
+    everything to whatever value the state variable currently has, so
+    references to it that the caller kept remain correct. If the state is
+    watched (see the section on fingerprints below), the private copy is a
+    _WatchedDict.
+    """
+    __slots__ = ('_state', '_name', '_dict')
+
+    def __init__(self, state, varname, shared_dict):
+        self._state = state
+        self._name = varname
+        self._dict = shared_dict
+
+    def _target(self):
+        """Return the dictionary (or _SharedVar) that reads should go to"""
+        current = vars(self._state)[self._name]
+        return self._dict if current is self else current
+
+    def _writable(self):
+        """Return the dictionary (or _SharedVar) that writes should go to"""
+        state_vars = vars(self._state)
+        current = state_vars[self._name]
+        if current is self:
+            state = self._state
+            if not _is_watched(state):
+                current = copy.copy(self._dict)
+            else:
+                current = _WatchedDict(state, self._name, self._dict)
+            state_vars[self._name] = current
+        return current
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+    def __eq__(self, other):
+        if type(other) is _SharedVar:
+            other = other._target()
+        return self._target() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._target())
+
+    def get(self, key, default=None):
+        return self._target().get(key, default)
+
+    def keys(self):
+        return self._target().keys()
+
+    def values(self):
+        return self._target().values()
+
+    def items(self):
+        return self._target().items()
+
+    def copy(self):
+        return copy.copy(self._target())
+
+    def setdefault(self, key, default=None):
+        if key in self._target():
+            return self._target()[key]
+        return self._writable().setdefault(key, default)
+
+    def pop(self, key, *default):
+        return self._writable().pop(key, *default)
+
+    def popitem(self):
+        return self._writable().popitem()
+
+    def update(self, *args, **kwargs):
+        self._writable().update(*args, **kwargs)
+
+    def clear(self):
+        self._writable().clear()
+
+    def __deepcopy__(self, memo):
+        # deep copies, such as those made by State.copy when copy_on_write is
+        # False, get an ordinary dictionary
+        return copy.deepcopy(self._target(), memo)
+
+    def __reduce__(self):
+        return (copy.copy, (self._target(),))
+
+MutableMapping.register(_SharedVar)
+
+
+def _private_copy(state):
+    """
+    Return a copy of 'state' for a planning function to make its copies from
+    in copy_on_write mode. Its dictionary-valued state variables are new
+    dictionaries with the same entries, so that State.copy wraps them,
+    rather than the caller's dictionaries, in _SharedVars (see
+    State._shared_copy), and the caller's state stays as it was. This costs
+    time proportional to the size of the state, but only once per call.
+    """
+    the_copy = State.__new__(type(state))
+    the_copy._fingerprint = state._fingerprint
+    the_copy._trail = None
+    the_copy._goal_status = None
+    new_vars = vars(the_copy)
+    for (varname,val) in vars(state).items():
+        if isinstance(val, dict):
+            new_vars[varname] = copy.copy(val)
+        elif type(val) is _SharedVar:
+            new_vars[varname] = val.copy()
+        else:
+            new_vars[varname] = val
+    if state._goal_status != None:
+        _fork_goal_status(state, the_copy)
+    if _is_watched(the_copy):
+        _watch_dicts(the_copy)
+    return the_copy
+
+
 # Sequence number to use when making copies of multigoals.
 _next_multigoal_number = 0
 
@@ -126,13 +368,21 @@ class Multigoal():
            g.loc['c'] = 'room3'
         Third:
            g = Multigoal('goal1',loc={'b':'room2', 'c':'room3'})
+
+    Like states, multigoals are equal if they have the same state variables
+    with the same values, and their hash value is g.fingerprint().
     """
 
+    __slots__ = ('__dict__', '__weakref__', '_fingerprint', '_trail', '_goal_status')
+
     def __init__(self, multigoal_name, **kwargs):
         """
         multigoal_name is the name to use for the multigoal. The keyword
         args are the names and desired values of state variables.
         """
+        self._fingerprint = None
+        self._trail = None
+        self._goal_status = None
         self.__name__ = multigoal_name
         vars(self).update(kwargs)
             
@@ -142,6 +392,38 @@ class Multigoal():
     def __repr__(self):
         return _make_repr(self, 'Multigoal')
 
+    def __setattr__(self, varname, val):
+        _set_var(self, varname, val)
+
+    def __delattr__(self, varname):
+        _delete_var(self, varname)
+
+    def __eq__(self, other):
+        if not isinstance(other, Multigoal):
+            return NotImplemented
+        return _same_vars(self, other)
+
+    def __hash__(self):
+        return self.fingerprint()
+
+    def __getstate__(self):
+        return vars(self)
+
+    def __setstate__(self, multigoal_vars):
+        self._fingerprint = None
+        self._trail = None
+        self._goal_status = None
+        vars(self).update(multigoal_vars)
+
+    def fingerprint(self):
+        """
+        Return an integer fingerprint of the multigoal's state variables and
+        their values, ignoring its name, in the same way as State.fingerprint.
+        """
+        if self._fingerprint == None:
+            _start_watching(self)
+        return self._fingerprint
+
     def copy(self,new_name=None):
         """
         Make a copy of the multigoal. For its name, use new_name if it is given.
@@ -149,6 +431,7 @@ class Multigoal():
         """
         global _next_multigoal_number
         the_copy = copy.deepcopy(self)
+        the_copy._fingerprint = self._fingerprint
         if new_name:
             the_copy.__name__ = new_name
         else:
@@ -168,6 +451,53 @@ class Multigoal():
         return [v for v in vars(self) if v != '__name__']
 
 
+################################################################################
+# Typed todo_list items
+
+
+class _TypedItem(tuple):
+    """
+    Base class for Action, Task and Goal. Each is a tuple, and compares,
+    hashes and prints like one, so it can be used wherever a plain tuple
+    can. The difference is that the planner doesn't need to look up the
+    item's name to find out what kind of item it is.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, *args):
+        return tuple.__new__(cls, (name,) + args)
+
+    def __reduce__(self):
+        return (type(self), tuple(self))
+
+
+class Action(_TypedItem):
+    """
+    Action(name, arg1, ..., argn) is the action (name, arg1, ..., argn).
+    A method may return it instead of a plain tuple, to tell the planner
+    that it is an action. 'name' must be the name of a declared action.
+    """
+    __slots__ = ()
+
+
+class Task(_TypedItem):
+    """
+    Task(name, arg1, ..., argn) is the task (name, arg1, ..., argn), where
+    'name' is a task name for which methods have been declared.
+    """
+    __slots__ = ()
+
+
+class Goal(_TypedItem):
+    """
+    Goal(state_var_name, arg, value) is the unigoal (state_var_name, arg,
+    value), where 'state_var_name' is a state-variable name for which
+    unigoal methods have been declared.
+    """
+    __slots__ = ()
+
+
+
 ################################################################################
 # Auxiliary functions for state and multigoal objects.
 
@@ -215,7 +545,7 @@ def _print_object(object, heading=None):
 
         log_event(object_string)
     else: 
-        log_event('{heading} = False')
+        log_event(f'{heading} = False')
 
 
 # print_state and print_multigoal are identical except for their names.
@@ -227,6 +557,265 @@ def get_type(object):
     return type(object).__name__
 
 
+################################################################################
+# Fingerprints, and watching the writes to states and multigoals
+#
+# s.fingerprint() is an integer that depends only on the state variables of s
+# and their values, not on its name. In the manner of Zobrist hashing, it is
+# the exclusive-or of one hash value per binding:
+#   - hash((varname, arg, val)) for each entry varname[arg] = val of a
+#     dictionary-valued state variable;
+#   - hash((varname, val)) for each state variable that isn't a dictionary;
+# where values that can't be hashed, such as lists and sets, are first
+# converted by _freeze. Writing an entry changes the fingerprint by removing
+# the old entry's hash value and adding the new one's, so the fingerprint
+# can be kept up to date at a constant cost per write, rather than being
+# recomputed each time it is needed. Multigoals have fingerprints too.
+#
+# The first call to s.fingerprint() computes the fingerprint from scratch,
+# and makes s "watched": its dictionaries are replaced by _WatchedDicts that
+# report each write to s, and s.__setattr__ reports the replacement of a
+# whole state variable (e.g., s.pos = {...}). Copies of a watched state are
+# watched too, and start out with the original's fingerprint. A state is
+# also watched if it has a trail (see the section on trails below), or if
+# the unsatisfied goals of a multigoal are being tracked in it (see the
+# section on tracking multigoals); its writes are then reported to those too.
+#
+# Changes that are made inside the values of a state variable, or to a state
+# variable that isn't a dictionary (e.g., s.packages.add(x)), can't be
+# detected, so they leave the fingerprint out of date. The same is true for
+# writes that bypass s.__setattr__, e.g., vars(s)['pos'] = {...}, and for
+# writes made through a reference to a dictionary that s no longer uses.
+#
+# Fingerprints are 64-bit hash values, so unequal states occasionally have
+# equal fingerprints. That is harmless for == and for dictionaries of states,
+# which check equality after comparing hash values, but a cache that is keyed
+# by fingerprints alone (such as TranspositionTable) accepts the small chance
+# of a collision. Python randomizes the hash values of strings in each
+# process, so fingerprints shouldn't be saved or compared across processes.
+
+
+# Value that stands for a missing dictionary entry or state variable.
+_NO_VALUE = object()
+
+# Attributes of states and multigoals that aren't state variables.
+_NOT_STATE_VARS = frozenset({'__name__', '_fingerprint', '_trail', '_goal_status'})
+
+
+def _freeze(value):
+    """
+    Return a hashable value that is equal to _freeze(other) whenever 'value'
+    and 'other' have the same contents, e.g., a frozenset for a dictionary.
+    """
+    if isinstance(value, (dict, MutableMapping)):
+        return frozenset((k, _freeze(v)) for (k, v) in value.items())
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    else:
+        return value
+
+
+def _entry_hash(varname, arg, val):
+    """Return the hash value of the binding varname[arg] = val"""
+    if val is _NO_VALUE:
+        return 0
+    try:
+        return hash((varname, arg, val))
+    except TypeError:
+        return hash((varname, arg, _freeze(val)))
+
+
+def _var_hash(varname, val):
+    """Return the exclusive-or of the hash values of state variable varname"""
+    if val is _NO_VALUE:
+        return 0
+    if isinstance(val, (dict, _SharedVar)):
+        result = 0
+        for (arg, argval) in val.items():
+            result ^= _entry_hash(varname, arg, argval)
+        return result
+    return hash((varname, _freeze(val)))
+
+
+class _WatchedDict(dict):
+    """
+    A dictionary-valued state variable of a watched state or multigoal (the
+    owner). It reports each write to the owner, which updates its fingerprint
+    and records the write on its trail.
+    """
+    __slots__ = ('_owner', '_name')
+
+    def __init__(self, owner, varname, contents=()):
+        dict.__init__(self, contents)
+        self._owner = owner
+        self._name = varname
+
+    def _changed(self, arg, old, new):
+        """Report to the owner that self[arg] changed from old to new"""
+        owner = self._owner
+        if owner._trail != None:
+            owner._trail.append((self, arg, old))
+        if owner._fingerprint != None:
+            owner._fingerprint ^= _entry_hash(self._name, arg, old) ^ \
+                                  _entry_hash(self._name, arg, new)
+        if owner._goal_status != None:
+            _note_goal_write(owner, self._name, arg, old, new)
+
+    def _restore(self, arg, old):
+        """Undo a change that was recorded on a trail, without recording it"""
+        new = self.get(arg, _NO_VALUE)
+        if old is _NO_VALUE:
+            dict.__delitem__(self, arg)
+        else:
+            dict.__setitem__(self, arg, old)
+        owner = self._owner
+        if owner._fingerprint != None:
+            owner._fingerprint ^= _entry_hash(self._name, arg, new) ^ \
+                                  _entry_hash(self._name, arg, old)
+        if owner._goal_status != None:
+            _note_goal_write(owner, self._name, arg, new, old)
+
+    def __setitem__(self, arg, val):
+        old = self.get(arg, _NO_VALUE)
+        dict.__setitem__(self, arg, val)
+        self._changed(arg, old, val)
+
+    def __delitem__(self, arg):
+        old = self[arg]
+        dict.__delitem__(self, arg)
+        self._changed(arg, old, _NO_VALUE)
+
+    def setdefault(self, arg, default=None):
+        if arg not in self:
+            self[arg] = default
+        return self[arg]
+
+    def pop(self, arg, *default):
+        if arg in self or not default:
+            val = self[arg]
+            del self[arg]
+            return val
+        return default[0]
+
+    def popitem(self):
+        (arg, val) = dict.popitem(self)
+        self._changed(arg, val, _NO_VALUE)
+        return (arg, val)
+
+    def update(self, *args, **kwargs):
+        for (arg, val) in dict(*args, **kwargs).items():
+            self[arg] = val
+
+    def clear(self):
+        for arg in list(self):
+            del self[arg]
+
+    def __deepcopy__(self, memo):
+        # When a watched state is deep-copied, the copy of the dictionary
+        # belongs to the copy of the state. Otherwise it's an ordinary one.
+        contents = copy.deepcopy(dict(self), memo)
+        owner = memo.get(id(self._owner))
+        if owner == None:
+            return contents
+        return _WatchedDict(owner, self._name, contents)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def _is_watched(obj):
+    """Return True if obj (a state or multigoal) reports its writes"""
+    return obj._fingerprint != None or obj._trail != None or obj._goal_status != None
+
+
+def _start_watching(obj):
+    """
+    Compute the fingerprint of obj, which may be either a state or a
+    multigoal, and make obj watched.
+    """
+    fingerprint = 0
+    for (varname,val) in vars(obj).items():
+        if varname != '__name__':
+            fingerprint ^= _var_hash(varname, val)
+    _watch_dicts(obj)
+    obj._fingerprint = fingerprint
+
+
+def _watch_dicts(obj):
+    """Replace the ordinary dictionaries in obj with _WatchedDicts"""
+    the_vars = vars(obj)
+    for (varname,val) in the_vars.items():
+        if isinstance(val, dict) and type(val) is not _WatchedDict:
+            the_vars[varname] = _WatchedDict(obj, varname, val)
+
+
+def _set_var(obj, varname, val):
+    """
+    Do obj.varname = val, where obj is a state or multigoal. If obj is
+    watched, report the change, and if val is a dictionary, use a
+    _WatchedDict copy of it instead.
+    """
+    if varname in _NOT_STATE_VARS or not _is_watched(obj):
+        object.__setattr__(obj, varname, val)
+        return
+    if isinstance(val, dict) and not (type(val) is _WatchedDict and \
+            val._owner is obj and val._name == varname):
+        val = _WatchedDict(obj, varname, val)
+    _replace_var(obj, varname, val)
+
+
+def _delete_var(obj, varname):
+    """Do del obj.varname, where obj is a state or multigoal"""
+    if varname not in vars(obj) or varname in _NOT_STATE_VARS:
+        raise AttributeError(varname)
+    if not _is_watched(obj):
+        del vars(obj)[varname]
+    else:
+        _replace_var(obj, varname, _NO_VALUE)
+
+
+def _replace_var(obj, varname, val, record=True):
+    """
+    Give the state variable varname of a watched state or multigoal obj the
+    value val (or remove it, if val is _NO_VALUE), and update obj's
+    fingerprint. If record is True and obj has a trail, record the change.
+    """
+    the_vars = vars(obj)
+    old = the_vars.get(varname, _NO_VALUE)
+    if val is _NO_VALUE:
+        del the_vars[varname]
+    else:
+        the_vars[varname] = val
+    if record and obj._trail != None:
+        obj._trail.append((obj, varname, old))
+    if obj._fingerprint != None:
+        obj._fingerprint ^= _var_hash(varname, old) ^ _var_hash(varname, val)
+    if obj._goal_status != None:
+        _note_goal_var_replaced(obj, varname, old, val)
+
+
+def _same_vars(object1, object2):
+    """
+    Return True if object1 and object2 (two states, or two multigoals) have
+    the same state variables with the same values, ignoring their names.
+    """
+    if object1 is object2:
+        return True
+    if object1._fingerprint != None and object2._fingerprint != None and \
+            object1._fingerprint != object2._fingerprint:
+        return False
+    vars1 = vars(object1)
+    vars2 = vars(object2)
+    if len(vars1) != len(vars2):
+        return False
+    for (varname,val) in vars1.items():
+        if varname != '__name__' and vars2.get(varname, _NO_VALUE) != val:
+            return False
+    return True
+
+
 ################################################################################
 # A class for holding planning-and-acting domains.
 
@@ -241,13 +830,12 @@ class Domain():
     def __init__(self,domain_name):
         """domain_name is the name to use for the domain."""
 
-        global _domains, current_domain, event_callback
+        global _domains, current_domain
         
         self.__name__ = domain_name
 
         _domains.append(self)
         current_domain = self
-        event_callback = None
         
         # dictionary that maps each action name to the corresponding function
         self._action_dict = {}    
@@ -256,9 +844,7 @@ class Domain():
         self._command_dict = {}
         
         # dictionary that maps each task name to a list of relevant methods
-        # _verify_g and _verify_mg are described later in this file.
-        self._task_method_dict = \
-            {'_verify_g': [_m_verify_g], '_verify_mg': [_m_verify_mg]}
+        self._task_method_dict = {}
         
         # dictionary that maps each unigoal name to a list of relevant methods
         self._unigoal_method_dict = {}
@@ -266,6 +852,24 @@ class Domain():
         # list of all methods for multigoals
         self._multigoal_method_list = []
 
+        # dictionary that maps each task and unigoal method that has a guard
+        # to its guard (see the section on method guards)
+        self._method_guards = {}
+
+        # dictionary that maps each action, task and unigoal name to what
+        # the planner should do with it (see _get_dispatch). It is None
+        # until the planner needs it, and declare_* reset it to None.
+        self._dispatch = None
+
+        # dictionary that maps (kind, name) to the _MethodIndex for the
+        # task or unigoal methods for 'name', for each one that has been
+        # needed since declare_* were last called
+        self._method_index = {}
+
+        # a digest of the actions, methods and guards (see _get_version).
+        # It is None until a PlanCache needs it, and declare_* reset it.
+        self._version = None
+
     def __str__(self):
         return f"<Domain {self.__name__}>"
         
@@ -289,6 +893,92 @@ class Domain():
     def display(self):
         """Print the domain's actions, commands, and methods."""
         print_domain(self)
+
+    def _clear_caches(self):
+        """
+        Forget the information that _get_dispatch, _candidate_methods and
+        _get_version cache
+        """
+        self._dispatch = None
+        self._method_index = {}
+        self._version = None
+
+    def _get_version(self):
+        """
+        Return a string that identifies the domain's actions, methods and
+        guards, in the order they were declared. It changes whenever one of
+        the declare_* functions is called, and it is the same in different
+        Python processes that declare the same functions in the same order,
+        so PlanCache can use it in keys that are saved on disk.
+        """
+        if self._version == None:
+            description = (
+                [(name, _function_id(f)) for (name, f) in self._action_dict.items()],
+                [(name, [_function_id(m) for m in methods])
+                 for (name, methods) in self._task_method_dict.items()],
+                [(name, [_function_id(m) for m in methods])
+                 for (name, methods) in self._unigoal_method_dict.items()],
+                [_function_id(m) for m in self._multigoal_method_list],
+                sorted((_function_id(m), _canonical((g.args, g.tests)))
+                       for (m, g) in self._method_guards.items()))
+            self._version = _digest(repr(description))
+        return self._version
+
+    def _get_dispatch(self):
+        """
+        Return a dictionary that maps each name in the domain to a pair:
+        ('action', the action's function) if it is an action name, else
+        ('task', the task's methods) if it is a task name, else ('unigoal',
+        the unigoal's methods). This is the order in which the planner
+        classifies todo_list items. The dictionary also maps each of the
+        classes Action, Task and Goal to a dictionary of the pairs for the
+        names of that kind, which is used for items of that class.
+        """
+        if self._dispatch == None:
+            dispatch = {Action: {}, Task: {}, Goal: {}}
+            for (name, methods) in self._unigoal_method_dict.items():
+                dispatch[name] = dispatch[Goal][name] = ('unigoal', methods)
+            for (name, methods) in self._task_method_dict.items():
+                dispatch[name] = dispatch[Task][name] = ('task', methods)
+            for (name, action) in self._action_dict.items():
+                dispatch[name] = dispatch[Action][name] = ('action', action)
+            self._dispatch = dispatch
+        return self._dispatch
+
+    def _classify(self, item):
+        """
+        Return what the planner should do with the todo_list item: a pair
+        like the ones in _get_dispatch, or ('multigoal', the multigoal
+        methods), or None if item isn't an action, task, unigoal, or
+        multigoal.
+        """
+        item_type = type(item)
+        if item_type is tuple or item_type is list:
+            return self._get_dispatch().get(item[0])
+        elif isinstance(item, Action):
+            return self._get_dispatch()[Action].get(item[0])
+        elif isinstance(item, Task):
+            return self._get_dispatch()[Task].get(item[0])
+        elif isinstance(item, Goal):
+            return self._get_dispatch()[Goal].get(item[0])
+        elif isinstance(item, Multigoal):
+            return ('multigoal', self._multigoal_method_list)
+        elif isinstance(item, (list, tuple)):
+            return self._get_dispatch().get(item[0])
+        return None
+
+    def _candidate_methods(self, kind, item, methods):
+        """
+        'methods' are the relevant methods for the task or unigoal 'item',
+        and kind is 'task' or 'unigoal'. Return the ones that the domain's
+        method index says may be applicable, in the same order.
+        """
+        key = (kind, item[0])
+        index = self._method_index.get(key)
+        if index == None:
+            index = _MethodIndex(methods, self._method_guards)
+            self._method_index[key] = index
+        return index.candidates(item)
         
 
 # Sequence number to use when making copies of domains.
@@ -299,18 +989,288 @@ _domains = []
 
 
 current_domain = None
-event_callback = None
+"""
+The Domain object that find_plan, run_lazy_lookahead, etc., will use.
+"""
 
 
-def log_event(event: str) -> None:
-    print(event)
-    if event_callback is not None:
-        event_callback(event)
+################################################################################
+# Events
+#
+# Everything that GTPyhop reports, from find_plan's "Here is the plan" to the
+# search engines' traces at verbose = 3, is an Event with a level, a kind and
+# a dictionary of fields. The planner creates an event only if verbose is at
+# least the event's level, so an event that isn't wanted costs one integer
+# comparison. An event's message isn't formatted until something asks for
+# it. Each event goes to the functions in event_sinks, and then its message
+# goes to event_callback; printing it is up to the print_event sink.
+
+
+class Event():
+    """
+    e = Event(level, kind, template, fields) is something that GTPyhop
+    reports:
+      - e.level is the smallest value of verbose at which it is reported;
+      - e.kind is a string that tells what happened, e.g. 'plan_found';
+      - e.fields is a dictionary of the data that goes with it, e.g.,
+        {'plan': [...]}. A search engine's todo_list field is a persistent
+        list (see the section on persistent lists).
+      - e.message is the text to print. The first time it is used, it is
+        formatted from template and fields with str.format's syntax, plus
+        the conversions !i for a todo_list item, !t for a todo_list, and !n
+        for a list of functions. If fields is empty, the message is template
+        itself.
+    """
+    __slots__ = ('level', 'kind', 'template', 'fields', '_message')
+
+    def __init__(self, level, kind, template, fields):
+        self.level = level
+        self.kind = kind
+        self.template = template
+        self.fields = fields
+        self._message = None
+
+    def __repr__(self):
+        return f"Event({self.level}, {self.kind!r}, {self.fields!r})"
+
+    @property
+    def message(self):
+        if self._message == None:
+            if self.fields:
+                self._message = _event_formatter.vformat(self.template, (), self.fields)
+            else:
+                self._message = self.template
+        return self._message
 
+
+class _EventFormatter(string.Formatter):
+    """The string.Formatter that formats the messages of events"""
+
+    def convert_field(self, value, conversion):
+        if conversion == 'i':
+            return _item_to_string(value)
+        elif conversion == 't':
+            if type(value) is not list:
+                value = _todo_to_list(value)
+            return '[' + ', '.join([_item_to_string(x) for x in value]) + ']'
+        elif conversion == 'n':
+            return str([f.__name__ for f in value])
+        return super().convert_field(value, conversion)
+
+_event_formatter = _EventFormatter()
+
+
+def print_event(event):
+    """An event sink that prints the event's message"""
+    print(event.message)
+
+
+event_sinks = [print_event]
 """
-The Domain object that find_plan, run_lazy_lookahead, etc., will use.
+event_sinks is the list of functions that GTPyhop calls with each Event that
+it reports. By default it contains just print_event. To keep GTPyhop from
+printing while still reporting events elsewhere, remove print_event; to
+collect events, add a function such as a list's append method.
 """
 
+event_callback = None
+"""
+If event_callback isn't None, GTPyhop calls it with the message of each
+Event that it reports, after calling the functions in event_sinks.
+"""
+
+
+def emit_event(level, kind, template, **fields):
+    """
+    Report an Event with the given level, kind, template and fields. To
+    avoid building the fields of an event that isn't wanted, the caller
+    should check first that verbose >= level.
+    """
+    event = Event(level, kind, template, fields)
+    for sink in event_sinks:
+        sink(event)
+    if event_callback is not None:
+        event_callback(event.message)
+
+
+def log_event(event: str) -> None:
+    """Report the message 'event' as an Event of kind 'message'"""
+    emit_event(0, 'message', event)
+
+
+################################################################################
+# Event buses
+#
+# An EventBus is an event sink that lets several subscribers listen to the
+# planner's events without making the search wait for them. It only appends
+# each event to a bounded buffer; the subscribers get the events later, in
+# batches, either in the thread that reports them (when the buffer holds
+# batch_size events, and when find_plan finishes) or in a background thread.
+
+
+class EventBus():
+    """
+    bus = EventBus(capacity, batch_size, threaded, interval) creates an
+    event sink that delivers events to any number of subscribers. To use it,
+    add it to event_sinks, e.g.:
+        bus = EventBus()
+        bus.subscribe(my_function, level=1)
+        gtpyhop.event_sinks.append(bus)
+      - capacity is the size of the buffer. When it is full, each new event
+        overwrites the oldest one, which is counted as dropped.
+      - the buffered events are delivered when there are batch_size of them,
+        when find_plan finishes, and whenever bus.flush() is called.
+      - If threaded is True, the events are delivered in a background
+        thread, which also delivers whatever is buffered every 'interval'
+        seconds. Call bus.close() to stop the thread.
+
+    A threaded bus makes find_plan faster only by putting off the
+    subscribers' work: the background thread has to wait for the GIL, so
+    while find_plan runs it delivers few of the events, and most of them
+    are delivered after find_plan returns. The buffer must therefore be
+    large enough to hold all of the events of a search, or the ones that
+    don't fit are dropped. The default capacity is 100000 events; at
+    verbose = 3, a 400-block problem in blocks_goal_splitting produces
+    about 13000. For longer searches, give a larger capacity, and check
+    bus.dropped.
+
+    bus.subscribe(function, level, kinds) makes the bus call function with a
+    list of events, each time it delivers a batch in which there are events
+    whose level is at most 'level' (any level if level is None) and whose
+    kind is in 'kinds' (any kind if kinds is None). If events were dropped
+    since the last batch, the list starts with an event of kind
+    'events_dropped' whose 'count' field is the number of them; bus.dropped
+    is the total number.
+
+    Event messages are formatted when the subscribers ask for them, so a
+    field that refers to a mutable object (such as the working state when
+    find_plan is called with trail=True) may have changed by then.
+    """
+
+    def __init__(self, capacity=100000, batch_size=1000, threaded=False, interval=0.1):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._dropped_since = 0
+        self._buffer = collections.deque(maxlen=capacity)
+        self._subscribers = []
+        # the largest level and the kinds that some subscriber wants; None
+        # for any kind
+        self._level = -1
+        self._kinds = set()
+        # held while delivering, so that batches are delivered in order
+        self._delivering = threading.Lock()
+        # held while changing the buffer and the counts of dropped events,
+        # which the thread that reports events and the thread that delivers
+        # them both do
+        self._buffering = threading.Lock()
+        self._thread = None
+        self._closed = False
+        if threaded:
+            self._wakeup = threading.Condition()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def subscribe(self, function, level=None, kinds=None):
+        """
+        Make the bus deliver events to function (see the class docstring).
+        """
+        self._subscribers.append((function, level, None if kinds == None else set(kinds)))
+        self._update_filter()
+
+    def unsubscribe(self, function):
+        """Stop delivering events to function"""
+        self._subscribers = [s for s in self._subscribers if s[0] != function]
+        self._update_filter()
+
+    def _update_filter(self):
+        """Compute the levels and kinds of events that the bus needs to buffer"""
+        self._level = -1
+        self._kinds = set()
+        for (_, level, kinds) in self._subscribers:
+            self._level = float('inf') if level == None else max(self._level, level)
+            if kinds == None or self._kinds == None:
+                self._kinds = None
+            else:
+                self._kinds |= kinds
+
+    def __call__(self, event):
+        """Buffer 'event', if some subscriber wants it"""
+        if event.level > self._level or \
+                (self._kinds != None and event.kind not in self._kinds):
+            return
+        with self._buffering:
+            buffer = self._buffer
+            if len(buffer) == self.capacity:
+                self._dropped_since += 1
+                self.dropped += 1
+            buffer.append(event)
+            batch_ready = len(buffer) == self.batch_size
+        if batch_ready:
+            self._search_paused()
+
+    def _search_paused(self):
+        """
+        Called when the bus has a batch to deliver, and when find_plan
+        finishes: deliver the buffered events, or wake up the thread that
+        does so.
+        """
+        if self._thread == None:
+            self.flush()
+        else:
+            with self._wakeup:
+                self._wakeup.notify()
+
+    def flush(self):
+        """Deliver the buffered events now, in the calling thread"""
+        with self._delivering:
+            with self._buffering:
+                batch = list(self._buffer)
+                self._buffer.clear()
+                dropped = self._dropped_since
+                self._dropped_since = 0
+            if dropped:
+                batch.insert(0, Event(0, 'events_dropped',
+                                      'event bus: {count} events were dropped',
+                                      {'count': dropped}))
+            if not batch:
+                return
+            for (function, level, kinds) in self._subscribers:
+                events = [e for e in batch if e.kind == 'events_dropped' or
+                          ((level == None or e.level <= level) and
+                           (kinds == None or e.kind in kinds))]
+                if events:
+                    function(events)
+
+    def _run(self):
+        """The background thread's loop"""
+        while True:
+            with self._wakeup:
+                if not self._closed:
+                    self._wakeup.wait(self.interval)
+            self.flush()
+            if self._closed:
+                return
+
+    def close(self):
+        """Stop the background thread, if any, and deliver the buffered events"""
+        self._closed = True
+        if self._thread != None:
+            with self._wakeup:
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+def _flush_event_buses():
+    """Let the EventBuses in event_sinks deliver their events"""
+    for sink in event_sinks:
+        if type(sink) is EventBus:
+            sink._search_paused()
+
+
 ################################################################################
 # Functions to print information about a domain
 
@@ -349,7 +1309,7 @@ def print_commands(domain=None):
     if domain == None:
         domain = current_domain
     if domain._command_dict:
-        log_event('-- Here are the available Commands:', ', '.join(domain._command_dict))
+        log_event('-- Here are the available Commands: ' + ', '.join(domain._command_dict))
     else:
         log_event('-- There are no commands --')
 
@@ -410,6 +1370,7 @@ def declare_actions(*actions):
     if current_domain == None:
         raise Exception(f"cannot declare actions until a domain has been created.")
     current_domain._action_dict.update({act.__name__:act for act in actions})
+    current_domain._clear_caches()
     return current_domain._action_dict
 
 
@@ -442,7 +1403,7 @@ def declare_commands(*commands):
     return current_domain._command_dict
 
 
-def declare_task_methods(task_name, *methods):
+def declare_task_methods(task_name, *methods, guards=None):
     """
     'task_name' should be a character string, and 'methods' should be a list
     of functions. declare_task_methods adds each member of 'methods' to the
@@ -460,9 +1421,14 @@ def declare_task_methods(task_name, *methods):
 
     This is like Pyhop's declare_methods function, except that it can be
     called several times to declare more methods for the same task.
+
+    'guards' (optional) is a dictionary that maps some of the methods to
+    Guard objects, which tell the planner when not to bother calling them.
+    See the section on method guards below.
     """
     if current_domain == None:
         raise Exception(f"cannot declare methods until a domain has been created.")
+    _declare_guards(methods, guards)
     if task_name in current_domain._task_method_dict:
         old_methods = current_domain._task_method_dict[task_name]
         # even though current_domain._task_method_dict[task_name] is a list,
@@ -471,18 +1437,19 @@ def declare_task_methods(task_name, *methods):
         current_domain._task_method_dict[task_name].extend(new_methods)
     else:
         current_domain._task_method_dict.update({task_name:list(methods)})
+    current_domain._clear_caches()
     return current_domain._task_method_dict
 
 
-def declare_methods(task, *methods):
+def declare_methods(task, *methods, guards=None):
     if verbose > 0:
         log_event("""
         >> declare_methods exists to provide backward compatibility with
         >> Pyhop. In the future, please use declare_task_methods instead.""")
-    return declare_task_methods(task, *methods)
+    return declare_task_methods(task, *methods, guards=guards)
 
 
-def declare_unigoal_methods(state_var_name, *methods):
+def declare_unigoal_methods(state_var_name, *methods, guards=None):
     """
     'state_var_name' should be a character string, and 'methods' should be a
     list of functions. declare_unigoal_method adds each member of 'methods'
@@ -502,15 +1469,20 @@ def declare_unigoal_methods(state_var_name, *methods):
 
     To see each unigoal's list of relevant methods, use
         current_domain.display()    
+
+    'guards' (optional) is a dictionary that maps some of the methods to
+    Guard objects, as in declare_task_methods.
     """
     if current_domain == None:
         raise Exception(f"cannot declare methods until a domain has been created.")
+    _declare_guards(methods, guards)
     if state_var_name not in current_domain._unigoal_method_dict:
         current_domain._unigoal_method_dict.update({state_var_name:list(methods)})
     else:
         old_methods = current_domain._unigoal_method_dict[state_var_name]
         new_methods = [m for m in methods if m not in old_methods]
         current_domain._unigoal_method_dict[state_var_name].extend(new_methods)
+    current_domain._clear_caches()
     return current_domain._unigoal_method_dict    
 
 
@@ -537,13 +1509,213 @@ def declare_multigoal_methods(*methods):
     new_mg_methods = [m for m in methods if m not in \
                       current_domain._multigoal_method_list]
     current_domain._multigoal_method_list.extend(new_mg_methods)
+    current_domain._clear_caches()
     return current_domain._multigoal_method_list    
 
+
+################################################################################
+# Method guards
+#
+# Ordinarily the planner finds out whether a method is applicable by calling
+# it and seeing whether it returns False. A guard is a declarative statement
+# of some conditions that a method needs, which the planner checks before
+# calling the method. For example, the blocks-world method m_take(state,x,h)
+# only applies if h is 'hand', x is clear, and the hand is empty, and
+# m_put(state,x,y) only applies if y isn't 'hand' and x is in the hand:
+#
+#   declare_unigoal_methods('pos', m_take, m_put, guards={
+#       m_take: Guard(args=(ANY, 'hand'),
+#                     tests=[('clear', Arg(0), True), ('holding', 'hand', False)]),
+#       m_put:  Guard(args=(ANY, Not('hand')),
+#                     tests=[('pos', Arg(0), 'hand')])})
+#
+# A guard needn't include all of the method's conditions, but everything in
+# it must be true whenever the method is applicable, since the planner
+# won't call the method otherwise.
+#
+# The planner also indexes the guarded methods for each task name and each
+# unigoal state-variable name: it picks the argument position at which the
+# most guards require a specific value, and for each such value, it lists
+# the methods whose guards allow it. When refining a task or unigoal, it
+# looks at that argument and considers only those methods, without looking
+# at the others' guards at all. Thus a task with dozens of methods, each of
+# which is for a different value of some argument, costs about one method
+# call to refine rather than dozens.
+
+
+class _AnyValue():
+    """The class of ANY"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'ANY'
+
+ANY = _AnyValue()
+"""In a Guard, ANY matches any value."""
+
+
+class Arg():
+    """
+    In a Guard, Arg(i) stands for the method's i'th argument, not counting
+    the state, and counting from 0. For example, the arguments of a unigoal
+    method m(state,arg,value) are Arg(0) and Arg(1).
+    """
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return f"Arg({self.index})"
+
+
+class Not():
+    """In a Guard, Not(pattern) matches any value that pattern doesn't match."""
+    __slots__ = ('pattern',)
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __repr__(self):
+        return f"Not({self.pattern!r})"
+
+
+class Guard():
+    """
+    Guard(args, tests) describes conditions that a task or unigoal method
+    needs in order to be applicable. Both arguments are optional.
+      - args is a tuple of patterns for the method's arguments (not counting
+        the state). It may be shorter than the list of arguments; the rest
+        can have any values.
+      - tests is a list of triples (state_var_name, arg, pattern), each of
+        which requires that state.state_var_name[arg] match pattern. arg may
+        be Arg(i).
+    A pattern may be ANY; Arg(i), which matches a value equal to the i'th
+    argument; Not(pattern); a set or frozenset, which matches the values in
+    it; or any other value, which matches values equal to it.
+    """
+
+    def __init__(self, args=(), tests=()):
+        self.args = tuple(args)
+        self.tests = tuple(tests)
+
+    def __repr__(self):
+        return f"Guard(args={self.args!r}, tests={list(self.tests)!r})"
+
+    def matches(self, state, args):
+        """
+        Return True if the method arguments 'args' (a tuple, not including
+        the state) and the state satisfy the guard.
+        """
+        for (pattern, arg) in zip(self.args, args):
+            if not _pattern_matches(pattern, arg, args):
+                return False
+        state_vars = vars(state)
+        for (state_var_name, arg, pattern) in self.tests:
+            if type(arg) is Arg:
+                arg = args[arg.index]
+            state_var = state_vars.get(state_var_name)
+            value = state_var.get(arg) if state_var != None else None
+            if not _pattern_matches(pattern, value, args):
+                return False
+        return True
+
+
+def _pattern_matches(pattern, value, args):
+    """Return True if value matches pattern, given the method arguments args"""
+    pattern_type = type(pattern)
+    if pattern_type is _AnyValue:
+        return True
+    elif pattern_type is Arg:
+        return value == args[pattern.index]
+    elif pattern_type is Not:
+        return not _pattern_matches(pattern.pattern, value, args)
+    elif pattern_type is set or pattern_type is frozenset:
+        return value in pattern
+    return value == pattern
+
+
+def _is_constant_pattern(pattern):
+    """Return True if pattern matches exactly the values equal to it"""
+    if isinstance(pattern, (_AnyValue, Arg, Not, set, frozenset)):
+        return False
+    try:
+        hash(pattern)
+    except TypeError:
+        return False
+    return True
+
+
+def _declare_guards(methods, guards):
+    """Add guards (a dictionary or None) for 'methods' to the current domain"""
+    if guards == None:
+        return
+    for (method, guard) in guards.items():
+        if method not in methods:
+            raise Exception(f"guard for {method.__name__}, which isn't being declared")
+        if not isinstance(guard, Guard):
+            raise Exception(f"the guard for {method.__name__} isn't a Guard")
+    current_domain._method_guards.update(guards)
+
+
+class _MethodIndex():
+    """
+    An index of the relevant methods for one task name or unigoal
+    state-variable name (see above). If position isn't None, then for each
+    value v that a guard requires argument 'position' to have, buckets[v]
+    is the list of the methods whose guards allow v there, and 'others' is
+    the list of methods whose guards don't require any specific value.
+    """
+    __slots__ = ('methods', 'position', 'buckets', 'others')
+
+    def __init__(self, methods, guards):
+        self.methods = methods
+        self.position = None
+        patterns = [guards[m].args if m in guards else () for m in methods]
+        counts = {}
+        for method_patterns in patterns:
+            for (i, pattern) in enumerate(method_patterns):
+                if _is_constant_pattern(pattern):
+                    counts[i] = counts.get(i, 0) + 1
+        if not counts:
+            return
+        position = max(counts, key=lambda i: (counts[i], -i))
+        at_position = [p[position] if position < len(p) else ANY for p in patterns]
+        self.position = position
+        self.others = [m for (m, p) in zip(methods, at_position) \
+                       if not _is_constant_pattern(p)]
+        self.buckets = {}
+        for value in at_position:
+            if _is_constant_pattern(value) and value not in self.buckets:
+                self.buckets[value] = [m for (m, p) in zip(methods, at_position) \
+                                       if not _is_constant_pattern(p) or p == value]
+
+    def candidates(self, item):
+        """Return the methods that may be applicable to the task or unigoal item"""
+        if self.position == None:
+            return self.methods
+        try:
+            return self.buckets.get(item[self.position + 1], self.others)
+        except (IndexError, TypeError):
+            return self.methods
+
     
 ################################################################################
 # A built-in multigoal method and its helper function.
 
 
+split_multigoal_order = None
+"""
+split_multigoal_order is a global value whose initial value is None. It tells
+m_split_multigoal in which order to return the goals that aren't achieved:
+ - None: the order in which they are in the multigoal;
+ - a function f(state, multigoal, goals), where goals is the list of the
+   (state_var_name, arg, val) triples for the goals that aren't achieved in
+   that order: the order of the list that f returns, which must contain the
+   same goals. order_by_dependencies is such a function.
+"""
+
+
 def m_split_multigoal(state,multigoal):
     """
     m_split_multigoal is the only multigoal method that GTPyhop provides,
@@ -565,11 +1737,11 @@ def m_split_multigoal(state,multigoal):
     m_split_multigal will be used repeatedly, until it succeeds in producing
     a state in which all of the goals in multigoal are simultaneously true.
 
-    The main problem with m_split_multigoal is that it isn't smart about
-    choosing the order in which to achieve g_1, ..., g_n. Some orderings may
-    work much better than others. Thus, rather than using the method as it's
-    defined below, one might want to modify it to choose a good order, e.g.,
-    by using domain-specific information or a heuristic function.
+    The main problem with m_split_multigoal is that by default, it isn't
+    smart about choosing the order in which to achieve g_1, ..., g_n. Some
+    orderings may work much better than others. To choose a better order,
+    e.g., by using domain-specific information or a heuristic function, set
+    split_multigoal_order (see above), for instance to order_by_dependencies.
     """
     goal_dict = _goals_not_achieved(state,multigoal)
     goal_list = []
@@ -578,11 +1750,67 @@ def m_split_multigoal(state,multigoal):
             val = goal_dict[state_var_name][arg]
             goal_list.append((state_var_name,arg,val))
     if goal_list:
+        if split_multigoal_order != None and len(goal_list) > 1:
+            goal_list = list(split_multigoal_order(state, multigoal, goal_list))
         # achieve goals, then check whether they're all simultaneously true
         return goal_list + [multigoal]
     return goal_list
 
 
+def order_by_dependencies(state, multigoal, goals):
+    """
+    A function for split_multigoal_order. It puts each goal (var, arg, val)
+    after the goals in 'goals' whose arg is val, i.e., the goals about the
+    object that this goal refers to, and otherwise keeps the order of goals.
+    For example, with the goals
+        ('pos', 'a', 'b'), ('pos', 'b', 'c'), ('pos', 'c', 'table')
+    it returns them in the opposite order, so that the blocks are stacked
+    from the bottom up. Achieving ('pos', 'a', 'b') first would be wasted
+    effort, since 'a' would have to be moved away again before 'b' could be
+    moved. If the goals depend on each other in a cycle, the first goal in
+    the cycle that is still waiting goes first.
+    """
+    # for each arg, the indices of the goals about it
+    about = {}
+    for (i, (state_var_name, arg, val)) in enumerate(goals):
+        about.setdefault(arg, []).append(i)
+    # after[j] is the list of the goals that must come after goals[j]
+    after = [[] for goal in goals]
+    waiting = [0] * len(goals)
+    for (i, (state_var_name, arg, val)) in enumerate(goals):
+        try:
+            depends_on = about.get(val, ())
+        except TypeError:       # val isn't hashable
+            continue
+        for j in depends_on:
+            if j != i:
+                after[j].append(i)
+                waiting[i] += 1
+    # a topological sort, using the original order to break ties
+    ready = [i for i in range(len(goals)) if waiting[i] == 0]
+    heapq.heapify(ready)
+    result = []
+    done = [False] * len(goals)
+    next_unplaced = 0
+    while len(result) < len(goals):
+        if ready:
+            i = heapq.heappop(ready)
+        else:
+            # a cycle: take the first goal that hasn't been placed
+            while done[next_unplaced]:
+                next_unplaced += 1
+            i = next_unplaced
+        if done[i]:
+            continue
+        done[i] = True
+        result.append(goals[i])
+        for k in after[i]:
+            waiting[k] -= 1
+            if waiting[k] == 0:
+                heapq.heappush(ready, k)
+    return result
+
+
 # helper function for m_split_multigoal above:
 
 def _goals_not_achieved(state,multigoal):
@@ -595,7 +1823,12 @@ def _goals_not_achieved(state,multigoal):
         s.loc['c2'] = 'room2', g.loc['c2'] = 'room4'.
     Then _goals_not_achieved(s, g) will return
         {'loc': {'c1': 'room3', 'c2': 'room4'}}    
+
+    If track_multigoals is True, the result comes from g's tracker in s
+    (see below) instead of from a comparison of every goal in g with s.
     """
+    if track_multigoals and isinstance(state, State):
+        return _tracked_goals_not_achieved(state,multigoal)
     unachieved = {}
     for name in vars(multigoal):
         if name != '__name__':
@@ -609,75 +1842,421 @@ def _goals_not_achieved(state,multigoal):
     return unachieved
 
 
+def _multigoal_achieved(state,multigoal):
+    """Return True if all of the goals in multigoal are true in state"""
+    if track_multigoals and isinstance(state, State):
+        return _get_goal_status(state,multigoal).count == 0
+    # like "not _goals_not_achieved(state,multigoal)", but stop at the first
+    # goal that isn't achieved
+    for name in vars(multigoal):
+        if name != '__name__':
+            values = vars(state).get(name)
+            for (arg, val) in vars(multigoal).get(name).items():
+                if val != values.get(arg):
+                    return False
+    return True
+
+
 ################################################################################
-# Functions to verify whether unigoal_methods achieve the goals they are
-# supposed to achieve.
+# Tracking the unsatisfied goals of multigoals
 
 
-verify_goals = True
+track_multigoals = False
 """
-If verify_goals is True, then whenever the planner uses a method m to refine
-a unigoal or multigoal, it will insert a "verification" task into the
-current partial plan. If verify_goals is False, the planner won't insert any
-verification tasks into the plan.
-
-The purpose of the verification task is to raise an exception if the
-refinement produced by m doesn't achieve the goal or multigoal that it is
-supposed to achieve. The verification task won't insert anything into the
-final plan; it just will verify whether m did what it was supposed to do.
+track_multigoals is a global value whose initial value is False. If it is
+True, then instead of comparing every goal of a multigoal g with the state
+each time m_split_multigoal or a multigoal verification marker needs to know
+which goals are unsatisfied, GTPyhop keeps track of them:
+ - The first time that happens for g and a state s, GTPyhop makes a
+   tracker for g, which holds g's goals as a list of (var, arg, value)
+   triples, and computes which of them are unsatisfied in s. s becomes
+   watched (see the section on fingerprints), so that it reports each
+   write to a state variable.
+ - Each write that changes whether one of g's goals is satisfied updates
+   the number of unsatisfied goals and records which goal changed. This
+   carries over to copies of s, and to their copies, and so on.
+ - Thus, checking whether g is achieved in a state descended from s takes
+   constant time, and finding its unsatisfied goals takes time proportional
+   to their number plus the number of changes since the last time that was
+   done, rather than to the number of goals in g.
+This is worthwhile for multigoals with many goals. It makes the state that
+find_plan starts from watched, and it requires the same discipline as
+fingerprints: actions must change dictionary-valued state variables by
+writing to them, and a multigoal mustn't be modified while it is tracked.
 """
 
 
-def _m_verify_g(state, method, state_var, arg, desired_val, depth):
+class _GoalTracker():
     """
-    _m_verify_g is a method that GTPyhop uses to check whether a
-    unigoal method has achieved the goal for which it was used.
+    The goals of a tracked multigoal: goals is a list of (var, arg, value)
+    triples in the multigoal's order, and index[var][arg] = (i, value),
+    where i is the position of the goal in goals.
     """
-    if vars(state)[state_var][arg] != desired_val:
-        raise Exception(f"depth {depth}: method {method} didn't achieve",
-                f"goal {state_var}[{arg}] = {desired_val}")
-    if verbose >= 3:
-        log_event(f"depth {depth}: method {method} achieved",
-                f"goal {state_var}[{arg}] = {desired_val}")
-    return []       # i.e., don't create any subtasks or subgoals
+    __slots__ = ('multigoal', 'goals', 'index')
+
+    def __init__(self, multigoal):
+        self.multigoal = multigoal
+        self.goals = []
+        self.index = {}
+        for (var, goal_dict) in vars(multigoal).items():
+            if var != '__name__':
+                self.index[var] = {}
+                for (arg, val) in goal_dict.items():
+                    self.index[var][arg] = (len(self.goals), val)
+                    self.goals.append((var, arg, val))
 
 
-def _m_verify_mg(state, method, multigoal, depth):
+class _GoalStatus():
     """
-    _m_verify_g is a method that GTPyhop uses to check whether a multigoal
-    method has achieved the multigoal for which it was used.
+    The unsatisfied goals of a tracked multigoal in one state. count is how
+    many goals are unsatisfied. If unsat is a set, it holds the positions
+    (in tracker.goals) of the unsatisfied goals. Otherwise unsat is None,
+    and flips lists the goals that have changed between satisfied and
+    unsatisfied since the state's status was that of 'parent'.
+
+    When a state is copied, its status is frozen and both the state and the
+    copy get new statuses whose parent is the frozen one, so that a status
+    never changes after another status depends on it.
     """
-    goal_dict = _goals_not_achieved(state,multigoal)
-    if goal_dict:
-        raise Exception(f"depth {depth}: method {method} " + \
-                        f"didn't achieve {multigoal}]")
-    if verbose >= 3:
-        log_event(f"depth {depth}: method {method} achieved {multigoal}")
-    return []
+    __slots__ = ('tracker', 'parent', 'flips', 'unsat', 'count')
+
+    def __init__(self, tracker, parent):
+        self.tracker = tracker
+        self.parent = parent
+        self.flips = []
+        self.unsat = None
+        self.count = parent.count if parent != None else 0
+
+    def flip(self, i, unsatisfied):
+        """Record that goal i has become unsatisfied, or satisfied"""
+        self.count += 1 if unsatisfied else -1
+        if self.unsat == None:
+            self.flips.append(i)
+        elif unsatisfied:
+            self.unsat.add(i)
+        else:
+            self.unsat.discard(i)
+
+    def unsatisfied(self):
+        """Return the set of positions of the unsatisfied goals"""
+        if self.unsat == None:
+            path = []
+            status = self
+            while status.unsat == None:
+                path.append(status)
+                status = status.parent
+            unsat = set(status.unsat)
+            for status in reversed(path):
+                for i in status.flips:
+                    if i in unsat:
+                        unsat.remove(i)
+                    else:
+                        unsat.add(i)
+            self.unsat = unsat
+            self.flips = []
+        return self.unsat
+
+
+def _lookup(state_var, arg):
+    """Return state_var[arg], or None if there isn't any"""
+    if isinstance(state_var, (dict, _SharedVar)):
+        return state_var.get(arg)
+    return None
+
+
+def _get_goal_status(state, multigoal):
+    """
+    Return multigoal's _GoalStatus in state, and start tracking it if it
+    isn't tracked there yet.
+    """
+    if state._goal_status == None:
+        state._goal_status = {}
+    status = state._goal_status.get(id(multigoal))
+    if status == None or status.tracker.multigoal is not multigoal:
+        tracker = _GoalTracker(multigoal)
+        status = _GoalStatus(tracker, None)
+        state_vars = vars(state)
+        status.unsat = {i for (i, (var, arg, val)) in enumerate(tracker.goals)
+                        if _lookup(state_vars.get(var), arg) != val}
+        status.count = len(status.unsat)
+        _watch_dicts(state)
+        # the tracker refers to multigoal, so its id can't be reused
+        state._goal_status[id(multigoal)] = status
+    return status
+
+
+def _tracked_goals_not_achieved(state, multigoal):
+    """Like _goals_not_achieved, but use multigoal's tracker in state"""
+    status = _get_goal_status(state, multigoal)
+    unachieved = {}
+    if status.count > 0:
+        goals = status.tracker.goals
+        for i in sorted(status.unsatisfied()):
+            (var, arg, val) = goals[i]
+            unachieved.setdefault(var, {})[arg] = val
+    return unachieved
+
+
+def _note_goal_write(state, var, arg, old, new):
+    """
+    Update the statuses of the tracked multigoals in state, after the value
+    of var[arg] has changed from old to new.
+    """
+    if old is _NO_VALUE:
+        old = None
+    if new is _NO_VALUE:
+        new = None
+    for status in state._goal_status.values():
+        goal = status.tracker.index.get(var, _NO_GOALS).get(arg)
+        if goal != None:
+            (i, val) = goal
+            unsatisfied = new != val
+            if (old != val) != unsatisfied:
+                status.flip(i, unsatisfied)
+
+
+# Used by _note_goal_write for state variables that no multigoal mentions.
+_NO_GOALS = {}
+
+
+def _note_goal_var_replaced(state, var, old, new):
+    """
+    Update the statuses of the tracked multigoals in state, after the state
+    variable var has changed from old to new (either may be _NO_VALUE).
+    """
+    for status in state._goal_status.values():
+        for (arg, (i, val)) in status.tracker.index.get(var, _NO_GOALS).items():
+            unsatisfied = _lookup(new, arg) != val
+            if (_lookup(old, arg) != val) != unsatisfied:
+                status.flip(i, unsatisfied)
+
+
+def _fork_goal_status(state, the_copy):
+    """
+    the_copy is a new copy of state. Give it the same tracked multigoals,
+    with the same statuses, as state.
+    """
+    statuses = {}
+    copy_statuses = {}
+    for (key, status) in state._goal_status.items():
+        if status.unsat == None and not status.flips and status.parent != None:
+            # status hasn't changed since it was made, so it can stay as it
+            # is, and the copy can share its parent
+            statuses[key] = status
+            base = status.parent
+        else:
+            statuses[key] = _GoalStatus(status.tracker, status)
+            base = status
+        copy_statuses[key] = _GoalStatus(status.tracker, base)
+    state._goal_status = statuses
+    the_copy._goal_status = copy_statuses
+
+
+################################################################################
+# Functions to verify whether unigoal_methods achieve the goals they are
+# supposed to achieve.
+
+
+verify_goals = True
+"""
+If verify_goals is True, then whenever the planner uses a method m to refine
+a unigoal or multigoal, it will insert a verification marker into the
+current todo_list, after the subgoals that m returned. If verify_goals is
+False, the planner won't insert any verification markers.
+
+The purpose of the verification marker is to raise an exception if the
+refinement produced by m doesn't achieve the goal or multigoal that it is
+supposed to achieve. The marker won't insert anything into the final plan,
+and it isn't a node of the search: when it reaches the front of the
+todo_list, the planner just checks whether m did what it was supposed to
+do, and goes on with the rest of the todo_list at the same depth.
+"""
+
+
+class _Verification(tuple):
+    """
+    _Verification((method_name, goal, depth)) is the verification marker for
+    a unigoal or multigoal 'goal' that the planner refined at the given depth
+    with the method named method_name. It is a tuple so that todo_lists that
+    contain it can be compared and hashed like other todo_lists (e.g., for
+    TranspositionTable), but its class tells the planner that it isn't an
+    action, task, or goal. Two markers are equal if their goals are, whatever
+    their methods and depths, since the check doesn't depend on those; so a
+    subproblem reached through different methods or at different depths is
+    still found in a TranspositionTable.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is _Verification and self[1] == other[1]
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((_Verification, self[1]))
+
+    def __repr__(self):
+        (method, goal, depth) = self
+        if isinstance(goal, Multigoal):
+            return f"_verify_mg({method}, {goal}, depth {depth})"
+        return f"_verify_g({method}, {goal}, depth {depth})"
+
+    def check(self, state):
+        """
+        Raise an exception if the marker's goal isn't achieved in state.
+        """
+        (method, goal, depth) = self
+        if isinstance(goal, Multigoal):
+            if not _multigoal_achieved(state,goal):
+                raise Exception(f"depth {depth}: method {method} " + \
+                                f"didn't achieve {goal}]")
+            if verbose >= 3:
+                emit_event(3, 'goal_verified',
+                           "depth {depth}: method {method} achieved {goal}",
+                           depth=depth, method=method, goal=goal)
+            return
+        (state_var, arg, desired_val) = goal
+        if vars(state)[state_var][arg] != desired_val:
+            raise Exception(f"depth {depth}: method {method} didn't achieve",
+                    f"goal {state_var}[{arg}] = {desired_val}")
+        if verbose >= 3:
+            emit_event(3, 'goal_verified', "depth {depth}: method {method} achieved " + \
+                       "goal {goal[0]}[{goal[1]}] = {goal[2]}",
+                       depth=depth, method=method, goal=goal)
+
+
+def _skip_markers(state, todo_list):
+    """
+    Handle the markers (verification markers, and the _SpanEnd markers of a
+    SearchTracer) at the front of the persistent list todo_list, and return
+    the rest of it.
+    """
+    while todo_list != () and type(todo_list[0]) in _MARKER_TYPES:
+        todo_list[0].check(state)
+        todo_list = todo_list[1]
+    return todo_list
+
+
+################################################################################
+# Persistent lists for todo_lists and partial plans
+#
+# While it searches, the planner represents each todo_list and partial plan as
+# a persistent (immutable, shared-structure) linked list: either () for the
+# empty list, or a pair (first, rest) where rest is another persistent list.
+# Removing the first item of a todo_list, pushing a method's subtasks onto it,
+# and appending an action to a plan then cost time proportional to the number
+# of items added, rather than to the length of the whole list. Todo_lists are
+# stored in order, and partial plans are stored last-action-first. They are
+# converted back to Python lists only when find_plan returns a plan, or when
+# a verbose message needs to print them.
+
+
+def _push_items(items, todo_list):
+    """
+    Return the persistent list whose items are those of the Python sequence
+    'items' followed by those of the persistent list 'todo_list'.
+    """
+    for item in reversed(items):
+        todo_list = (item, todo_list)
+    return todo_list
+
+
+class _HashedCell(tuple):
+    """
+    _HashedCell(item, rest) is a cell (item, rest) of a persistent list that
+    stores its hash when it is created, computing it from item's hash and
+    rest's stored hash, so that hashing the whole list takes constant time
+    instead of time proportional to its length. _SearchEngine builds its
+    todo_lists out of these cells when it has a TranspositionTable, since
+    each key includes the rest of the todo_list. rest must be () or another
+    _HashedCell. If an item isn't hashable, hashing the list raises
+    TypeError, as it would for a tuple.
+    """
+
+    def __new__(cls, item, rest):
+        cell = tuple.__new__(cls, (item, rest))
+        rest_hash = 0 if rest == () else rest._hash
+        try:
+            cell._hash = None if rest_hash == None else hash((item, rest_hash))
+        except TypeError:
+            cell._hash = None
+        return cell
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __hash__(self):
+        if self._hash == None:
+            raise TypeError(f"unhashable item in todo_list {_todo_to_list(self)}")
+        return self._hash
+
+
+def _push_hashed_items(items, todo_list):
+    """
+    Like _push_items, but for a todo_list made of _HashedCells.
+    """
+    for item in reversed(items):
+        todo_list = _HashedCell(item, todo_list)
+    return todo_list
+
+
+def _todo_to_list(todo_list):
+    """Return a Python list of the items in the persistent list 'todo_list'"""
+    result = []
+    while todo_list:
+        (item, todo_list) = todo_list
+        result.append(item)
+    return result
+
+
+def _plan_to_list(plan):
+    """Return a Python list of the actions in the persistent plan 'plan'"""
+    result = _todo_to_list(plan)
+    result.reverse()
+    return result
 
 
 ################################################################################
 # Applying actions, commands, and methods
 
 
+# Templates for the events that both search engines report
+_ACTION_APPLIED = 'depth {depth} action {action}: applied'
+_ACTION_NOT_APPLICABLE = 'depth {depth} action {action}: not applicable'
+_ALREADY_ACHIEVED = 'depth {depth} goal {goal}: already achieved'
+_GUARD_NOT_SATISFIED = 'depth {depth} trying {method.__name__}: guard not satisfied'
+_METHOD_APPLICABLE = 'depth {depth} trying {method.__name__}: applicable, subitems {subitems}'
+_METHOD_NOT_APPLICABLE = 'depth {depth} trying {method.__name__}: not applicable'
+_METHODS = 'depth {depth} {item_kind} {item} methods {methods!n}'
+_REFINEMENT_FAILED = 'depth {depth} could not refine {item_kind} {item}'
+_TODO_LIST = 'depth {depth} todo_list {todo_list!t}'
+_TODO_LIST_DONE = 'depth {depth} no more tasks or goals, return plan'
+
+
 def _apply_action_and_continue(state, task1, todo_list, plan, depth):
     """
     _apply_action_and_continue is called only when task1's name matches an
     action name. It applies the action by retrieving the action's function
-    definition and calling it on the arguments, then calls seek_plan
+    definition and calling it on the arguments, then calls _seek_plan
     recursively on todo_list.
     """
-    if verbose >= 3:
-        log_event(f'depth {depth} action {task1}: ', end='')
     action = current_domain._action_dict[task1[0]]
     newstate = action(state.copy(),*task1[1:])
+    stats = _seek_options.stats
+    if stats != None:
+        stats.state_copies += 1
+        if newstate:
+            stats.actions += 1
     if newstate:
         if verbose >= 3:
-            log_event('applied')
+            emit_event(3, 'action_applied', _ACTION_APPLIED,
+                       depth=depth, action=task1)
             newstate.display()
-        return seek_plan(newstate, todo_list, plan+[task1], depth+1)
+        return _seek_plan(newstate, todo_list, (task1, plan), depth+1)
     if verbose >= 3:
-        log_event('not applicable')
+        emit_event(3, 'action_not_applicable', _ACTION_NOT_APPLICABLE,
+                   depth=depth, action=task1)
     return False
 
 
@@ -685,31 +2264,64 @@ def _refine_task_and_continue(state, task1, todo_list, plan, depth):
     """
     If task1 is in the task-method dictionary, then iterate through the list
     of relevant methods to find one that's applicable, apply it to get
-    additional todo_list items, and call seek_plan recursively on
+    additional todo_list items, and call _seek_plan recursively on
             [the additional items] + todo_list.
 
-    If the call to seek_plan fails, go on to the next method in the list.
+    If the call to _seek_plan fails, go on to the next method in the list.
     """
     relevant = current_domain._task_method_dict[task1[0]]
+    guards = current_domain._method_guards
+    if guards:
+        relevant = current_domain._candidate_methods('task', task1, relevant)
+    options = _seek_options
+    statistics = options.statistics
+    if statistics != None:
+        relevant = statistics._ordered(relevant)
+    stats = options.stats
+    tracer = options.tracer
+    if tracer != None:
+        path = tracer.path
     if verbose >= 3:
-        log_event(f'depth {depth} task {task1} methods {[m.__name__ for m in relevant]}')
+        emit_event(3, 'methods', _METHODS,
+                   depth=depth, item_kind='task', item=task1, methods=relevant)
     for method in relevant:
-        if verbose >= 3: 
-            log_event(f'depth {depth} trying {method.__name__}: ', end='')
+        if guards and method in guards and not guards[method].matches(state, task1[1:]):
+            if verbose >= 3:
+                emit_event(3, 'guard_not_satisfied', _GUARD_NOT_SATISFIED,
+                           depth=depth, method=method)
+            continue
+        if tracer != None:
+            tracer._begin(task1, 'task', method)
         subtasks = method(state, *task1[1:])
+        if statistics != None:
+            statistics._tried(method, subtasks)
+        if stats != None:
+            stats._called(method)
         # Can't just say "if subtasks:", because that's wrong if subtasks == []
         if subtasks != False and subtasks != None:
             if verbose >= 3:
-                log_event('applicable')
-                log_event(f'depth {depth} subtasks: {subtasks}')
-            result = seek_plan(state, subtasks+todo_list, plan, depth+1)
+                emit_event(3, 'method_applicable', _METHOD_APPLICABLE,
+                           depth=depth, method=method, subitems=subtasks)
+            subplan = _recorded(plan, task1, method, subtasks) if options.record_trees else plan
+            continuation = (_SpanEnd((tracer,)), todo_list) if tracer != None else todo_list
+            result = _seek_plan(state, _push_items(subtasks, continuation), subplan, depth+1)
             if result != False and result != None:
+                if statistics != None:
+                    statistics._succeeded(method)
                 return result
+            if stats != None:
+                stats.backtracks += 1
+            if tracer != None:
+                tracer._restore(path)
         else:
+            if tracer != None:
+                tracer._end('not applicable')
             if verbose >= 3:
-                log_event(f'not applicable')
+                emit_event(3, 'method_not_applicable', _METHOD_NOT_APPLICABLE,
+                           depth=depth, method=method)
     if verbose >= 3:
-        log_event(f'depth {depth} could not accomplish task {task1}')
+        emit_event(3, 'refinement_failed', _REFINEMENT_FAILED,
+                   depth=depth, item_kind='task', item=task1)
     return False
 
 
@@ -717,45 +2329,75 @@ def _refine_unigoal_and_continue(state, goal1, todo_list, plan, depth):
     """
     If goal1 is in the unigoal-method dictionary, then iterate through the
     list of relevant methods to find one that's applicable, apply it to get
-    additional todo_list items, and call seek_plan recursively on
+    additional todo_list items, and call _seek_plan recursively on
           [the additional items] + [verify_g] + todo_list,
 
-    where [verify_g] verifies whether the method actually achieved goal1.
-    If the call to seek_plan fails, go on to the next method in the list.
+    where [verify_g] is a verification marker (see verify_goals) that checks
+    whether the method actually achieved goal1.
+    If the call to _seek_plan fails, go on to the next method in the list.
     """
-    if verbose >= 3:
-        log_event(f'depth {depth} goal {goal1}: ', end='')
     (state_var_name, arg, val) = goal1
     if vars(state).get(state_var_name).get(arg) == val:
         if verbose >= 3:
-            log_event(f'already achieved')
-        return seek_plan(state, todo_list, plan, depth+1)
+            emit_event(3, 'already_achieved', _ALREADY_ACHIEVED, depth=depth, goal=goal1)
+        if _seek_options.record_trees:
+            plan = _recorded(plan, goal1, None, ())
+        return _seek_plan(state, todo_list, plan, depth+1)
     relevant = current_domain._unigoal_method_dict[state_var_name]
+    guards = current_domain._method_guards
+    if guards:
+        relevant = current_domain._candidate_methods('unigoal', goal1, relevant)
+    options = _seek_options
+    statistics = options.statistics
+    if statistics != None:
+        relevant = statistics._ordered(relevant)
+    stats = options.stats
+    tracer = options.tracer
+    if tracer != None:
+        path = tracer.path
     if verbose >= 3:
-        log_event(f'methods {[m.__name__ for m in relevant]}')
+        emit_event(3, 'methods', _METHODS,
+                   depth=depth, item_kind='unigoal', item=goal1, methods=relevant)
     for method in relevant:
-        if verbose >= 3: 
-            log_event(f'depth {depth} trying method {method.__name__}: ', end='')
+        if guards and method in guards and not guards[method].matches(state, (arg, val)):
+            if verbose >= 3:
+                emit_event(3, 'guard_not_satisfied', _GUARD_NOT_SATISFIED,
+                           depth=depth, method=method)
+            continue
+        if tracer != None:
+            tracer._begin(goal1, 'unigoal', method)
         subgoals = method(state,arg,val)
+        if statistics != None:
+            statistics._tried(method, subgoals)
+        if stats != None:
+            stats._called(method)
         # Can't just say "if subgoals:", because that's wrong if subgoals == []
         if subgoals != False and subgoals != None:
             if verbose >= 3:
-                log_event('applicable')
-                log_event(f'depth {depth} subgoals: {subgoals}')
+                emit_event(3, 'method_applicable', _METHOD_APPLICABLE,
+                           depth=depth, method=method, subitems=subgoals)
+            verification = (_SpanEnd((tracer,)), todo_list) if tracer != None else todo_list
             if verify_goals:
-                verification = [('_verify_g', method.__name__, \
-                                 state_var_name, arg, val, depth)]
-            else:
-                verification = []
-            todo_list = subgoals + verification + todo_list
-            result = seek_plan(state, todo_list, plan, depth+1)
+                verification = (_Verification((method.__name__, goal1, depth)), verification)
+            subplan = _recorded(plan, goal1, method, subgoals) if options.record_trees else plan
+            result = _seek_plan(state, _push_items(subgoals, verification), subplan, depth+1)
             if result != False and result != None:
+                if statistics != None:
+                    statistics._succeeded(method)
                 return result
+            if stats != None:
+                stats.backtracks += 1
+            if tracer != None:
+                tracer._restore(path)
         else:
+            if tracer != None:
+                tracer._end('not applicable')
             if verbose >= 3:
-                log_event(f'not applicable')
+                emit_event(3, 'method_not_applicable', _METHOD_NOT_APPLICABLE,
+                           depth=depth, method=method)
     if verbose >= 3:
-        log_event(f'depth {depth} could not achieve goal {goal1}')
+        emit_event(3, 'refinement_failed', _REFINEMENT_FAILED,
+                   depth=depth, item_kind='unigoal', item=goal1)
     return False
 
 
@@ -763,39 +2405,60 @@ def _refine_multigoal_and_continue(state, goal1, todo_list, plan, depth):
     """
     If goal1 is a multigoal, then iterate through the list of multigoal
     methods to find one that's applicable, apply it to get additional
-    todo_list items, and call seek_plan recursively on
+    todo_list items, and call _seek_plan recursively on
           [the additional items] + [verify_mg] + todo_list,
 
-    where [verify_mg] verifies whether the method actually achieved goal1.
-    If the call to seek_plan fails, go on to the next method in the list.
+    where [verify_mg] is a verification marker (see verify_goals) that checks
+    whether the method actually achieved goal1.
+    If the call to _seek_plan fails, go on to the next method in the list.
     """
-    if verbose >= 3:
-        log_event(f'depth {depth} multigoal {goal1}: ', end='')
     relevant = current_domain._multigoal_method_list
+    options = _seek_options
+    statistics = options.statistics
+    if statistics != None:
+        relevant = statistics._ordered(relevant)
+    stats = options.stats
+    tracer = options.tracer
+    if tracer != None:
+        path = tracer.path
     if verbose >= 3:
-        log_event(f'methods {[m.__name__ for m in relevant]}')
+        emit_event(3, 'methods', _METHODS,
+                   depth=depth, item_kind='multigoal', item=goal1, methods=relevant)
     for method in relevant:
-        if verbose >= 3: 
-            log_event(f'depth {depth} trying method {method.__name__}: ', end='')
+        if tracer != None:
+            tracer._begin(goal1, 'multigoal', method)
         subgoals = method(state,goal1)
+        if statistics != None:
+            statistics._tried(method, subgoals)
+        if stats != None:
+            stats._called(method)
         # Can't just say "if subgoals:", because that's wrong if subgoals == []
         if subgoals != False and subgoals != None:
             if verbose >= 3:
-                log_event('applicable')
-                log_event(f'depth {depth} subgoals: {subgoals}')
+                emit_event(3, 'method_applicable', _METHOD_APPLICABLE,
+                           depth=depth, method=method, subitems=subgoals)
+            verification = (_SpanEnd((tracer,)), todo_list) if tracer != None else todo_list
             if verify_goals:
-                verification = [('_verify_mg', method.__name__, goal1, depth)]
-            else:
-                verification = []
-            todo_list = subgoals + verification + todo_list
-            result = seek_plan(state, todo_list, plan, depth+1)
+                verification = (_Verification((method.__name__, goal1, depth)), verification)
+            subplan = _recorded(plan, goal1, method, subgoals) if options.record_trees else plan
+            result = _seek_plan(state, _push_items(subgoals, verification), subplan, depth+1)
             if result != False and result != None:
+                if statistics != None:
+                    statistics._succeeded(method)
                 return result
+            if stats != None:
+                stats.backtracks += 1
+            if tracer != None:
+                tracer._restore(path)
         else:
+            if tracer != None:
+                tracer._end('not applicable')
             if verbose >= 3:
-                log_event(f'not applicable')
+                emit_event(3, 'method_not_applicable', _METHOD_NOT_APPLICABLE,
+                           depth=depth, method=method)
     if verbose >= 3:
-        log_event(f'depth {depth} could not achieve multigoal {goal1}')
+        emit_event(3, 'refinement_failed', _REFINEMENT_FAILED,
+                   depth=depth, item_kind='multigoal', item=goal1)
     return False
 
 
@@ -803,30 +2466,409 @@ def _refine_multigoal_and_continue(state, goal1, todo_list, plan, depth):
 # The planning algorithm
 
 
-def find_plan(state, todo_list):
+search_engine = 'recursive'
+"""
+search_engine tells find_plan which search engine to use, unless find_plan's
+'engine' argument says otherwise:
+ - 'recursive': seek_plan, which calls itself once for each item in the
+   todo_list. Long plans need a correspondingly high recursion limit.
+ - 'iterative': _SearchEngine, which keeps its choice points on an explicit
+   stack instead of Python's call stack. It returns the same plans as
+   seek_plan, but its depth isn't limited by sys.getrecursionlimit().
+"""
+
+
+class PlanResult():
+    """
+    find_plan(..., return_result=True) returns a PlanResult r that tells
+    what the search found, why it stopped, and how much work it did:
+      - r.plan is the plan, or False if the search didn't find one;
+      - r.status is 'success' if it found a plan, 'failure' if it searched
+        the whole search space without finding one, 'max_depth' if it did
+        the same except for the nodes that were cut off by max_depth, or
+        'max_nodes' or 'deadline' if it ran out of nodes or time first;
+      - r.nodes is the number of nodes it expanded, i.e., the number of
+        times it took an item off a todo_list (or found the todo_list empty);
+      - r.depth is the largest depth of any of those nodes;
+      - r.elapsed is the number of seconds that it took;
+      - r.tree is the plan's DecompositionTree if find_plan was called with
+        return_tree=True and found a plan, and None otherwise;
+      - r.stats is the SearchStats that find_plan was called with, or None
+        (see the section on search statistics).
+    """
+
+    def __init__(self, plan, status, nodes, depth, elapsed, tree=None, stats=None):
+        self.plan = plan
+        self.status = status
+        self.nodes = nodes
+        self.depth = depth
+        self.elapsed = elapsed
+        self.tree = tree
+        self.stats = stats
+
+    def __str__(self):
+        return f"<PlanResult {self.status}>"
+
+    def __repr__(self):
+        return f"PlanResult(plan={self.plan}, status={self.status!r}, " + \
+               f"nodes={self.nodes}, depth={self.depth}, elapsed={self.elapsed})"
+
+
+def find_plan(state, todo_list, engine=None, trail=False, transposition_table=None,
+              max_nodes=None, max_depth=None, deadline=None, return_result=False,
+              workers=None, split_depth=2, first_found=False, portfolio=None,
+              restart_nodes=None, plan_cache=None, return_tree=False,
+              method_statistics=None, stats=None, tracer=None):
     """
     find_plan tries to find a plan that accomplishes the items in todo_list,
     starting from the given state, using whatever methods and actions you
     declared previously. If successful, it returns the plan. Otherwise it
     returns False. Arguments:
      - 'state' is a state;
-     - 'todo_list' is a list of goals, tasks, and actions.
+     - 'todo_list' is a list of goals, tasks, and actions;
+     - 'engine' (optional) is 'recursive' or 'iterative'. It defaults to
+       the value of search_engine, or to 'iterative' if any of the options
+       below need the iterative engine.
+     - 'trail' (optional): if it is True, then instead of copying the state
+       for each action, the planner applies the actions to a single working
+       copy of the state and undoes their changes when it backtracks. This
+       requires the iterative engine, and actions that modify only the
+       state-variable dictionaries (see the section on trails below).
+     - 'transposition_table' (optional) is a TranspositionTable in which
+       to remember subproblems that fail, or True to use a new one for this
+       call. This requires the iterative engine.
+     - 'max_nodes' (optional): stop after expanding this many nodes.
+     - 'max_depth' (optional): don't expand nodes whose depth is larger
+       than this; treat them as failures, and go on searching elsewhere.
+     - 'deadline' (optional): stop if the search is still going at this
+       time, given in seconds since the epoch, like time.time().
+     - 'return_result' (optional): if it is True, return a PlanResult that
+       includes the plan (or False), why the search stopped, and how many
+       nodes it expanded, instead of just the plan (or False).
+     - 'workers' (optional) is a number of worker processes in which to
+       search in parallel (see the section on OR-parallel search below).
+       The parent process splits the search at the first 'split_depth'
+       choice points that have more than one applicable method, and the
+       workers search the resulting subproblems. find_plan returns the
+       same plan as without workers, or if 'first_found' is True, the
+       first plan that any worker finds. Each worker uses a new
+       transposition table if 'transposition_table' isn't None, since a
+       table can't be shared between processes. max_nodes can't be used
+       with workers.
+     - 'portfolio' (optional) is a number of searches to run in parallel
+       in worker processes, each with the lists of methods in a different
+       order, or a list of seeds for random.Random, one for each search.
+       The seed None means the order in which the methods were declared,
+       and a number k means the seeds [None, 1, 2, ..., k-1]. find_plan
+       returns the result of the first search that finds a plan or shows
+       that there isn't one, and cancels the others. 'workers' is then the
+       number of worker processes, by default one per search.
+     - 'restart_nodes' (optional): with 'portfolio', a search that hasn't
+       finished after this many nodes starts over with a new random method
+       order and twice as many nodes, and so on.
+     - 'plan_cache' (optional) is a PlanCache in which to look for the
+       result before searching, and to store it afterward (see the section
+       on plan caches below).
+     - 'return_tree' (optional): if it is True, return the plan's
+       DecompositionTree instead of the plan (see the section on
+       decomposition trees below), or False if there is no plan. With
+       return_result, the tree is in the PlanResult. It can't be used with
+       workers, portfolio, plan_cache, or a transposition table that
+       records successes.
+     - 'method_statistics' (optional) is a MethodStatistics in which to
+       count how often each method is tried and succeeds, and which may
+       change the order in which the methods are tried (see the section on
+       method statistics below).
+     - 'stats' (optional) is a SearchStats to which to add the amount of
+       work that the search does, or True to use a new one for this call,
+       which requires return_result. With return_result, the SearchStats
+       is in the PlanResult.
+     - 'tracer' (optional) is a SearchTracer in which to record a span for
+       each method that the search tries (see the section on search
+       tracing). Neither stats nor tracer can be used with workers or
+       portfolio.
+    max_nodes, max_depth, deadline, return_result, workers and portfolio
+    require the iterative engine. Stopping because of max_nodes or deadline
+    isn't an error: find_plan returns False (or a PlanResult whose status
+    tells why).
+    """
+    (search, cache_key, stats) = _start_search(state, todo_list, engine, trail,
+        transposition_table, max_nodes, max_depth, deadline, return_result,
+        workers, split_depth, first_found, portfolio, restart_nodes, plan_cache,
+        return_tree, method_statistics, stats, tracer)
+    if stats != None:
+        cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    if search == None:
+        result = _run_seek_plan(state, todo_list, return_tree, method_statistics,
+                                stats, tracer)
+    else:
+        result = search.run()
+    elapsed = time.perf_counter() - start_time
+    if stats != None:
+        stats.cpu_time += time.process_time() - cpu_start
+    tree = None
+    if return_tree and result != False:
+        tree = _decomposition_tree(state, todo_list, result)
+        result = tree.plan
+    return _finish_search(search, result, elapsed, return_result, plan_cache,
+                          cache_key, tree, stats, tracer)
+
+
+class _SeekOptions(threading.local):
+    """
+    The options that find_plan gives seek_plan: whether to record
+    decomposition trees, and the MethodStatistics, SearchStats and
+    SearchTracer to use, if any. They are kept in a thread-local object,
+    _seek_options, rather than passed down through every recursive call,
+    so find_plan calls that use the recursive engine in different threads
+    (or a find_plan call made by a method or action) don't see each
+    other's options. The iterative engine keeps them in its _SearchEngine
+    instead.
+    """
+    record_trees = False
+    statistics = None
+    stats = None
+    tracer = None
+
+_seek_options = _SeekOptions()
+
+
+def _run_seek_plan(state, todo_list, record_trees, statistics, stats=None, tracer=None):
+    """
+    Call seek_plan for find_plan, with _seek_options set to record_trees,
+    statistics, stats and tracer.
     """
+    if copy_on_write:
+        state = _private_copy(state)
+    options = _seek_options
+    old_options = (options.record_trees, options.statistics, options.stats, options.tracer)
+    (options.record_trees, options.statistics, options.stats, options.tracer) = \
+        (record_trees, statistics, stats, tracer)
+    try:
+        return seek_plan(state, todo_list, [], 0)
+    finally:
+        (options.record_trees, options.statistics, options.stats, options.tracer) = \
+            old_options
+
+
+def _start_search(state, todo_list, engine=None, trail=False, transposition_table=None,
+                  max_nodes=None, max_depth=None, deadline=None, return_result=False,
+                  workers=None, split_depth=2, first_found=False, portfolio=None,
+                  restart_nodes=None, plan_cache=None, return_tree=False,
+                  method_statistics=None, stats=None, tracer=None):
+    """
+    Check find_plan's arguments, report the event that a search is
+    starting, and return a triple (search, cache_key, stats). 'search' is
+    the object that will do the search: a _SearchEngine, _ParallelSearch,
+    _PortfolioSearch, or _CachedSearch, or None for seek_plan. cache_key
+    is the key under which to store the result in plan_cache, or None if
+    it shouldn't be stored. stats is the SearchStats to use, or None.
+    """
+    if transposition_table == True:
+        transposition_table = TranspositionTable()
+    elif transposition_table == False:
+        transposition_table = None
+    iterative_options = [name for (name, value) in (('trail', trail),
+            ('transposition_table', transposition_table), ('max_nodes', max_nodes),
+            ('max_depth', max_depth), ('deadline', deadline),
+            ('return_result', return_result), ('workers', workers),
+            ('portfolio', portfolio))
+            if value is not None and value is not False]
+    if engine == None:
+        engine = 'iterative' if iterative_options else search_engine
+    if engine not in {'recursive', 'iterative'}:
+        raise Exception(f"find_plan: unknown search engine {engine!r}")
+    if iterative_options and engine != 'iterative':
+        raise Exception(f"find_plan: {', '.join(iterative_options)} " + \
+                        f"require the iterative engine")
+    if (workers != None or portfolio != None) and max_nodes != None:
+        raise Exception("find_plan: max_nodes can't be used with workers or portfolio")
+    if restart_nodes != None and portfolio == None:
+        raise Exception("find_plan: restart_nodes requires portfolio")
+    if return_tree and (workers != None or portfolio != None or plan_cache != None
+                        or (transposition_table != None
+                            and transposition_table.record_successes)):
+        raise Exception("find_plan: return_tree can't be used with workers, " + \
+                        "portfolio, plan_cache or record_successes")
+    if method_statistics != None:
+        if workers != None or portfolio != None:
+            raise Exception("find_plan: method_statistics can't be used with " + \
+                            "workers or portfolio")
+        if plan_cache != None and not method_statistics.stable:
+            raise Exception("find_plan: method_statistics can't be used with " + \
+                            "plan_cache unless it is stable")
+        method_statistics._begin(current_domain)
+    if stats == True:
+        if not return_result:
+            raise Exception("find_plan: stats=True requires return_result=True, " + \
+                            "which returns the new SearchStats in the PlanResult")
+        stats = SearchStats()
+    elif stats == False:
+        stats = None
+    if stats != None and (workers != None or portfolio != None):
+        raise Exception("find_plan: stats can't be used with workers or portfolio")
+    if tracer != None and (workers != None or portfolio != None):
+        raise Exception("find_plan: tracer can't be used with workers or portfolio")
     if verbose >= 1: 
-        todo_string = '[' + ', '.join([_item_to_string(x) for x in todo_list]) + ']'
-        log_event(f'The robot is now attempting to find a plan starting from state {state.__name__} and trying to achieve the following todo_list: {todo_string}')
-    result = seek_plan(state, todo_list, [], 0)
+        emit_event(1, 'find_plan', 'The robot is now attempting to find a plan starting ' + \
+                   'from state {state.__name__} and trying to achieve the following ' + \
+                   'todo_list: {todo_list!t}', state=state, todo_list=list(todo_list))
+    if tracer != None:
+        tracer._start(todo_list)
+    cache_key = None
+    if plan_cache != None:
+        cache_key = plan_cache.key(state, todo_list, max_depth)
+        entry = plan_cache.lookup(cache_key)
+        if entry != None:
+            if verbose >= 2:
+                emit_event(2, 'plan_cache_hit', "Found the result in the plan cache.")
+            return (_CachedSearch(entry), None, stats)
+        if portfolio != None or (workers != None and first_found):
+            cache_key = None    # the result depends on timing
+    if portfolio != None:
+        if isinstance(portfolio, int):
+            portfolio = [None] + list(range(1, portfolio))
+        search = _PortfolioSearch(state, todo_list, portfolio,
+                                  workers if workers != None else len(portfolio),
+                                  restart_nodes=restart_nodes, trail=trail,
+                                  transposition_table=transposition_table,
+                                  max_depth=max_depth, deadline=deadline)
+    elif workers != None:
+        search = _ParallelSearch(state, todo_list, workers, split_depth=split_depth,
+                                 first_found=first_found, trail=trail,
+                                 transposition_table=transposition_table,
+                                 max_depth=max_depth, deadline=deadline)
+    elif engine == 'iterative':
+        search = _SearchEngine(state, todo_list, trail=trail,
+                               transposition_table=transposition_table,
+                               max_nodes=max_nodes, max_depth=max_depth,
+                               deadline=deadline, record_tree=return_tree,
+                               statistics=method_statistics, stats=stats,
+                               tracer=tracer)
+    else:
+        search = None
+    return (search, cache_key, stats)
+
+
+def _finish_search(search, result, elapsed, return_result, plan_cache=None,
+                   cache_key=None, tree=None, stats=None, tracer=None):
+    """
+    Report find_plan's verbose events about the result of 'search' (the
+    object returned by _start_search), let the EventBuses in event_sinks
+    deliver them, store the result in plan_cache under cache_key if that
+    isn't None, and return what find_plan returns. 'tree' is the plan's
+    DecompositionTree if find_plan should return it, and stats is the
+    SearchStats to which to add the search's nodes and time, or None.
+    If tracer isn't None, end the spans that are still open in it.
+    """
+    if stats != None:
+        stats.calls += 1
+        stats.wall_time += elapsed
+        if search != None:
+            # seek_plan counts its own nodes
+            stats.nodes += search.nodes
+            stats.max_depth = max(stats.max_depth, search.depth)
+    if search == None:
+        status = 'success' if result is not False else 'failure'
+    else:
+        status = search.status
+    if tracer != None:
+        tracer._finish(status)
+    if cache_key != None and status in {'success', 'failure', 'max_depth'}:
+        plan_cache.store(cache_key, status, result)
     if verbose >= 1:
-        if result is False:
-            log_event("Could not find any plan.")
+        if search != None and search.status in {'max_nodes', 'deadline'}:
+            emit_event(1, 'search_stopped',
+                       "Stopped searching ({status}) after {nodes} nodes.",
+                       status=search.status, nodes=search.nodes)
+        elif result is False:
+            emit_event(1, 'no_plan', "Could not find any plan.")
         else:
             if len(result) == 0:
-                log_event("The plan is empty. This means the goal is satisfied.")
+                emit_event(1, 'plan_found',
+                           "The plan is empty. This means the goal is satisfied.",
+                           plan=result)
             else:
-                log_event(f"Here is the plan: {result}\n")
+                emit_event(1, 'plan_found', "Here is the plan: {plan}\n", plan=result)
+        if search != None and search.table != None:
+            emit_event(1, 'statistics', "Statistics for the {summary}",
+                       summary=search.table.summary())
+        if plan_cache != None:
+            emit_event(1, 'statistics', "Statistics for the {summary}",
+                       summary=plan_cache.summary())
+    _flush_event_buses()
+    if return_result:
+        return PlanResult(result, search.status, search.nodes, search.depth, elapsed,
+                          tree, stats)
+    elif tree != None:
+        return tree
     return result
 
 
+async def find_plan_async(state, todo_list, yield_nodes=1000, **options):
+    """
+    find_plan_async is a version of find_plan for programs that use asyncio.
+    It takes the same arguments as find_plan and returns the same result,
+    but it is a coroutine that lets the event loop run other tasks every
+    yield_nodes nodes, instead of blocking the loop until the search is over.
+    Cancelling the task that runs it stops the search, ends the spans that
+    are open in the tracer, if any, with the status 'cancelled', and lets
+    the EventBuses in event_sinks deliver their events. It always uses the
+    iterative engine, and it doesn't support the 'workers' and 'portfolio'
+    options; to use those without blocking the loop, call find_plan with
+    loop.run_in_executor. If return_result is True, the PlanResult's elapsed
+    time includes only the time spent searching.
+    """
+    # asyncio is imported here rather than at the top of the file, since
+    # most programs that use GTPyhop don't need it
+    import asyncio
+    for name in ('workers', 'portfolio'):
+        if options.get(name) != None:
+            raise Exception(f"find_plan_async: {name} isn't supported")
+    if options.get('engine') == 'recursive':
+        raise Exception("find_plan_async: it requires the iterative engine")
+    options['engine'] = 'iterative'
+    (search, cache_key, stats) = _start_search(state, todo_list, **options)
+    max_nodes = search.max_nodes
+    elapsed = 0
+    cpu_time = 0
+    done = False
+    try:
+        while True:
+            limit = search.nodes + yield_nodes
+            if max_nodes != None and max_nodes < limit:
+                limit = max_nodes
+            search.max_nodes = limit
+            start_time = time.perf_counter()
+            cpu_start = time.process_time()
+            result = search.run()
+            elapsed += time.perf_counter() - start_time
+            cpu_time += time.process_time() - cpu_start
+            if search.status != 'max_nodes' or search.nodes == max_nodes:
+                break
+            await asyncio.sleep(0)
+        done = True
+    finally:
+        if not done:
+            # The task was cancelled (or the search raised an exception), so
+            # _finish_search won't be called: end the tracer's open spans,
+            # and let the EventBuses deliver the events reported so far.
+            if options.get('tracer') != None:
+                options['tracer']._finish('cancelled')
+            _flush_event_buses()
+    search.max_nodes = max_nodes
+    if stats != None:
+        stats.cpu_time += cpu_time
+    tree = None
+    if options.get('return_tree') and result != False:
+        tree = _decomposition_tree(state, todo_list, result)
+        result = tree.plan
+    return _finish_search(search, result, elapsed, options.get('return_result', False),
+                          options.get('plan_cache'), cache_key, tree, stats,
+                          options.get('tracer'))
+
+
 def pyhop(state, todo_list):
     if verbose > 0:
         log_event("""
@@ -842,25 +2884,44 @@ def seek_plan(state, todo_list, plan, depth):
      - todo_list is the current list of goals, tasks, and actions
      - plan is the current partial plan
      - depth is the recursion depth, for use in debugging
+    seek_plan converts todo_list and plan to persistent lists, calls
+    _seek_plan, and converts the resulting plan back to a Python list.
+    """
+    result = _seek_plan(state, _push_items(todo_list, ()), \
+                        _push_items(plan[::-1], ()), depth)
+    if result == False or result == None:
+        return False
+    return _plan_to_list(result)
+
+
+def _seek_plan(state, todo_list, plan, depth):
     """
+    Recursive part of seek_plan. It takes the same arguments, except that
+    todo_list and plan are persistent lists, and it returns a persistent
+    plan (or False).
+    """
+    todo_list = _skip_markers(state, todo_list)
+    stats = _seek_options.stats
+    if stats != None:
+        stats._node(depth)
     if verbose >= 2: 
-        todo_string = '[' + ', '.join([_item_to_string(x) for x in todo_list]) + ']'
-        log_event(f'depth {depth} todo_list ' + todo_string)
-    if todo_list == []:
+        emit_event(2, 'todo_list', _TODO_LIST, depth=depth, todo_list=todo_list)
+    if todo_list == ():
         if verbose >= 3:
-            log_event(f'depth {depth} no more tasks or goals, return plan')
+            emit_event(3, 'todo_list_done', _TODO_LIST_DONE, depth=depth)
         return plan
-    item1 = todo_list[0]
-    ttype = get_type(item1)
-    if ttype in {'Multigoal'}:
-        return _refine_multigoal_and_continue(state, item1, todo_list[1:], plan, depth)
-    elif ttype in {'list','tuple'}:
-        if item1[0] in current_domain._action_dict:
-            return _apply_action_and_continue(state, item1, todo_list[1:], plan, depth)
-        elif item1[0] in current_domain._task_method_dict:
-            return _refine_task_and_continue(state, item1, todo_list[1:], plan, depth)
-        elif item1[0] in current_domain._unigoal_method_dict:
-            return _refine_unigoal_and_continue(state, item1, todo_list[1:], plan, depth)
+    (item1, todo_list) = todo_list
+    kind = current_domain._classify(item1)
+    if kind != None:
+        kind = kind[0]
+    if kind == 'action':
+        return _apply_action_and_continue(state, item1, todo_list, plan, depth)
+    elif kind == 'task':
+        return _refine_task_and_continue(state, item1, todo_list, plan, depth)
+    elif kind == 'unigoal':
+        return _refine_unigoal_and_continue(state, item1, todo_list, plan, depth)
+    elif kind == 'multigoal':
+        return _refine_multigoal_and_continue(state, item1, todo_list, plan, depth)
     raise Exception(    \
         f"depth {depth}: {item1} isn't an action, task, unigoal, or multigoal\n")
     return False
@@ -877,11 +2938,2144 @@ def _item_to_string(item):
         return str(item)
 
 
+############################################################
+# Trails, for searching with a single state that is modified in place
+#
+# When find_plan is called with trail=True, _SearchEngine applies actions to
+# one working copy of the state instead of copying the state for each action.
+# The working state is watched (see the section on fingerprints above), and
+# each of its writes is recorded on a trail as a triple
+#       (dictionary, key, old value),
+# where old value is _NO_VALUE if the key wasn't there before. A replacement
+# of a whole state variable (e.g., s.pos = {...}) is recorded with the state
+# itself in place of the dictionary. To backtrack to a choice point, the
+# engine undoes the trail entries made since then. Changes that are made
+# inside a state variable's values, or to a state variable that isn't a
+# dictionary (e.g., s.packages.add(x)), can't be detected and won't be
+# undone, so actions that do that should be used with trail=False.
+
+
+def _trailed_copy(state, trail):
+    """
+    Return a watched copy of state that records its changes on 'trail'.
+    """
+    the_copy = copy.deepcopy(state)
+    the_copy._trail = trail
+    _watch_dicts(the_copy)
+    return the_copy
+
+
+def _adopt_vars(state, other):
+    """
+    Give the trailed state the same state variables and values as the state
+    'other', recording the changes on the trail.
+    """
+    for varname in [v for v in vars(state) if v not in vars(other)]:
+        delattr(state, varname)
+    for (varname,val) in vars(other).items():
+        if varname != '__name__':
+            setattr(state, varname, val)
+
+
+def _undo_trail(trail, mark):
+    """Undo the changes recorded on the trail after its first 'mark' entries"""
+    while len(trail) > mark:
+        (target, key, old) = trail.pop()
+        if type(target) is _WatchedDict:
+            target._restore(key, old)
+        else:
+            _replace_var(target, key, old, record=False)
+
+
+############################################################
+# Transposition tables
+#
+# Different method choices can lead the search to the same subproblem, i.e.,
+# the same state and the same remaining todo_list. Since the outcome of a
+# subproblem doesn't depend on how the search got there, a transposition
+# table can remember which subproblems have failed, so that _SearchEngine
+# doesn't search them again.
+
+
+class TranspositionTable():
+    """
+    t = TranspositionTable(max_entries, record_successes) creates a bounded
+    table of subproblems that find_plan has solved or failed to solve. To use
+    it, call find_plan(state, todo_list, transposition_table=t). The same
+    table may be passed to several calls, as long as they use the same
+    domain and the domain's methods and actions don't change in between;
+    otherwise call t.clear() first.
+      - max_entries is the maximum number of subproblems to remember. When
+        the table is full, the least recently used entry is discarded.
+      - If record_successes is True, then when find_plan finds a plan, the
+        table also remembers the rest of the plan for each subproblem that
+        was being refined at the time, so that a later call that reaches
+        the same subproblem can reuse it.
+
+    A subproblem is identified by the state's fingerprint (see
+    State.fingerprint) plus the remaining todo_list. Both are hashed
+    incrementally (the todo_list is made of _HashedCells), so computing a
+    key takes constant time, whatever the sizes of the state and the
+    todo_list. In the unlikely event that two different states that
+    have the same todo_list also have the same fingerprint, the table will
+    give the wrong answer for one of them. The counters t.hits, t.misses,
+    t.stores and t.evictions tell how useful the table has been.
+    """
+
+    def __init__(self, max_entries=100000, record_successes=False):
+        self.max_entries = max_entries
+        self.record_successes = record_successes
+        # maps each key to False (the subproblem failed) or to a tuple of the
+        # actions that accomplish it
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return f"<TranspositionTable with {len(self._entries)} entries>"
+
+    def __repr__(self):
+        return f"TranspositionTable(max_entries={self.max_entries}, " + \
+               f"record_successes={self.record_successes})"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget all entries and reset the counters"""
+        self._entries.clear()
+        self.hits = self.misses = self.stores = self.evictions = 0
+
+    def lookup(self, key):
+        """
+        Return False if the subproblem 'key' is known to fail, a tuple of
+        actions if it is known to succeed, and None if it isn't known.
+        """
+        entry = self._entries.get(key)
+        if entry == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, entry):
+        """Remember that subproblem 'key' has the outcome 'entry'"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.stores += 1
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        """Return a one-line summary of the table's counters"""
+        return f"transposition table: {self.hits} hits, {self.misses} misses, " + \
+               f"{self.stores} stores, {self.evictions} evictions, " + \
+               f"{len(self._entries)} entries"
+
+
+############################################################
+# Plan caches
+#
+# A PlanCache remembers the results of calls to find_plan, so that a later
+# call for the same problem can return the same result without searching.
+# Unlike a transposition table, which is only used within a search and is
+# keyed by the process-local fingerprints described earlier, a plan cache
+# may be kept on disk and shared by several processes, so its keys are
+# digests of canonical descriptions of the state, the todo_list and the
+# domain. Computing a key costs time proportional to the size of the state.
+
+
+def _canonical(value):
+    """
+    Return a string that describes 'value' in the same way in every Python
+    process: the items of dictionaries and sets are sorted, and states and
+    multigoals are described by their state variables but not their names,
+    code objects (e.g., of lambdas and inner functions, which are among the
+    constants of the code of the functions that contain them) by their
+    contents, and functions by their qualified names. Other values are
+    described by repr(), so values whose repr() contains a memory address
+    (e.g., instances of classes that don't define __repr__) will give
+    different strings in different processes.
+    """
+    if isinstance(value, (State, Multigoal)):
+        state_vars = vars(value)
+        return type(value).__name__ + _canonical({name: state_vars[name]
+            for name in state_vars if name not in _NOT_STATE_VARS})
+    elif isinstance(value, (dict, MutableMapping)):
+        return '{' + ', '.join(sorted(f'{_canonical(k)}: {_canonical(v)}'
+                                      for (k, v) in value.items())) + '}'
+    elif isinstance(value, (set, frozenset)):
+        return type(value).__name__ + \
+               '{' + ', '.join(sorted(_canonical(x) for x in value)) + '}'
+    elif isinstance(value, (tuple, list)):
+        return type(value).__name__ + \
+               '(' + ', '.join(_canonical(x) for x in value) + ')'
+    elif isinstance(value, types.CodeType):
+        return f'code {value.co_name}(' + repr(value.co_code) + ', ' + \
+               _canonical(value.co_consts) + ', ' + repr(value.co_names) + ')'
+    elif isinstance(value, types.FunctionType):
+        return f'function {value.__module__}.{value.__qualname__}'
+    return repr(value)
+
+
+def _function_id(f):
+    """
+    Return a string that identifies the function f by its name, code and
+    closure variables.
+    """
+    code = getattr(f, '__code__', None)
+    if code == None:
+        return _canonical(f)
+    cells = [_canonical(cell.cell_contents) for cell in (f.__closure__ or ())]
+    return f'{f.__module__}.{f.__qualname__}.{f.__name__}:' + \
+           _digest(repr((code.co_code, _canonical(code.co_consts), code.co_names,
+                         cells)))
+
+
+def _digest(text):
+    """Return a short hexadecimal digest of the string 'text'"""
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class PlanCache():
+    """
+    c = PlanCache(max_entries, directory) creates a cache of find_plan's
+    results. To use it, call find_plan(state, todo_list, plan_cache=c). If
+    c has the result of an earlier call for the same problem, find_plan
+    returns a copy of it without searching; otherwise it searches, and then
+    stores the result in c.
+      - max_entries is the maximum number of results to keep in memory. When
+        there are more, the least recently used one is discarded.
+      - If directory isn't None, c also keeps every result in an on-disk
+        cache in that directory, using the diskcache package, so that it is
+        available to later Python processes and to other processes that use
+        the same directory.
+
+    Two calls are for the same problem if their states have the same state
+    variables (their names don't matter), their todo_lists are the same,
+    the domain's actions, methods and guards are the same (see
+    Domain._get_version), and verify_goals, split_multigoal_order and
+    find_plan's max_depth argument have the same values. Stopping because
+    of max_nodes or deadline doesn't give a result to store, and neither do
+    searches whose result depends on timing (with portfolio, or with
+    workers and first_found=True). The counters c.hits, c.disk_hits,
+    c.misses, c.stores and c.evictions tell how useful the cache has been,
+    and c.hit_rate() is the fraction of lookups that found a result.
+    """
+
+    def __init__(self, max_entries=1000, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        # maps each key to a pair (status, plan), where status is 'success',
+        # 'failure' or 'max_depth', and plan is a tuple of actions or False
+        self._entries = OrderedDict()
+        self._disk = None
+        if directory != None:
+            import diskcache
+            self._disk = diskcache.Cache(directory)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return f"<PlanCache with {len(self._entries)} entries>"
+
+    def __repr__(self):
+        return f"PlanCache(max_entries={self.max_entries}, " + \
+               f"directory={self.directory!r})"
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget all entries, including the ones on disk, and reset the counters"""
+        self._entries.clear()
+        if self._disk != None:
+            self._disk.clear()
+        self.hits = self.disk_hits = self.misses = self.stores = self.evictions = 0
+
+    def key(self, state, todo_list, max_depth=None, domain=None):
+        """
+        Return the key for planning for todo_list from 'state' in 'domain'
+        (by default, current_domain) with the given max_depth.
+        """
+        if domain == None:
+            domain = current_domain
+        order = split_multigoal_order
+        return _digest(repr((domain._get_version(), verify_goals,
+                             _function_id(order) if order != None else None,
+                             max_depth, _canonical(state), _canonical(list(todo_list)))))
+
+    def lookup(self, key):
+        """
+        Return the pair (status, plan) stored for 'key', or None if there
+        isn't one.
+        """
+        entry = self._entries.get(key)
+        if entry != None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        if self._disk != None:
+            entry = self._disk.get(key)
+            if entry != None:
+                self.disk_hits += 1
+                self._remember(key, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, status, plan):
+        """Remember that searching for 'key' gave 'status' and 'plan'"""
+        entry = (status, tuple(plan) if plan != False else False)
+        self._remember(key, entry)
+        if self._disk != None:
+            self._disk[key] = entry
+        self.stores += 1
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        """Return the fraction of lookups that found a result, or 0 if there were none"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0
+
+    def summary(self):
+        """Return a one-line summary of the cache's counters"""
+        return f"plan cache: {self.hits} hits, {self.disk_hits} disk hits, " + \
+               f"{self.misses} misses ({100*self.hit_rate():.1f}% hit rate), " + \
+               f"{self.stores} stores, {self.evictions} evictions, " + \
+               f"{len(self._entries)} entries in memory"
+
+
+class _CachedSearch():
+    """
+    What _start_search returns in place of a search if a PlanCache has the
+    result. Its run() method returns a copy of the cached plan.
+    """
+
+    def __init__(self, entry):
+        (self.status, self.plan) = entry
+        self.nodes = 0
+        self.depth = 0
+        self.max_nodes = None
+        self.table = None
+
+    def run(self):
+        return list(self.plan) if self.plan != False else False
+
+
+############################################################
+# Method statistics
+#
+# The order in which a task's or goal's methods are declared is the order in
+# which the planner tries them. If one of them usually fails in a particular
+# workload, putting it last can save much of the search, but the best order
+# is hard to know in advance. A MethodStatistics object counts how each
+# method fares over many calls to find_plan, and unless it is 'stable', it
+# makes find_plan try the methods that have succeeded most often first.
+#
+# The counts for a method are the number of times the planner called it
+# (attempts), and the number of times it was applicable, i.e., returned a
+# list of subtasks or subgoals. A method that was applicable either
+# succeeded (its subtasks and subgoals are part of the plan that find_plan
+# returned) or was backtracked over. A method is ranked by its estimated
+# success rate (successes + 1) / (attempts + 2), which is 1/2 for a method
+# that hasn't been tried. The ranks are computed when find_plan starts, so
+# the order doesn't change during a search.
+
+
+class MethodStatistics():
+    """
+    s = MethodStatistics(filename, stable) collects statistics about how
+    often each method is tried and succeeds. To use it, call
+    find_plan(state, todo_list, method_statistics=s); the same s may be
+    passed to any number of calls, for any number of domains.
+      - If stable is False, find_plan tries the relevant methods for each
+        task and goal in decreasing order of their success rates, and methods
+        that have the same rate in the order they were declared. If stable is
+        True, it keeps the declared order, for domains in which the order
+        means something (e.g., a fallback method that should only be used if
+        the others fail), and s only collects the statistics.
+      - If filename isn't None and the file exists, s starts with the
+        statistics in it, as saved by s.save(). Methods are identified in
+        the file by their modules and qualified names.
+
+    s.counts(method) is a tuple (attempts, successes, backtracks) for the
+    method, and s.display() prints the counts for all the methods.
+    method_statistics can't be used with workers or portfolio, since the
+    methods are then called in other processes, and if stable is False, it
+    can't be used with plan_cache, since the cached plans may have been
+    found with a different order.
+    """
+
+    def __init__(self, filename=None, stable=False):
+        self.filename = filename
+        self.stable = stable
+        # maps each method that has been counted to a list
+        # [attempts, applicable, successes]
+        self._counts = {}
+        # maps the names (see _method_name) of the methods in the file that
+        # haven't been counted yet to their lists of counts
+        self._saved = {}
+        # maps each method to its success rate when the current search began
+        self._rates = {}
+        if filename != None and os.path.exists(filename):
+            with open(filename) as f:
+                self._saved = json.load(f)
+
+    def __str__(self):
+        return f"<MethodStatistics for {len(self._counts) + len(self._saved)} methods>"
+
+    def __repr__(self):
+        return f"MethodStatistics(filename={self.filename!r}, stable={self.stable})"
+
+    def clear(self):
+        """Forget all of the counts, including the ones read from the file"""
+        self._counts.clear()
+        self._saved.clear()
+        self._rates.clear()
+
+    def counts(self, method):
+        """Return (attempts, successes, backtracks) for 'method'"""
+        (attempts, applicable, successes) = self._peek(method)
+        return (attempts, successes, applicable - successes)
+
+    def success_rate(self, method):
+        """Return the estimated success rate that is used to rank 'method'"""
+        (attempts, applicable, successes) = self._peek(method)
+        return (successes + 1) / (attempts + 2)
+
+    def save(self, filename=None):
+        """
+        Write the counts to filename, or if it is None, to the file given
+        when s was created.
+        """
+        if filename == None:
+            filename = self.filename
+        if filename == None:
+            raise Exception("MethodStatistics.save: there is no filename")
+        data = dict(self._saved)
+        for (method, counts) in self._counts.items():
+            data[_method_name(method)] = counts
+        with open(filename, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+
+    def summary(self):
+        """Return a one-line summary of the counts"""
+        totals = [sum(c[i] for c in self._counts.values()) for i in range(3)]
+        return f"method statistics: {len(self._counts)} methods, " + \
+               f"{totals[0]} attempts, {totals[2]} successes, " + \
+               f"{totals[1] - totals[2]} backtracks"
+
+    def display(self):
+        """
+        Print the counts and success rates for the methods that have been
+        counted since s was created, highest success rate first.
+        """
+        lines = [f"{'method':<40} {'attempts':>9} {'successes':>10} " + \
+                 f"{'backtracks':>11} {'rate':>6}"]
+        for method in sorted(self._counts, key=self.success_rate, reverse=True):
+            (attempts, successes, backtracks) = self.counts(method)
+            lines.append(f"{method.__name__:<40} {attempts:>9} {successes:>10} " + \
+                         f"{backtracks:>11} {self.success_rate(method):>6.3f}")
+        log_event('\n'.join(lines))
+
+    def _peek(self, method):
+        """Return the list of counts for 'method', without creating one"""
+        counts = self._counts.get(method)
+        if counts == None:
+            counts = self._saved.get(_method_name(method), [0, 0, 0])
+        return counts
+
+    def _get(self, method):
+        """Return the list of counts for 'method', creating it if need be"""
+        counts = self._counts.get(method)
+        if counts == None:
+            counts = self._saved.pop(_method_name(method), [0, 0, 0])
+            self._counts[method] = counts
+        return counts
+
+    def _begin(self, domain):
+        """
+        Called when a search in 'domain' begins: compute the success rates
+        that _ordered uses.
+        """
+        self._rates = {}
+        if self.stable:
+            return
+        for methods in [*domain._task_method_dict.values(),
+                        *domain._unigoal_method_dict.values(),
+                        domain._multigoal_method_list]:
+            for method in methods:
+                self._rates[method] = self.success_rate(method)
+
+    def _ordered(self, methods):
+        """
+        Return the list 'methods' in the order in which the search should try
+        them.
+        """
+        if self.stable or len(methods) < 2:
+            return methods
+        return sorted(methods, key=lambda m: -self._rates.get(m, 0.5))
+
+    def _tried(self, method, subitems):
+        """Count a call to 'method' that returned 'subitems'"""
+        counts = self._get(method)
+        counts[0] += 1
+        if subitems != False and subitems != None:
+            counts[1] += 1
+
+    def _succeeded(self, method):
+        """Count a success for 'method', which must have been applicable"""
+        self._get(method)[2] += 1
+
+
+def _method_name(method):
+    """Return the name by which MethodStatistics files identify 'method'"""
+    return f'{method.__module__}.{method.__qualname__}'
+
+
+
+############################################################
+# Search statistics
+#
+# find_plan(..., stats=s) adds up how much work the search did in the
+# SearchStats s. The search engines keep the counts only if they are given a
+# SearchStats, and otherwise each count costs them one comparison with None.
+
+
+class SearchStats():
+    """
+    s = SearchStats() is a record of how much work find_plan did. To use it,
+    call find_plan(state, todo_list, stats=s). find_plan adds each call's
+    work to s, so the same s may be passed to several calls to total their
+    work; or call find_plan(..., stats=True, return_result=True) to get a new
+    SearchStats for the call as r.stats. The counts are:
+      - s.calls: the number of calls to find_plan;
+      - s.nodes: the number of nodes expanded (see PlanResult);
+      - s.actions: the number of actions that were applied successfully;
+      - s.method_calls: a dictionary that maps each method's name to the
+        number of times it was called;
+      - s.backtracks: the number of times the search went back to a task,
+        unigoal or multigoal to try its next method, after the one that it
+        tried last had failed;
+      - s.max_depth: the largest depth of any of the nodes;
+      - s.state_copies: the number of copies of the state that the search
+        made (one for each action that it tried, unless trail=True);
+      - s.wall_time and s.cpu_time: the number of seconds that the searches
+        took, according to time.perf_counter and time.process_time.
+    s.summary() returns a one-line summary of the counts, and s.display()
+    prints them. stats can't be used with workers or portfolio, since the
+    search then happens in other processes. find_plans(..., stats=True)
+    returns a separate SearchStats for each problem.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Set all of the counts to 0"""
+        self.calls = 0
+        self.nodes = 0
+        self.actions = 0
+        self.backtracks = 0
+        self.max_depth = 0
+        self.state_copies = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        # maps each method that has been called to the number of calls
+        self._method_calls = {}
+
+    @property
+    def method_calls(self):
+        calls = {}
+        for (method, n) in self._method_calls.items():
+            calls[method.__name__] = calls.get(method.__name__, 0) + n
+        return calls
+
+    def __str__(self):
+        return f"<{self.summary()}>"
+
+    def __repr__(self):
+        return f"SearchStats(calls={self.calls}, nodes={self.nodes}, " + \
+               f"actions={self.actions}, backtracks={self.backtracks}, " + \
+               f"max_depth={self.max_depth}, state_copies={self.state_copies}, " + \
+               f"wall_time={self.wall_time}, cpu_time={self.cpu_time})"
+
+    def summary(self):
+        """Return a one-line summary of the counts"""
+        return f"search statistics: {self.calls} calls, {self.nodes} nodes, " + \
+               f"{self.actions} actions, {sum(self._method_calls.values())} method " + \
+               f"calls, {self.backtracks} backtracks, max depth {self.max_depth}, " + \
+               f"{self.state_copies} state copies, {self.wall_time:.3f} s wall time, " + \
+               f"{self.cpu_time:.3f} s CPU time"
+
+    def display(self):
+        """Print the counts, and the number of calls of each method"""
+        lines = [self.summary()]
+        calls = self.method_calls
+        if calls:
+            lines.append(f"{'method':<40} {'calls':>9}")
+            for name in sorted(calls, key=calls.get, reverse=True):
+                lines.append(f"{name:<40} {calls[name]:>9}")
+        log_event('\n'.join(lines))
+
+    def _called(self, method):
+        """Count a call to 'method'"""
+        calls = self._method_calls
+        calls[method] = calls.get(method, 0) + 1
+
+    def _node(self, depth):
+        """Count a node at the given depth"""
+        self.nodes += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+
+
+############################################################
+# Search tracing
+#
+# find_plan(..., tracer=t) records in the SearchTracer t a span for each
+# attempt to refine a task, unigoal or multigoal with a method. A span that
+# succeeds ends when the todo_list reaches a _SpanEnd marker, which the
+# search engines push after the method's subtasks and subgoals in the same
+# way as a verification marker. A span that fails ends when the search
+# backtracks past it. The engines keep the path of spans that are open at
+# each node as a persistent list, like the plan, so that backtracking to a
+# choice point can restore the path that was open there.
+
+
+class SearchTracer():
+    """
+    t = SearchTracer(filename, format, min_duration, max_spans) records where find_plan
+    spends its time, including in the parts of the search that failed. To
+    use it, call find_plan(state, todo_list, tracer=t) (the same t may be
+    passed to several calls), and then t.save().
+
+    t records a span for each call to find_plan, and for each attempt to
+    refine a task, unigoal or multigoal with a method. An attempt's span
+    starts when the method is called, and ends with the status 'success'
+    when the subtasks and subgoals that the method returned have been
+    accomplished, 'failed' when the search backtracks past it, or 'not
+    applicable'. When the search backtracks into the subtasks of a span that
+    has already ended, to try another method for one of them, the span is
+    resumed as a new span with the same name. Time spent applying actions
+    and calling methods counts toward the innermost open span.
+      - filename is the file that t.save() writes.
+      - If format is 'chrome', t.save() writes Chrome's trace-event JSON
+        format, for chrome://tracing or https://ui.perfetto.dev, with an
+        event for each span that lasted at least min_duration seconds.
+        Spans are stored until t.save() is called, so to bound t's memory,
+        it keeps only the max_spans longest of them (or all of them, if
+        max_spans is None), and counts the others in t.discarded. For long
+        searches, min_duration also keeps the fast spans out.
+      - If format is 'collapsed', t.save() writes the collapsed-stack
+        format of flamegraph.pl and speedscope: a line for each different
+        stack of spans, with the number of microseconds spent in its
+        innermost span but not in that span's children. t adds up the
+        times as the spans end, so its memory doesn't grow with the number
+        of spans.
+    tracer can't be used with workers or portfolio, since the search then
+    happens in other processes.
+    """
+
+    def __init__(self, filename=None, format='chrome', min_duration=0.0, max_spans=100000):
+        if format not in {'chrome', 'collapsed'}:
+            raise Exception(f"SearchTracer: unknown format {format!r}")
+        self.filename = filename
+        self.format = format
+        self.min_duration = min_duration
+        self.max_spans = max_spans
+        self._origin = time.perf_counter()
+        # the number of spans that have ended
+        self.spans = 0
+        # maps each stack of spans, identified by a key (parent stack,
+        # kind, item name, method), to an index in _stacks
+        self._stack_ids = {}
+        self._stacks = []
+        # the self time of each stack, by index
+        self._self_times = []
+        # with format='chrome', a heap of the spans to save, shortest first:
+        # (duration, number, frame, start, status), where number is the
+        # span's number in t.spans, so that no two spans compare equal
+        self._spans = [] if format == 'chrome' else None
+        # the number of spans that weren't saved because of max_spans
+        self.discarded = 0
+        # the path of open spans in the search, as a persistent list of
+        # _TraceFrames, innermost first
+        self.path = ()
+        # the open spans, outermost first: [frame, start, time in children]
+        self._open = []
+
+    def __str__(self):
+        return f"<{self.summary()}>"
+
+    def __repr__(self):
+        return f"SearchTracer({self.filename!r}, {self.format!r}, {self.min_duration}, " + \
+               f"{self.max_spans})"
+
+    def summary(self):
+        """Return a one-line summary of what t has recorded"""
+        return f"search tracer: {self.spans} spans, {len(self._stacks)} stacks, " + \
+               f"{self.discarded} discarded"
+
+    def _frame(self, kind, name, method):
+        """Return a _TraceFrame for a span inside the innermost open one"""
+        if self.path == ():
+            (parent, depth) = (None, 0)
+        else:
+            parent = self.path[0]
+            (parent, depth) = (parent.stack, parent.depth + 1)
+        key = (parent, kind, name, method)
+        stack = self._stack_ids.get(key)
+        if stack == None:
+            stack = self._stack_ids[key] = len(self._stacks)
+            self._stacks.append(key)
+            self._self_times.append(0.0)
+        return _TraceFrame(kind, name, method, depth, stack)
+
+    def _begin(self, item, kind, method):
+        """Start a span for refining item with method, and return its frame"""
+        name = item.__name__ if kind == 'multigoal' else item[0]
+        frame = self._frame(kind, name, method)
+        frame.item = item
+        self.path = (frame, self.path)
+        self._open.append([frame, time.perf_counter(), 0.0])
+        return frame
+
+    def _end(self, status):
+        """End the innermost open span"""
+        (frame, start, child_time) = self._open.pop()
+        self.path = self.path[1]
+        self._close(frame, start, child_time, status, time.perf_counter())
+
+    def _close(self, frame, start, child_time, status, now):
+        """Record a span that has ended, whose frame has been popped from _open"""
+        duration = now - start
+        self.spans += 1
+        self._self_times[frame.stack] += duration - child_time
+        if self._open:
+            self._open[-1][2] += duration
+        if self._spans != None and duration >= self.min_duration:
+            span = (duration, self.spans, frame, start - self._origin, status)
+            if self.max_spans == None or len(self._spans) < self.max_spans:
+                heapq.heappush(self._spans, span)
+            else:
+                heapq.heappushpop(self._spans, span)
+                self.discarded += 1
+
+    def _restore(self, path):
+        """
+        The search has backtracked to a node at which 'path' was the path of
+        open spans. End the spans that aren't in it, and resume the ones in
+        it that have ended.
+        """
+        open_spans = self._open
+        resumed = []
+        while path != ():
+            frame = path[0]
+            if frame.depth < len(open_spans) and open_spans[frame.depth][0] is frame:
+                break
+            resumed.append(frame)
+            path = path[1]
+        keep = path[0].depth + 1 if path != () else 0
+        now = time.perf_counter()
+        while len(open_spans) > keep:
+            (frame, start, child_time) = open_spans.pop()
+            self._close(frame, start, child_time, 'failed', now)
+        for frame in reversed(resumed):
+            open_spans.append([frame, now, 0.0])
+            path = (frame, path)
+        self.path = path
+
+    def _start(self, todo_list):
+        """Start the span for a call to find_plan"""
+        frame = self._frame('find_plan', 'find_plan', None)
+        frame.item = todo_list
+        self.path = (frame, ())
+        self._open = [[frame, time.perf_counter(), 0.0]]
+
+    def _finish(self, status):
+        """End the spans that are still open when find_plan finishes"""
+        now = time.perf_counter()
+        while self._open:
+            (frame, start, child_time) = self._open.pop()
+            self._close(frame, start, child_time, status, now)
+        self.path = ()
+
+    def _stack_names(self, stack):
+        """Return the list of names of the spans in a stack, outermost first"""
+        names = []
+        while stack != None:
+            (stack, kind, name, method) = self._stacks[stack]
+            names.append(name if method == None else f"{name} {method.__name__}")
+        names.reverse()
+        return names
+
+    def save(self, filename=None):
+        """
+        Write what t has recorded to filename, or if it is None, to the file
+        given when t was created.
+        """
+        if filename == None:
+            filename = self.filename
+        if filename == None:
+            raise Exception("SearchTracer.save: there is no filename")
+        if self.format == 'collapsed':
+            with open(filename, 'w') as f:
+                for (stack, self_time) in enumerate(self._self_times):
+                    microseconds = round(self_time * 1e6)
+                    if microseconds > 0:
+                        f.write(';'.join(self._stack_names(stack)) + f" {microseconds}\n")
+            return
+        pid = os.getpid()
+        events = []
+        spans = sorted(self._spans, key=lambda span: span[3])
+        for (duration, _, frame, start, status) in spans:
+            (_, kind, name, method) = self._stacks[frame.stack]
+            if kind == 'find_plan':
+                item = '[' + ', '.join([_item_to_string(x) for x in frame.item]) + ']'
+            else:
+                item = _item_to_string(frame.item)
+            events.append({'name': name if method == None else f"{name} {method.__name__}",
+                           'cat': kind, 'ph': 'X', 'ts': start * 1e6,
+                           'dur': duration * 1e6, 'pid': pid, 'tid': 0,
+                           'args': {'item': item, 'status': status}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _TraceFrame():
+    """
+    A span in a SearchTracer: the kind and name of the item that is being
+    refined, the method, the number of spans outside it, the index of its
+    stack in the tracer, and the item itself.
+    """
+    __slots__ = ('kind', 'name', 'method', 'depth', 'stack', 'item')
+
+    def __init__(self, kind, name, method, depth, stack):
+        self.kind = kind
+        self.name = name
+        self.method = method
+        self.depth = depth
+        self.stack = stack
+        self.item = None
+
+
+class _SpanEnd(tuple):
+    """
+    _SpanEnd((tracer,)) is the marker that ends the innermost open span of
+    the SearchTracer 'tracer' when it reaches the front of a todo_list (see
+    _skip_markers). All _SpanEnd markers are equal, so that todo_lists that
+    contain them can still be found in a TranspositionTable.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is _SpanEnd
+
+    def __ne__(self, other):
+        return type(other) is not _SpanEnd
+
+    def __hash__(self):
+        return hash(_SpanEnd)
+
+    def __repr__(self):
+        return '_span_end()'
+
+    def check(self, state):
+        self[0]._end('success')
+
+
+# The classes of todo_list items that the search engines handle themselves
+# (see _skip_markers)
+_MARKER_TYPES = frozenset({_Verification, _SpanEnd})
+
+
+
+############################################################
+# An iterative search engine
+
+
+class _ChoicePoint():
+    """
+    A choice point on _SearchEngine's stack. It records the node at which a
+    task, unigoal, or multigoal was refined (the state, the item itself, the
+    rest of the todo_list, the partial plan and the depth), together with the
+    relevant methods and the index of the next one to try.
+    """
+    __slots__ = ('state', 'item', 'todo_list', 'plan', 'depth', 'kind', 'methods',
+                 'next_method', 'trail_mark', 'key', 'cutoffs', 'trace_path')
+
+    def __init__(self, state, item, todo_list, plan, depth, kind, methods):
+        self.state = state
+        self.item = item
+        self.todo_list = todo_list
+        self.plan = plan
+        self.depth = depth
+        self.kind = kind
+        self.methods = methods
+        self.next_method = 0
+        # with trail=True, the length of the trail when 'state' was current
+        self.trail_mark = 0
+        # with a transposition table, the subproblem's key; otherwise None
+        self.key = None
+        # how many nodes max_depth had cut off when the choice point was made
+        self.cutoffs = 0
+        # with a SearchTracer, the path of spans that were open at the node
+        self.trace_path = ()
+
+
+class _SearchEngine():
+    """
+    e = _SearchEngine(state, todo_list) is a search engine that does the same
+    depth-first search as seek_plan, but without recursion. e.run() returns
+    the same result that seek_plan(state, todo_list, [], 0) would return.
+
+    Instead of a chain of recursive calls, e keeps a stack of _ChoicePoint
+    objects, one for each task, unigoal, and multigoal that it has refined on
+    the current path. Actions and achieved unigoals don't create choice
+    points. When a node fails, e backtracks by asking the choice point on
+    top of the stack for its next applicable method, and pops the choice
+    point once it runs out of methods.
+
+    If trail is True, e makes a single working copy of 'state' and applies
+    the actions to it in place, recording their writes on a trail (see the
+    section on trails above). Backtracking to a choice point undoes the
+    writes made since the choice point was created.
+
+    If transposition_table is a TranspositionTable, e looks up each task,
+    unigoal and multigoal (together with the state and the rest of the
+    todo_list) in it before refining it, skips the ones that are known to
+    fail, and records the ones that fail. A subproblem isn't recorded as
+    failing if max_depth cut off any of its nodes.
+
+    max_nodes, max_depth and deadline are the budgets described in
+    find_plan. After e.run() returns, e.status is 'success', 'failure',
+    'max_depth', 'max_nodes' or 'deadline' (see PlanResult), e.nodes is the
+    number of nodes expanded so far, and e.depth is the largest depth of
+    those nodes. If the status is 'max_nodes' or 'deadline', e.run() can be
+    called again, after raising e.max_nodes or e.deadline, to go on with the
+    search from where it stopped.
+
+    If record_tree is True, e records the refinements that it makes in its
+    partial plans, and the plan that e.run() returns includes the records
+    (see the section on decomposition trees). If statistics is a
+    MethodStatistics, e counts its method calls in it and orders the methods
+    by it. If stats is a SearchStats, e adds the work that it does to it,
+    and if tracer is a SearchTracer, e records its method attempts in it.
+    """
+
+    def __init__(self, state, todo_list, domain=None, trail=False,
+                 transposition_table=None, max_nodes=None, max_depth=None,
+                 deadline=None, record_tree=False, statistics=None, stats=None,
+                 tracer=None):
+        if domain == None:
+            domain = current_domain
+        self.domain = domain
+        self.record_tree = record_tree
+        self.statistics = statistics
+        self.stats = stats
+        self.tracer = tracer
+        self.stack = []
+        self.table = transposition_table
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self.status = None
+        self.nodes = 0
+        self.depth = 0
+        # the number of nodes that max_depth has cut off
+        self.cutoffs = 0
+        # with trail=True, the trail for the working state; otherwise None
+        self.trail = None
+        if trail:
+            self.trail = []
+            state = _trailed_copy(state, self.trail)
+        elif copy_on_write:
+            # make copies from a private copy of the caller's state (and
+            # fingerprint that one, if there's a table)
+            state = _private_copy(state)
+        elif transposition_table != None:
+            # fingerprint a copy, so as not to make the caller's state watched
+            state = state.copy(state.__name__)
+        if stats != None and (trail or copy_on_write or transposition_table != None):
+            stats.state_copies += 1
+        if transposition_table != None:
+            state.fingerprint()
+        # how to push items onto a todo_list: with a table, the todo_lists
+        # are made of _HashedCells, so that computing a key is cheap
+        self.push_items = _push_items if transposition_table == None else _push_hashed_items
+        # The next node to expand: (state, todo_list, plan, depth), where
+        # todo_list and plan are persistent lists. It is None if the last
+        # node failed, in which case we need to backtrack.
+        self.node = (state, self.push_items(todo_list, ()), (), 0)
+
+    def run(self):
+        """
+        Search until a plan is found or the search space is exhausted. Return
+        the plan, or False if there isn't one.
+        """
+        domain = self.domain
+        stack = self.stack
+        node = self.node
+        max_nodes = self.max_nodes
+        max_depth = self.max_depth
+        deadline = self.deadline
+        while True:
+            if node == None:
+                if not stack:
+                    self.node = None
+                    self.status = 'max_depth' if self.cutoffs else 'failure'
+                    return False
+                if self.stats != None:
+                    self.stats.backtracks += 1
+                node = self._next_alternative(stack[-1])
+                continue
+            (state, todo_list, plan, depth) = node
+            if todo_list != () and type(todo_list[0]) in _MARKER_TYPES:
+                todo_list = _skip_markers(state, todo_list)
+                node = (state, todo_list, plan, depth)
+            if max_nodes != None and self.nodes >= max_nodes:
+                return self._stop(node, 'max_nodes')
+            if deadline != None and time.time() >= deadline:
+                return self._stop(node, 'deadline')
+            self.nodes += 1
+            if depth > self.depth:
+                self.depth = depth
+            if verbose >= 2:
+                emit_event(2, 'todo_list', _TODO_LIST, depth=depth, todo_list=todo_list)
+            if max_depth != None and depth > max_depth:
+                if verbose >= 3:
+                    emit_event(3, 'max_depth', 'depth {depth} exceeds max_depth, backtrack',
+                               depth=depth)
+                self.cutoffs += 1
+                node = None
+                continue
+            if todo_list == ():
+                if verbose >= 3:
+                    emit_event(3, 'todo_list_done', _TODO_LIST_DONE, depth=depth)
+                if self.table != None and self.table.record_successes:
+                    self._store_successes(plan)
+                if self.statistics != None:
+                    for choice in stack:
+                        self.statistics._succeeded(choice.methods[choice.next_method-1])
+                self.node = None
+                self.status = 'success'
+                return _plan_to_list(plan)
+            (item1, todo_list) = todo_list
+            # look up plain and typed items without calling _classify
+            dispatch = domain._dispatch
+            if dispatch == None:
+                dispatch = domain._get_dispatch()
+            item_type = type(item1)
+            if item_type is tuple or item_type is list:
+                entry = dispatch.get(item1[0])
+            elif item_type is Action or item_type is Task or item_type is Goal:
+                entry = dispatch[item_type].get(item1[0])
+            else:
+                entry = domain._classify(item1)
+            if entry == None:
+                raise Exception(    \
+                    f"depth {depth}: {item1} isn't an action, task, unigoal, or multigoal\n")
+            (kind, target) = entry
+            if kind == 'action':
+                node = self._apply_action(state, item1, todo_list, plan, depth, target)
+            elif kind == 'task':
+                node = self._push(state, item1, todo_list, plan, depth, 'task', target)
+            elif kind == 'unigoal':
+                (state_var_name, arg, val) = item1
+                if vars(state).get(state_var_name).get(arg) == val:
+                    if verbose >= 3:
+                        emit_event(3, 'already_achieved', _ALREADY_ACHIEVED,
+                                   depth=depth, goal=item1)
+                    if self.record_tree:
+                        plan = _recorded(plan, item1, None, ())
+                    node = (state, todo_list, plan, depth+1)
+                else:
+                    node = self._push(state, item1, todo_list, plan, depth, 'unigoal', target)
+            else:
+                node = self._push(state, item1, todo_list, plan, depth, 'multigoal', target)
+
+    def _stop(self, node, status):
+        """
+        Stop searching because of a budget, remembering 'node' as the node
+        to expand if run() is called again, and return False.
+        """
+        if verbose >= 3:
+            emit_event(3, 'stopped', 'depth {depth} stopping: {status}',
+                       depth=node[3], status=status)
+        self.node = node
+        self.status = status
+        return False
+
+    def _apply_action(self, state, task1, todo_list, plan, depth, action):
+        """
+        Counterpart of _apply_action_and_continue: return the node to expand
+        after applying the action task1, whose function is 'action', or None
+        if it isn't applicable.
+        """
+        trail = self.trail
+        stats = self.stats
+        if trail == None:
+            newstate = action(state.copy(),*task1[1:])
+            if stats != None:
+                stats.state_copies += 1
+        else:
+            mark = len(trail)
+            newstate = action(state,*task1[1:])
+            if not newstate:
+                _undo_trail(trail, mark)
+            elif newstate is not state:
+                # The action returned a different state object, so fall back
+                # to copying it into the working state, one variable at a time
+                _undo_trail(trail, mark)
+                _adopt_vars(state, newstate)
+                newstate = state
+        if newstate:
+            if stats != None:
+                stats.actions += 1
+            if verbose >= 3:
+                emit_event(3, 'action_applied', _ACTION_APPLIED, depth=depth, action=task1)
+                newstate.display()
+            return (newstate, todo_list, (task1, plan), depth+1)
+        if verbose >= 3:
+            emit_event(3, 'action_not_applicable', _ACTION_NOT_APPLICABLE,
+                       depth=depth, action=task1)
+        return None
+
+    def _push(self, state, item1, todo_list, plan, depth, kind, relevant):
+        """
+        Push a choice point for refining item1 with the methods in 'relevant',
+        and return the node produced by the first applicable one (or None).
+        """
+        if kind != 'multigoal' and self.domain._method_guards:
+            relevant = self.domain._candidate_methods(kind, item1, relevant)
+        if self.statistics != None:
+            relevant = self.statistics._ordered(relevant)
+        if verbose >= 3:
+            emit_event(3, 'methods', _METHODS,
+                       depth=depth, item_kind=kind, item=item1, methods=relevant)
+        choice = _ChoicePoint(state, item1, todo_list, plan, depth, kind, relevant)
+        choice.cutoffs = self.cutoffs
+        if self.trail != None:
+            choice.trail_mark = len(self.trail)
+        if self.tracer != None:
+            choice.trace_path = self.tracer.path
+        if self.table != None:
+            try:
+                choice.key = (state.fingerprint(), (item1, todo_list))
+                known = self.table.lookup(choice.key)
+            except TypeError:       # something in todo_list isn't hashable
+                choice.key = None
+                known = None
+            if known == False:
+                if verbose >= 3:
+                    emit_event(3, 'known_failure',
+                               'depth {depth} {item_kind} {item}: known to fail',
+                               depth=depth, item_kind=kind, item=item1)
+                return None
+            elif known != None:
+                if verbose >= 3:
+                    emit_event(3, 'known_plan',
+                               'depth {depth} {item_kind} {item}: known plan {plan}',
+                               depth=depth, item_kind=kind, item=item1, plan=list(known))
+                return (state, (), _push_items(known[::-1], plan), depth+1)
+        self.stack.append(choice)
+        return self._next_alternative(choice)
+
+    def _store_successes(self, plan):
+        """
+        'plan' is a solution plan. For each choice point on the stack, record
+        in the transposition table the part of the plan after that point.
+        """
+        suffix = []
+        for choice in reversed(self.stack):
+            # choice.plan is a tail of plan, since plan extends it
+            while plan is not choice.plan:
+                (action, plan) = plan
+                suffix.append(action)
+            if choice.key != None:
+                self.table.store(choice.key, tuple(reversed(suffix)))
+
+    def _next_alternative(self, choice):
+        """
+        Try the remaining methods of 'choice', which must be on top of the
+        stack, until one of them is applicable. Return the node that the
+        method produces, or pop 'choice' and return None if there are no
+        applicable methods left.
+        """
+        state = choice.state
+        item1 = choice.item
+        depth = choice.depth
+        methods = choice.methods
+        guards = self.domain._method_guards if choice.kind != 'multigoal' else None
+        tracer = self.tracer
+        if self.trail != None:
+            _undo_trail(self.trail, choice.trail_mark)
+        if tracer != None:
+            tracer._restore(choice.trace_path)
+        while choice.next_method < len(methods):
+            method = methods[choice.next_method]
+            choice.next_method += 1
+            if guards and method in guards and not guards[method].matches(state, item1[1:]):
+                if verbose >= 3:
+                    emit_event(3, 'guard_not_satisfied', _GUARD_NOT_SATISFIED,
+                               depth=depth, method=method)
+                continue
+            if tracer != None:
+                tracer._begin(item1, choice.kind, method)
+            if choice.kind == 'task':
+                subitems = method(state, *item1[1:])
+            elif choice.kind == 'unigoal':
+                subitems = method(state, item1[1], item1[2])
+            else:
+                subitems = method(state, item1)
+            if self.statistics != None:
+                self.statistics._tried(method, subitems)
+            if self.stats != None:
+                self.stats._called(method)
+            # Can't just say "if subitems:", because that's wrong if subitems == []
+            if subitems != False and subitems != None:
+                if verbose >= 3:
+                    emit_event(3, 'method_applicable', _METHOD_APPLICABLE,
+                               depth=depth, method=method, subitems=subitems)
+                todo_list = choice.todo_list
+                if tracer != None:
+                    todo_list = self.push_items((_SpanEnd((tracer,)),), todo_list)
+                if verify_goals and choice.kind != 'task':
+                    todo_list = self.push_items(
+                        (_Verification((method.__name__, item1, depth)),), todo_list)
+                plan = choice.plan
+                if self.record_tree:
+                    plan = _recorded(plan, item1, method, subitems)
+                return (state, self.push_items(subitems, todo_list), plan, depth+1)
+            if tracer != None:
+                tracer._end('not applicable')
+            if verbose >= 3:
+                emit_event(3, 'method_not_applicable', _METHOD_NOT_APPLICABLE,
+                           depth=depth, method=method)
+        if verbose >= 3:
+            emit_event(3, 'refinement_failed', _REFINEMENT_FAILED,
+                       depth=depth, item_kind=choice.kind, item=item1)
+        if choice.key != None and choice.cutoffs == self.cutoffs:
+            self.table.store(choice.key, False)
+        self.stack.pop()
+        return None
+
+
+################################################################################
+# Decomposition trees and plan repair
+#
+# find_plan(..., return_tree=True) returns a DecompositionTree that tells how
+# the planner decomposed the todo_list into the plan: which method it used
+# for each task and goal, and what subtasks and subgoals the method gave.
+# It works with both search engines.
+#
+# To make the tree, the search records each refinement that it makes (see
+# _recorded): when it refines a task or goal with a method, or finds that a
+# unigoal is already achieved, it adds a _Refinement record to the partial
+# plan, just before the actions that will come from the subtasks and
+# subgoals. A record is a small object that refers to the item and the
+# method, and no state is copied. Since partial plans are persistent lists
+# that the search shares with its backtracking stack (or with the recursive
+# calls of seek_plan), the records for a branch that fails are freed along
+# with the rest of its partial plan. When the search succeeds, the records
+# and actions in its plan are a preorder walk of the tree, which
+# _decomposition_tree turns into DecompositionNodes.
+#
+# If an action fails when the plan is executed, repair_plan(tree, new_state,
+# failed_step) looks for a new plan for the rest of the todo_list, starting
+# in new_state, the state in which the execution stopped. Rather than
+# planning for the whole todo_list again, it re-refines the lowest task or
+# goal in the tree that contains the failed action, together with what is
+# left of the todo_list around it:
+#   - if there is no plan without it, and the failed action is the first
+#     one under that task or goal: before it, the goal just before it among
+#     its parent's subtasks and subgoals, if there is one. The parent's
+#     method may rely on that goal, and the failure may have undone it
+#     (e.g., ('pos', b, 'hand') before ('pos', b, c) in the blocks_hgn
+#     example, where a failed 'stack' leaves the block on the table);
+#   - after it, the remaining siblings of each node on the path up from the
+#     failed action, first by reusing their actions, which only need to be applied
+#     to check that they are still applicable, and if that fails, by
+#     refining the siblings again;
+#   - each goal on that path, after its siblings, in case they no longer
+#     achieve it.
+# If there is no plan for that, repair_plan tries again one level higher in
+# the tree, and so on up to the todo_list's top-level items.
+
+
+class DecompositionNode():
+    """
+    A node of a DecompositionTree. If n is a node, then
+      - n.item is the todo_list item (an action, task, unigoal, or multigoal)
+        that n is for, or None if n is the tree's root;
+      - n.kind is 'action', 'task', 'unigoal', 'multigoal', or 'root';
+      - n.method is the method that the planner used for n.item, or None if
+        n.item is an action, a unigoal that was already achieved, or if n
+        is the root;
+      - n.children is a list of the nodes for the subtasks and subgoals that
+        n.method returned, in order, or for the root, the nodes for the
+        todo_list's items;
+      - n.parent is n's parent, or None if n is the root;
+      - if n.item is an action, n.step is its index in the plan; otherwise
+        n.step is None.
+    The planner's verification markers (see verify_goals) aren't included.
+    """
+    __slots__ = ('item', 'kind', 'method', 'children', 'parent', 'step')
+
+    def __init__(self, item, kind, method=None, parent=None):
+        self.item = item
+        self.kind = kind
+        self.method = method
+        self.children = []
+        self.parent = parent
+        self.step = None
+
+    def __str__(self):
+        if self.kind == 'root':
+            return "<DecompositionNode root>"
+        return f"<DecompositionNode {_item_to_string(self.item)}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def actions(self):
+        """Return the list of action nodes in n's subtree, in the plan's order"""
+        result = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.kind == 'action':
+                result.append(node)
+            else:
+                stack.extend(reversed(node.children))
+        return result
+
+
+class DecompositionTree():
+    """
+    t = DecompositionTree(state, todo_list, plan, root) records how the planner
+    found 'plan' for todo_list, starting in 'state'. find_plan returns one
+    if it is called with return_tree=True, and so does repair_plan.
+      - t.state, t.todo_list and t.plan are the arguments;
+      - t.root is a DecompositionNode whose children are the nodes for the
+        items of todo_list;
+      - t.leaves[i] is the node for the action t.plan[i].
+    """
+
+    def __init__(self, state, todo_list, plan, root):
+        self.state = state
+        self.todo_list = todo_list
+        self.plan = plan
+        self.root = root
+        self.leaves = root.actions()
+        for (step, leaf) in enumerate(self.leaves):
+            leaf.step = step
+
+    def __str__(self):
+        return f"<DecompositionTree with {len(self.plan)} actions>"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def display(self, heading=None):
+        """
+        Print the tree, one node per line, indenting each node's children
+        under it.
+        """
+        if heading == None:
+            heading = 'Decomposition tree for [' + \
+                      ', '.join([_item_to_string(x) for x in self.todo_list]) + ']'
+        lines = [heading + ':']
+        stack = [(child, 1) for child in reversed(self.root.children)]
+        while stack:
+            (node, indent) = stack.pop()
+            line = '  ' * indent + _item_to_string(node.item)
+            if node.step != None:
+                line += f'   (step {node.step})'
+            elif node.method != None:
+                line += f'   via {node.method.__name__}'
+            lines.append(line)
+            stack.extend((child, indent+1) for child in reversed(node.children))
+        log_event('\n'.join(lines))
+
+
+class _Refinement():
+    """
+    A record, in a partial plan, that the search refined 'item' with
+    'method' (None for a unigoal that was already achieved), and that the
+    method returned 'size' subtasks and subgoals.
+    """
+    __slots__ = ('item', 'method', 'size')
+
+    def __init__(self, item, method, size):
+        self.item = item
+        self.method = method
+        self.size = size
+
+
+
+def _recorded(plan, item, method, subitems):
+    """
+    Return the persistent plan 'plan' with a _Refinement record for item,
+    method and subitems added to it.
+    """
+    return (_Refinement(item, method, len(subitems)), plan)
+
+
+def _decomposition_tree(state, todo_list, steps, domain=None):
+    """
+    'steps' is what a search that recorded its refinements (see _recorded)
+    found for todo_list, starting in 'state': a list of actions and
+    _Refinement records, in order. Return the DecompositionTree for the
+    plan, which is the list of actions in steps.
+    """
+    if domain == None:
+        domain = current_domain
+    root = DecompositionNode(None, 'root')
+    plan = []
+    # each frame is [node, the number of node's children still to come]
+    frames = [[root, len(todo_list)]]
+    for step in steps:
+        while frames and frames[-1][1] == 0:
+            frames.pop()
+        if not frames:
+            raise Exception("can't make a decomposition tree: too many steps")
+        frame = frames[-1]
+        frame[1] -= 1
+        if type(step) is _Refinement:
+            node = DecompositionNode(step.item, domain._classify(step.item)[0],
+                                     step.method, frame[0])
+            if step.size > 0:
+                frames.append([node, step.size])
+        else:
+            node = DecompositionNode(step, 'action', None, frame[0])
+            plan.append(step)
+        frame[0].children.append(node)
+    if any(count > 0 for (node, count) in frames):
+        raise Exception("can't make a decomposition tree: too few steps")
+    return DecompositionTree(state, todo_list, plan, root)
+
+
+def repair_plan(tree, new_state, failed_step, trail=False, transposition_table=None,
+                max_nodes=None, max_depth=None, deadline=None):
+    """
+    repair_plan tries to find a new plan after the action tree.plan[failed_step]
+    fails, given that the actions before it were executed and the current
+    state is new_state. It returns a DecompositionTree for the new plan
+    (for the rest of tree.todo_list, starting in new_state), or False if
+    it can't find one. See the section on plan repair for how it works.
+    The other arguments are as in find_plan; max_nodes applies to each of
+    the searches that repair_plan does.
+    """
+    if not 0 <= failed_step < len(tree.plan):
+        raise Exception(f"repair_plan: step {failed_step} isn't in the plan")
+    if transposition_table == True:
+        transposition_table = TranspositionTable()
+    elif transposition_table == False:
+        transposition_table = None
+    if transposition_table != None and transposition_table.record_successes:
+        raise Exception("repair_plan: it can't use a transposition table " + \
+                        "that records successes")
+    leaf = tree.leaves[failed_step]
+    levels = []
+    node = leaf.parent
+    while node.kind != 'root':
+        levels.append(node)
+        node = node.parent
+    if not levels:
+        levels = [leaf]
+    for node in levels:
+        earlier = _earlier_goals(node, failed_step)
+        attempts = [(reuse, goals) for reuse in (True, False)
+                    for goals in ([[], earlier] if earlier else [[]])]
+        for (reuse, goals) in attempts:
+            (todo_list, layout) = _repair_todo_list(node, reuse, goals)
+            if reuse == False and all(not siblings for (_, siblings, _) in layout):
+                break       # the same as with reuse == True
+            if verbose >= 1:
+                emit_event(1, 'repair_attempt', "repair_plan: re-refining {item!i}" + \
+                           (" after {goal!i}" if goals else "") + \
+                           (", reusing the actions after it" if reuse else ""),
+                           item=node.item, goal=goals[0].item if goals else None,
+                           reuse=reuse)
+            search = _SearchEngine(new_state, todo_list, trail=trail,
+                                   transposition_table=transposition_table,
+                                   max_nodes=max_nodes, max_depth=max_depth,
+                                   deadline=deadline, record_tree=True)
+            steps = search.run()
+            if steps != False:
+                new_tree = _decomposition_tree(new_state, todo_list, steps)
+                return _splice_repair(new_tree, layout, reuse, len(goals))
+            if search.status == 'deadline':
+                return False
+    if verbose >= 1:
+        emit_event(1, 'repair_failed', "repair_plan: could not repair the plan")
+    return False
+
+
+def _earlier_goals(node, failed_step):
+    """
+    Return a list containing the node for the goal just before 'node' among
+    its parent's children, if there is one and the action at failed_step is
+    the first one under 'node'. Otherwise return [].
+    """
+    first = node
+    while first.children:
+        first = first.children[0]
+    if first.step != failed_step:
+        return []
+    siblings = node.parent.children
+    i = next(i for (i, c) in enumerate(siblings) if c is node)
+    if i > 0 and siblings[i-1].kind in {'unigoal', 'multigoal'}:
+        return [siblings[i-1]]
+    return []
+
+
+def _repair_todo_list(node, reuse, goals):
+    """
+    Return (todo_list, layout), where todo_list is what repair_plan should
+    plan for in order to re-refine 'node' after re-establishing 'goals' (a
+    list of nodes from _earlier_goals), and layout describes where the
+    items of todo_list came from, for _splice_repair: it has a triple
+    (ancestor, siblings, goal) for each ancestor of node, from the bottom
+    up, where siblings is a list of pairs (sibling, number of items) for the
+    ancestor's children after the path to node, and goal tells whether the
+    ancestor's item is a goal that is checked after them. If reuse is True,
+    each sibling's items are its actions, followed by the sibling's own item
+    if it is a goal; otherwise each sibling's one item is its own item.
+    """
+    todo_list = [earlier.item for earlier in goals] + [node.item]
+    layout = []
+    child = node
+    ancestor = node.parent
+    while ancestor != None:
+        i = next(i for (i, c) in enumerate(ancestor.children) if c is child)
+        siblings = []
+        for sibling in ancestor.children[i+1:]:
+            if not reuse:
+                items = [sibling.item]
+            else:
+                items = [action.item for action in sibling.actions()]
+                if sibling.kind in {'unigoal', 'multigoal'}:
+                    items.append(sibling.item)
+            todo_list.extend(items)
+            siblings.append((sibling, len(items)))
+        # a goal right after the same goal needn't be checked again
+        goal = ancestor.kind in {'unigoal', 'multigoal'} and \
+               todo_list[-1] != ancestor.item
+        if goal:
+            todo_list.append(ancestor.item)
+        layout.append((ancestor, siblings, goal))
+        child = ancestor
+        ancestor = ancestor.parent
+    return (todo_list, layout)
+
+
+def _splice_repair(new_tree, layout, reuse, goals):
+    """
+    new_tree is the DecompositionTree for a todo_list made by _repair_todo_list
+    with the given layout and reuse, and with 'goals' earlier goals. Return a
+    DecompositionTree for the same plan that has the shape of the old tree:
+    the nodes for the ancestors of the re-refined node, each with the
+    re-refined node or ancestor below it followed by the subtrees for its
+    remaining children. The earlier goals that weren't already achieved come
+    before the re-refined node.
+    """
+    results = new_tree.root.children
+    redone = [goal for goal in results[:goals] if goal.children]
+    position = goals + 1
+    below = results[goals]
+    for (ancestor, siblings, goal) in layout:
+        node = DecompositionNode(ancestor.item, ancestor.kind, ancestor.method)
+        children = redone + [below]
+        redone = []
+        for (sibling, count) in siblings:
+            if not reuse:
+                children.append(results[position])
+            else:
+                children.append(_copy_subtree(sibling))
+                if sibling.kind in {'unigoal', 'multigoal'}:
+                    # the goal check is the last of the sibling's items
+                    check = results[position + count - 1]
+                    if check.children:
+                        children.append(check)
+            position += count
+        if goal:
+            check = results[position]
+            position += 1
+            if check.children:
+                # the goal wasn't achieved, so the planner refined it again
+                children.append(check)
+        for child in children:
+            child.parent = node
+        node.children = children
+        below = node
+    tree = DecompositionTree(new_tree.state, new_tree.todo_list, new_tree.plan, below)
+    if [leaf.item for leaf in tree.leaves] != new_tree.plan:
+        raise Exception("repair_plan: the repaired tree doesn't match the plan")
+    return tree
+
+
+def _copy_subtree(node):
+    """Return a copy of the subtree whose root is 'node', without its parent"""
+    the_copy = DecompositionNode(node.item, node.kind, node.method)
+    stack = [(node, the_copy)]
+    while stack:
+        (old, new) = stack.pop()
+        for old_child in old.children:
+            new_child = DecompositionNode(old_child.item, old_child.kind,
+                                          old_child.method, new)
+            new.children.append(new_child)
+            stack.append((old_child, new_child))
+    return the_copy
+
+
+################################################################################
+# Searching in worker processes
+#
+# find_plans(problems, workers=n) solves a batch of planning problems in a pool
+# of n worker processes, one problem per call to find_plan.
+#
+# find_plan(..., portfolio=k) runs k searches in worker processes, each with
+# the methods in a different order, and returns the result of the first one
+# to finish. Since the best method order differs from problem to problem,
+# this can avoid the long searches that any one order makes for some
+# problems.
+#
+# find_plan(..., workers=n) does an OR-parallel search: it splits the search
+# into subproblems and solves them in n worker processes. The parent process
+# expands the first few choice points itself (see split_depth in find_plan):
+# at each one, it calls all of the relevant methods, and each applicable
+# method gives a subproblem (a node that the search would expand after
+# choosing that method). The subproblems are listed in the order in which the
+# sequential search would try them. Each worker searches one subproblem at a
+# time with _SearchEngine, and the parent takes the plan of the first
+# subproblem in the list that has one, which is the plan the sequential search
+# would return. With first_found=True, it instead takes the first plan that
+# any worker finds. Once the answer is known, the parent cancels the
+# subproblems that haven't started, and tells the running workers to stop.
+#
+# In all three cases, the workers get copies of current_domain and of the
+# global settings that affect planning (copy_on_write, track_multigoals,
+# verify_goals, split_multigoal_order) when they start, and keep them for all
+# of the problems they solve. Where the 'fork' start method is available, the
+# workers inherit them; elsewhere they are pickled, so the domain's actions
+# and methods, and split_multigoal_order, must be module-level functions.
+# The workers don't print anything, whatever verbose is.
+
+
+_CANCEL_CHECK_NODES = 1000
+"""
+How many nodes a worker expands between checks of whether the parent process
+has cancelled its search.
+"""
+
+
+# Set in each worker process by _init_search_worker.
+_cancel_search = None
+
+
+def _init_search_worker(domain, settings, cancel):
+    """
+    Initializer for the processes in the pools made by _make_worker_pool.
+    """
+    global current_domain, copy_on_write, track_multigoals, verify_goals, \
+        split_multigoal_order, verbose, _cancel_search
+    current_domain = domain
+    (copy_on_write, track_multigoals, verify_goals, split_multigoal_order) = settings
+    verbose = 0
+    _cancel_search = cancel
+
+
+def _worker_context():
+    """
+    Return the multiprocessing context in which to start worker processes.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+
+def _make_worker_pool(workers, cancel=None):
+    """
+    Return a ProcessPoolExecutor with the given number of worker processes,
+    initialized with current_domain and the global settings. 'cancel' is
+    None, or an Event made by _worker_context() that tells the workers to
+    stop searching.
+    """
+    context = _worker_context()
+    settings = (copy_on_write, track_multigoals, verify_goals, split_multigoal_order)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_search_worker,
+        initargs=(current_domain, settings, cancel))
+
+
+def _search_subproblem(index, subproblem, trail, transposition_table,
+                       max_depth, deadline):
+    """
+    Run in a worker process: search subproblem = (state, todo_list, plan,
+    depth), where todo_list and plan are Python lists. Return (index, plan or
+    False, status, nodes, depth), where status is as in PlanResult, or
+    'cancelled' if the parent process cancelled the search. If
+    transposition_table is True, use a new TranspositionTable.
+    """
+    (state, todo_list, plan, depth) = subproblem
+    if transposition_table == True:
+        transposition_table = TranspositionTable()
+    search = _SearchEngine(state, todo_list, trail=trail,
+                           transposition_table=transposition_table,
+                           max_depth=max_depth, deadline=deadline)
+    (state, todo_list, _, _) = search.node
+    search.node = (state, todo_list, _push_items(plan[::-1], ()), depth)
+    result = _run_in_worker(search)
+    return (index, result, search.status, search.nodes, search.depth)
+
+
+def _run_in_worker(search, max_nodes=None):
+    """
+    Run 'search', a _SearchEngine, in a worker process, checking every
+    _CANCEL_CHECK_NODES nodes whether the parent process has cancelled it.
+    Stop after max_nodes nodes if max_nodes isn't None. Return the result of
+    search.run(), or False if the search was cancelled, in which case set
+    search.status to 'cancelled'.
+    """
+    while True:
+        limit = search.nodes + _CANCEL_CHECK_NODES
+        if max_nodes != None and max_nodes < limit:
+            limit = max_nodes
+        search.max_nodes = limit
+        result = search.run()
+        if search.status != 'max_nodes' or search.nodes == max_nodes:
+            return result
+        if _cancel_search != None and _cancel_search.is_set():
+            search.status = 'cancelled'
+            return False
+
+
+class _ParallelSearch():
+    """
+    p = _ParallelSearch(state, todo_list, workers, ...) does the search that
+    find_plan(state, todo_list, workers=workers, ...) describes. Like
+    _SearchEngine, p.run() returns the plan or False, and afterward p.status
+    is 'success', 'failure', 'max_depth' or 'deadline', p.nodes is the number
+    of nodes expanded by all of the processes together, and p.depth is the
+    largest depth of those nodes. Unlike _SearchEngine, p can't resume.
+    """
+
+    def __init__(self, state, todo_list, workers, split_depth=2, first_found=False,
+                 trail=False, transposition_table=None, max_depth=None, deadline=None):
+        self.state = state
+        self.todo_list = todo_list
+        self.workers = workers
+        self.split_depth = split_depth
+        self.first_found = first_found
+        self.trail = trail
+        self.table = transposition_table
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self.status = None
+        self.nodes = 0
+        self.depth = 0
+        # whether max_depth cut off any nodes
+        self.cutoffs = False
+
+    def run(self):
+        """
+        Split the search into subproblems, solve them, and return the plan,
+        or False if there isn't one.
+        """
+        # Each entry of 'entries' is [status, plan, node]: status is None until
+        # the search of the node is over. If the search raised an exception,
+        # status is 'error' and the exception is in place of the plan.
+        search = _SearchEngine(self.state, self.todo_list, max_depth=self.max_depth,
+                               deadline=self.deadline)
+        entries = [[None, False, search.node]]
+        for i in range(self.split_depth):
+            entries = [new for entry in entries for new in self._split(entry)]
+            if self.deadline != None and time.time() >= self.deadline:
+                break
+        open_entries = [entry for entry in entries if entry[0] == None]
+        if verbose >= 2:
+            emit_event(2, 'parallel_split', 'parallel search: {subproblems} subproblems ' + \
+                       'after {nodes} nodes', subproblems=len(open_entries), nodes=self.nodes)
+        if self._answer(entries) == None:
+            if len(open_entries) == 1:
+                # nothing to do in parallel
+                self._finish(open_entries[0], self._search_locally(open_entries[0]))
+            else:
+                self._search_in_pool(entries, open_entries)
+        answer = self._answer(entries)
+        if answer[0] == 'error':
+            raise answer[1]
+        self.status = answer[0]
+        return answer[1]
+
+    def _split(self, entry):
+        """
+        If 'entry' isn't solved yet, expand its subproblem up to and including
+        the next choice point that has more than one applicable method, and
+        return a list of entries, one for each applicable method. Otherwise
+        return [entry].
+        """
+        if entry[0] != None:
+            return [entry]
+        search = _SearchEngine(self.state, [], max_depth=self.max_depth,
+                               deadline=self.deadline)
+        search.node = entry[2]
+        try:
+            while True:
+                search.max_nodes = search.nodes + 1
+                result = search.run()
+                if search.status != 'max_nodes':
+                    return [[search.status, result, None]]
+                if search.stack:
+                    choice = search.stack[-1]
+                    new_entries = [[None, False, search.node]]
+                    try:
+                        node = search._next_alternative(choice)
+                        while node != None:
+                            new_entries.append([None, False, node])
+                            node = search._next_alternative(choice)
+                    except Exception as e:
+                        # The sequential search would raise e only if it got
+                        # this far, so leave that to _answer
+                        new_entries.append(['error', e, None])
+                    if len(new_entries) > 1:
+                        return new_entries
+                    search.node = new_entries[0][2]
+        finally:
+            self._count(search.status, search.nodes, search.depth, search.cutoffs)
+
+    def _count(self, status, nodes, depth, cutoffs=0):
+        """
+        Add the work done by one search to the totals.
+        """
+        self.nodes += nodes
+        self.depth = max(self.depth, depth)
+        if cutoffs or status == 'max_depth':
+            self.cutoffs = True
+
+    def _subproblem(self, entry):
+        """
+        Return entry's node in the form that _search_subproblem takes.
+        """
+        (state, todo_list, plan, depth) = entry[2]
+        return (state, _todo_to_list(todo_list), _plan_to_list(plan), depth)
+
+    def _search_locally(self, entry):
+        """
+        Search entry's subproblem in this process.
+        """
+        return _search_subproblem(0, self._subproblem(entry), self.trail,
+                                  self.table, self.max_depth,
+                                  self.deadline)
+
+    def _finish(self, entry, outcome):
+        """
+        Record the outcome of _search_subproblem for 'entry'.
+        """
+        (_, plan, status, nodes, depth) = outcome
+        self._count(status, nodes, depth)
+        entry[0] = status
+        entry[1] = plan
+
+    def _search_in_pool(self, entries, open_entries):
+        """
+        Solve the entries in open_entries in a pool of worker processes, until
+        _answer(entries) says that the answer is known.
+        """
+        cancel = _worker_context().Event()
+        table = True if self.table != None else None
+        with _make_worker_pool(self.workers, cancel) as pool:
+            futures = {}
+            for (index, entry) in enumerate(open_entries):
+                futures[pool.submit(_search_subproblem, index,
+                                    self._subproblem(entry), self.trail, table,
+                                    self.max_depth, self.deadline)] = index
+            pending = set(futures)
+            try:
+                while pending and self._answer(entries) == None:
+                    (done, pending) = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() != None:
+                            entry = open_entries[futures[future]]
+                            entry[0] = 'error'
+                            entry[1] = future.exception()
+                        else:
+                            outcome = future.result()
+                            self._finish(open_entries[outcome[0]], outcome)
+            finally:
+                cancel.set()
+                for future in pending:
+                    future.cancel()
+                for future in pending:
+                    if not future.cancelled() and future.exception() == None:
+                        self._count(*future.result()[2:])
+
+    def _answer(self, entries):
+        """
+        Return the entry whose plan is the answer, or an entry whose status
+        explains why there is no plan, or None if the answer isn't known yet.
+        """
+        if self.first_found:
+            for entry in entries:
+                if entry[0] == 'success':
+                    return entry
+        for entry in entries:
+            if entry[0] == None:
+                return None
+            if entry[0] not in {'failure', 'max_depth'}:
+                return entry
+        return ['max_depth' if self.cutoffs else 'failure', False, None]
+
+
+def find_plans(problems, workers=None, ordered=True, **options):
+    """
+    find_plans solves a batch of planning problems, and yields a pair (i, r)
+    for each of them, where i is the problem's index in 'problems' and r is
+    the PlanResult returned by find_plan(state, todo_list, return_result=True,
+    **options). In particular, r.elapsed is the number of seconds that the
+    search for that problem took. Arguments:
+     - 'problems' is an iterable of pairs (state, todo_list). find_plans
+       reads it only as fast as the workers need more problems, so it can
+       be a generator.
+     - 'workers' (optional) is the number of worker processes in which to
+       solve the problems. If it is None, find_plans solves them one at a
+       time in this process.
+     - 'ordered' (optional): if it is True, the results come in the same
+       order as the problems. Otherwise they come in the order in which
+       the workers finish them.
+     - the other keyword arguments are passed to find_plan, except that
+       they can't include 'workers' or 'return_result'. With workers, they
+       also can't include a plan_cache, method_statistics or tracer, since
+       each worker would update its own copy of it.
+    The workers keep copies of the domain and global settings that are
+    current when find_plans is called (see the section on searching in
+    worker processes above). If find_plan raises an exception for a problem,
+    find_plans raises it in place of that problem's result.
+
+    With workers, each problem and its PlanResult are pickled to go between
+    the processes, and the workers' processes are started once per call.
+    This pays off when the problems take much longer to solve than to pickle
+    (see batch_planning in benchmark.py, which prints both times), and when
+    'workers' is no more than the number of cores: with more, the workers
+    take turns on the cores, so each search takes longer and the batch
+    doesn't finish sooner. The results are the same as without workers.
+    """
+    for name in ('workers', 'return_result'):
+        if name in options:
+            raise Exception(f"find_plans: can't pass {name!r} to find_plan")
+    if workers != None and isinstance(options.get('stats'), SearchStats):
+        raise Exception("find_plans: with workers, use stats=True to get " + \
+                        "a SearchStats for each problem")
+    for name in ('plan_cache', 'method_statistics', 'tracer'):
+        if workers != None and options.get(name) != None:
+            raise Exception(f"find_plans: {name} can't be used with workers")
+    if workers == None:
+        return ((i, find_plan(state, todo_list, return_result=True, **options))
+                for (i, (state, todo_list)) in enumerate(problems))
+    # the pool's initializer gets current_domain now, but the pool doesn't
+    # start any processes until the first problem is submitted
+    pool = _make_worker_pool(workers)
+    return _find_plans_in_pool(pool, problems, 2*workers, ordered, options)
+
+
+def _find_plan_in_worker(state, todo_list, options):
+    """
+    Run in a worker process: return find_plan's PlanResult for one problem.
+    """
+    return find_plan(state, todo_list, return_result=True, **options)
+
+
+def _find_plans_in_pool(pool, problems, max_pending, ordered, options):
+    """
+    The generator that find_plans returns if it uses worker processes. It
+    keeps at most max_pending problems in the pool at a time, and shuts
+    the pool down when it finishes or is closed.
+    """
+    problems = enumerate(problems)
+    indices = {}            # pending futures and the indices of their problems
+    finished = {}           # finished futures that ordered=True holds back
+    next_index = 0          # with ordered=True, the index of the next result
+    try:
+        while True:
+            while len(indices) < max_pending:
+                problem = next(problems, None)
+                if problem == None:
+                    break
+                (i, (state, todo_list)) = problem
+                indices[pool.submit(_find_plan_in_worker, state, todo_list, options)] = i
+            if not indices:
+                return
+            (done, _) = concurrent.futures.wait(
+                indices, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in sorted(done, key=indices.get):
+                i = indices.pop(future)
+                if ordered:
+                    finished[i] = future
+                else:
+                    yield (i, future.result())
+            while next_index in finished:
+                yield (next_index, finished.pop(next_index).result())
+                next_index += 1
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _shuffled_domain(domain, rng):
+    """
+    Return a copy of 'domain' in which the lists of task, unigoal and multigoal
+    methods have been shuffled with rng, a random.Random. The copy shares
+    everything else with 'domain', and isn't added to the list of domains.
+    """
+    the_copy = copy.copy(domain)
+    the_copy._task_method_dict = {name: rng.sample(methods, len(methods))
+                                  for (name, methods) in domain._task_method_dict.items()}
+    the_copy._unigoal_method_dict = {
+        name: rng.sample(methods, len(methods))
+        for (name, methods) in domain._unigoal_method_dict.items()}
+    the_copy._multigoal_method_list = rng.sample(domain._multigoal_method_list,
+                                                 len(domain._multigoal_method_list))
+    the_copy._clear_caches()
+    return the_copy
+
+
+def _search_with_ordering(index, state, todo_list, seed, restart_nodes, trail,
+                          transposition_table, max_depth, deadline):
+    """
+    Run in a worker process: search for a plan for todo_list, with the method
+    lists shuffled by random.Random(seed), or in the order they were declared
+    if seed is None. If restart_nodes isn't None, give up after that many
+    nodes and start over with a new shuffle and twice as many nodes, and so
+    on. Return (index, plan or False, status, nodes, depth) like
+    _search_subproblem. If transposition_table is True, use a new
+    TranspositionTable, and keep it from one restart to the next, since the
+    subproblems that fail don't depend on the method order.
+    """
+    rng = random.Random(seed if seed != None else 0)
+    shuffle = (seed != None)
+    if transposition_table == True:
+        transposition_table = TranspositionTable()
+    (nodes, depth) = (0, 0)
+    while True:
+        domain = _shuffled_domain(current_domain, rng) if shuffle else current_domain
+        search = _SearchEngine(state, todo_list, domain=domain, trail=trail,
+                               transposition_table=transposition_table,
+                               max_depth=max_depth, deadline=deadline)
+        result = _run_in_worker(search, restart_nodes)
+        nodes += search.nodes
+        depth = max(depth, search.depth)
+        if search.status != 'max_nodes':
+            return (index, result, search.status, nodes, depth)
+        restart_nodes *= 2
+        shuffle = True
+
+
+class _PortfolioSearch():
+    """
+    p = _PortfolioSearch(state, todo_list, seeds, workers, ...) does the search
+    that find_plan(state, todo_list, portfolio=seeds, workers=workers, ...)
+    describes: one search for each seed in 'seeds', each with its own method
+    order (see _search_with_ordering), in a pool of worker processes. Like
+    _ParallelSearch, p.run() returns the plan or False, and sets p.status,
+    p.nodes and p.depth. It also sets p.winner to the index in 'seeds' of the
+    search whose result it returned, or None if none of them finished.
+    """
+
+    def __init__(self, state, todo_list, seeds, workers, restart_nodes=None,
+                 trail=False, transposition_table=None, max_depth=None, deadline=None):
+        self.state = state
+        self.todo_list = todo_list
+        self.seeds = seeds
+        self.workers = workers
+        self.restart_nodes = restart_nodes
+        self.trail = trail
+        self.table = transposition_table
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self.status = None
+        self.nodes = 0
+        self.depth = 0
+        self.winner = None
+
+    def run(self):
+        """
+        Start the searches, and return the result of the first one that
+        finds a plan or shows that there isn't one, after cancelling the
+        others.
+        """
+        cancel = _worker_context().Event()
+        table = True if self.table != None else None
+        answer = None
+        error = None
+        with _make_worker_pool(self.workers, cancel) as pool:
+            pending = set()
+            for (index, seed) in enumerate(self.seeds):
+                pending.add(pool.submit(_search_with_ordering, index, self.state,
+                                        self.todo_list, seed, self.restart_nodes,
+                                        self.trail, table, self.max_depth, self.deadline))
+            try:
+                while pending and answer == None:
+                    (done, pending) = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() != None:
+                            error = error or future.exception()
+                            continue
+                        outcome = future.result()
+                        self._count(outcome)
+                        # With any method order, the search is complete, so
+                        # a failure is as final as a plan
+                        if answer == None and outcome[2] != 'deadline':
+                            answer = outcome
+            finally:
+                cancel.set()
+                for future in pending:
+                    future.cancel()
+                for future in pending:
+                    if not future.cancelled() and future.exception() == None:
+                        self._count(future.result())
+        if answer == None:
+            if error != None:
+                raise error
+            self.status = 'deadline'
+            return False
+        (self.winner, plan, self.status) = answer[:3]
+        if verbose >= 2:
+            emit_event(2, 'portfolio_winner', 'portfolio search {winner} (seed {seed}) ' + \
+                       'finished first: {status}', winner=self.winner,
+                       seed=self.seeds[self.winner], status=self.status)
+        return plan
+
+    def _count(self, outcome):
+        """
+        Add the work done by one search to the totals.
+        """
+        self.nodes += outcome[3]
+        self.depth = max(self.depth, outcome[4])
+
+
 ################################################################################
 # An actor
 
 
-def run_lazy_lookahead(state, todo_list, max_tries=10):
+def run_lazy_lookahead(state, todo_list, max_tries=10, repair=False):
     """
     An adaptation of the run_lazy_lookahead algorithm from Ghallab et al.
     (2016), Automated Planning and Acting. It works roughly like this:
@@ -894,25 +5088,41 @@ def run_lazy_lookahead(state, todo_list, max_tries=10):
     Arguments: 
       - 'state' is a state;
       - 'todo_list' is a list of tasks, goals, and multigoals;
-      - max_tries is a bound on how many times to execute the outer loop.
+      - max_tries is a bound on how many times to execute the outer loop;
+      - if repair is True, then after a command fails, the next plan comes
+        from repair_plan rather than from planning for todo_list again,
+        unless repair_plan can't find one.
       
     Note: whenever run_lazy_lookahead encounters an action for which there is
     no corresponding command definition, it uses the action definition instead.
     """
     
     if verbose >= 1: 
-        log_event(f"RLL> run_lazy_lookahead, verbose = {verbose}, max_tries = {max_tries}")
-        log_event(f"RLL> initial state: {state.__name__}")
-        log_event('RLL> To do:', todo_list)
-
+        emit_event(1, 'rll_start', "RLL> run_lazy_lookahead, verbose = {verbose}, " + \
+                   "max_tries = {max_tries}\nRLL> initial state: {state.__name__}\n" + \
+                   "RLL> To do: {todo_list!t}", verbose=verbose, max_tries=max_tries,
+                   state=state, todo_list=list(todo_list))
+
+    if copy_on_write:
+        state = _private_copy(state)
+    failed_step = None
     for tries in range(1,max_tries+1):
         if verbose >= 1: 
             ordinals = {1:'st',2:'nd',3:'rd'}
-            if ordinals.get(tries):
-                log_event(f"RLL> {tries}{ordinals.get(tries)} call to find_plan:\n")
-            else:
-                log_event(f"RLL> {tries}th call to find_plan:\n")
-        plan = find_plan(state, todo_list)
+            emit_event(1, 'rll_find_plan', "RLL> {tries}" + ordinals.get(tries, 'th') + \
+                       " call to find_plan:\n", tries=tries)
+        if not repair:
+            plan = find_plan(state, todo_list)
+        else:
+            if failed_step != None:
+                tree = repair_plan(tree, state, failed_step)
+                if verbose >= 1 and tree == False:
+                    emit_event(1, 'rll_repair_failed',
+                               'RLL> repair_plan failed; calling find_plan instead.')
+            if failed_step == None or tree == False:
+                tree = find_plan(state, todo_list, return_tree=True)
+            plan = tree.plan if tree else False
+            failed_step = None
         if plan == False or plan == None:
             if verbose >= 1:
                 raise Exception(
@@ -920,11 +5130,11 @@ def run_lazy_lookahead(state, todo_list, max_tries=10):
             return state
         if plan == []:
             if verbose >= 1: 
-                log_event(f'RLL> Empty plan => success',
-                      f'after {tries} calls to find_plan.')
+                emit_event(1, 'rll_success', 'RLL> Empty plan => success ' + \
+                           'after {tries} calls to find_plan.', tries=tries)
             if verbose >= 2: state.display(heading='> final state')
             return state
-        for action in plan:
+        for (step, action) in enumerate(plan):
             command_name = 'c_' + action[0]
             command_func = current_domain._command_dict.get(command_name)
             if command_func == None:
@@ -934,21 +5144,24 @@ def run_lazy_lookahead(state, todo_list, max_tries=10):
                 command_func = current_domain._action_dict.get(action[0])
                 
             if verbose >= 1:
-                log_event('RLL> Command:', [command_name] + list(action[1:]))
+                emit_event(1, 'rll_command', 'RLL> Command: {command} {args}',
+                           command=command_name, args=list(action[1:]))
             new_state = _apply_command_and_continue(state, command_func, action[1:])
             if new_state == False:
                 if verbose >= 1: 
-                    log_event(f'RLL> WARNING: command {command_name} failed; will call find_plan.')
-                    break
+                    emit_event(1, 'rll_command_failed', 'RLL> WARNING: command {command} ' + \
+                               'failed; will call find_plan.', command=command_name)
+                failed_step = step
+                break
             else:
                 if verbose >= 2: 
                     new_state.display()
                 state = new_state
         # if state != False then we're here because the plan ended
         if verbose >= 1 and state:
-            log_event(f'RLL> Plan ended; will call find_plan again.')
+            emit_event(1, 'rll_plan_ended', 'RLL> Plan ended; will call find_plan again.')
         
-    if verbose >= 1: log_event('RLL> Too many tries, giving up.')
+    if verbose >= 1: emit_event(1, 'rll_gave_up', 'RLL> Too many tries, giving up.')
     if verbose >= 2: state.display(heading='RLL> final state')
     return state
 
@@ -958,17 +5171,19 @@ def _apply_command_and_continue(state, command, args):
     _apply_command_and_continue applies 'command' by retrieving its
     function definition and calling it on the arguments.
     """
-    if verbose >= 3:
-        log_event(f"_apply_command_and_continue {command.__name__}, args = {args}")
     next_state = command(state.copy(),*args)
     if next_state:
         if verbose >= 3:
-            log_event('applied')
+            emit_event(3, 'command_applied', "_apply_command_and_continue " + \
+                       "{command.__name__}, args = {args}: applied",
+                       command=command, args=args)
             next_state.display()
         return next_state
     else:
         if verbose >= 3:
-            log_event('not applicable')
+            emit_event(3, 'command_not_applicable', "_apply_command_and_continue " + \
+                       "{command.__name__}, args = {args}: not applicable",
+                       command=command, args=args)
         return False
 
 
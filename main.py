@@ -9,6 +9,9 @@ the_domain = gtpyhop.Domain(__package__)  # must be defined before importing any
 from Examples.blocks_htn.methods import *
 from Examples.blocks_htn.actions import *
 
+# replanning from a state that has already been planned for reuses the earlier plan
+plan_cache = gtpyhop.PlanCache()
+
 llm = LLMModule(
     model_path="../../models/solar-10.7b-instruct-v1.0.Q5_K_M.gguf",
     n_threads=16,
@@ -128,7 +131,7 @@ def generate_plan(initial_state) -> list:
     goal1a.display(heading="Here is a description of the goal named")
 
     # find_plan will also inform the LLM
-    plan = gtpyhop.find_plan(state=initial_state, todo_list=[('achieve', goal1a)])
+    plan = gtpyhop.find_plan(state=initial_state, todo_list=[('achieve', goal1a)], plan_cache=plan_cache)
     return plan
 
 